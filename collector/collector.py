@@ -60,6 +60,7 @@
 import sys
 import os
 import plac
+import signal
 from datetime import datetime
 from time import sleep
 from timeit import default_timer as timer
@@ -83,7 +84,12 @@ def main(api_only=False, create=False, index_license=False, text_lang=False,
          file=None, force=False, get_files=False, prefer_http=False, id=None,
          lang=None, index_langs=False, print_details=False, print_stats=False,
          index_readmes=False, print_summary=False, print_ids=False,
-         infer_type=False, list_deleted=False, user=None, delete=False, *repos):
+         infer_type=False, list_deleted=False, user=None, delete=False,
+         workers=None, async_pages=None, shard_size=None, graphql=False,
+         enrich=False, batch_size=None, resume=False, compress=False,
+         zip_readmes=False, dedup=False, inherit=False, refresh=False,
+         ttl=None, offline=False, in_database=False, processes=None,
+         *repos):
     '''Generate or print index of projects found in repositories.'''
 
     def convert(arg):
@@ -93,6 +99,13 @@ def main(api_only=False, create=False, index_license=False, text_lang=False,
         raise SystemExit('Cannot specify both API-only and prefer-HTTP.')
 
     id = int(id) if id else 0
+    workers = int(workers) if workers else 1
+    async_pages = int(async_pages) if async_pages else 0
+    shard_size = int(shard_size) if shard_size else 0
+    batch_size = int(batch_size) if batch_size else 0
+    processes = int(processes) if processes else 0
+    if workers < 1:
+        raise SystemExit('The number of workers must be at least 1.')
     lang = lang.split(',') if lang else None
     if repos:
         repos = [convert(x) for x in repos]
@@ -103,7 +116,14 @@ def main(api_only=False, create=False, index_license=False, text_lang=False,
                 repos = [int(x) for x in repos]
 
     args = {'targets': repos, 'languages': lang, 'prefer_http': prefer_http,
-            'api_only': api_only, 'force': force, 'start_id': id}
+            'api_only': api_only, 'force': force, 'start_id': id,
+            'workers': workers, 'async_pages': async_pages,
+            'shard_size': shard_size, 'graphql': graphql,
+            'batch_size': batch_size, 'resume': resume, 'compress': compress,
+            'dedup': dedup, 'inherit': inherit, 'offline': offline,
+            'in_database': in_database, 'processes': processes}
+    if refresh:
+        args['ttl'] = float(ttl) if ttl else None
 
     if   print_stats:     call('print_stats'  ,     user=user, **args)
     elif print_summary:   call('print_summary',     user=user, **args)
@@ -113,11 +133,14 @@ def main(api_only=False, create=False, index_license=False, text_lang=False,
     elif index_langs:     call('add_languages',     user=user, **args)
     elif index_readmes:   call('add_readmes',       user=user, **args)
     elif index_license:   call('add_licenses',      user=user, **args)
+    elif enrich:          call('enrich',            user=user, **args)
     elif delete:          call('mark_deleted',      user=user, **args)
     elif list_deleted:    call('list_deleted',      user=user, **args)
     elif infer_type:      call('infer_type',        user=user, **args)
     elif get_files:       call('add_files',         user=user, **args)
     elif text_lang:       call('detect_text_lang',  user=user, **args)
+    elif zip_readmes:     call('compress_readmes',  user=user, **args)
+    elif refresh:         call('refresh',           user=user, **args)
     else:
         raise SystemExit('No action specified. Use -h for help.')
 
@@ -127,20 +150,33 @@ def call(action, user, **kwargs):
 
     started = timer()
     casicsdb = CasicsDB()
+    indexer = None
+
+    # Updates to the database are buffered.  Turn a SIGTERM into a normal
+    # exit so that the buffer gets flushed on the way out.
+    def terminate(signum, frame):
+        raise SystemExit('Terminated by signal {}'.format(signum))
+    signal.signal(signal.SIGTERM, terminate)
 
     # Do each host in turn.  (Currently we handle only GitHub.)
     try:
-        # Find out how we log into the hosting service.
-        (github_user, github_password) = GitHub.login('github', user)
+        # Find out how we log into the hosting service.  More than one
+        # account may be given, in which case their API budgets are pooled.
+        users = user.split(',') if user else [None]
+        logins = [GitHub.login('github', u) for u in users]
+        (github_user, github_password) = logins[0]
         # Open our Mongo database.
         github_db = casicsdb.open('github')
         # Initialize our worker object.
-        indexer = GitHubIndexer(github_user, github_password, github_db)
+        indexer = GitHubIndexer(github_user, github_password, github_db,
+                                logins[1:])
 
         # Figure out what action we're supposed to perform, and do it.
         method = getattr(indexer, action, None)
         method(**kwargs)
     finally:
+        if indexer:
+            indexer.flush_updates()
         casicsdb.close()
 
     # We're done.  Print some messages and exit.
@@ -155,26 +191,42 @@ def call(action, user, **kwargs):
 # Plac automatically adds a -h argument for help, so no need to do it here.
 
 main.__annotations__ = dict(
+    async_pages   = ('fetch this many GitHub pages at a time',        'option', 'a'),
     api_only      = ('only use the API, without first trying HTTP',   'flag',   'A'),
+    batch_size    = ('read this many database entries at a time',     'option', 'b'),
     create        = ('create database entries by querying GitHub',    'flag',   'c'),
+    dedup         = ('(with -r) store each distinct README once',     'flag',   'd'),
+    shard_size    = ('share _id ranges of this size with other runs', 'option', 'D'),
     index_license = ('index license(s)',                              'flag',   'e'),
+    enrich        = ('get all data on repo home pages in one pass',   'flag',   'E'),
     file          = ('use subset of repo names or id\'s from file',   'option', 'f'),
     force         = ('get info even if we know we already tried',     'flag',   'F'),
     get_files     = ('get list of files at GitHub repo top level',    'flag',   'g'),
+    graphql       = ('batch API queries using GitHub GraphQL',        'flag',   'G'),
     prefer_http   = ('prefer HTTP without using API, if possible',    'flag'  , 'H'),
     infer_type    = ('try to infer if repos contain code or not',     'flag',   'i'),
     id            = ('start iterations with this GitHub id',          'option', 'I'),
+    processes     = ('(with -t) use this many processes',             'option', 'j'),
+    inherit       = ('copy data to unpushed forks from parent repos', 'flag',   'k'),
     index_langs   = ('gather programming languages',                  'flag',   'l'),
     lang          = ('(with -p/-s/-S) limit to given languages',      'option', 'L'),
+    in_database   = ('(with -i) let the database do the inferring',   'flag',   'M'),
+    offline       = ('(with -i) use only data already in database',   'flag',   'o'),
     print_details = ('print details about entries',                   'flag',   'p'),
     print_stats   = ('print summary of database statistics',          'flag',   'P'),
     index_readmes = ('gather README files',                           'flag',   'r'),
+    resume        = ('continue where an interrupted run stopped',     'flag',   'R'),
     print_summary = ('print list of indexed repositories'   ,         'flag',   's'),
     print_ids     = ('print all known repository id numbers',         'flag',   'S'),
     text_lang     = ('detect text languages in description & readme', 'flag',   't'),
-    user          = ('use specified GitHub user account name',        'option', 'u'),
+    ttl           = ('(with -U) also refresh data older than N days', 'option', 'T'),
+    refresh       = ('refresh entries changed since last gathered',   'flag',   'U'),
+    user          = ('use GitHub account name(s), comma-separated',   'option', 'u'),
+    workers       = ('process this many entries concurrently',        'option', 'w'),
     list_deleted  = ('list deleted entries',                          'flag',   'x'),
     delete        = ('mark specific entries as deleted',              'flag',   'X'),
+    compress      = ('(with -r) store READMEs compressed',            'flag',   'z'),
+    zip_readmes   = ('compress READMEs stored as plain text',         'flag',   'Z'),
     repos         = 'one or more repository identifiers or names',
 )
 
@@ -10,6 +10,8 @@
 # Inventory Creation System.  For more information, visit http://casics.org.
 # ------------------------------------------------------------------------- -->
 
+import functools
+
 # Code to normalize language names.
 # List came from our first database approach to cataloging github repos.
 lang_names = {
@@ -830,20 +832,29 @@ noncode_file_extensions = [
 ]
 
 
+# The lists above are kept for reference and for other modules to use, but
+# lookups are done in these sets.
+
+_code_files              = frozenset(code_files)
+_noncode_files           = frozenset(noncode_files)
+_code_file_extensions    = frozenset(code_file_extensions)
+_noncode_file_extensions = frozenset(noncode_file_extensions)
+
+
 def has_code_extension(name):
-    return name.split(".")[-1].lower() in code_file_extensions
+    return name.split(".")[-1].lower() in _code_file_extensions
 
 
 def has_noncode_extension(name):
-    return name.split(".")[-1].lower() in noncode_file_extensions
+    return name.split(".")[-1].lower() in _noncode_file_extensions
 
 
 def has_code_file_name(name):
-    return name.lower() in code_files
+    return name.lower() in _code_files
 
 
 def has_noncode_file_name(name):
-    return name.lower() in noncode_files
+    return name.lower() in _noncode_files
 
 
 def is_code_file(file):
@@ -852,3 +863,114 @@ def is_code_file(file):
 
 def is_noncode_file(file):
     return has_noncode_extension(file) or has_noncode_file_name(file)
+
+
+# Classifying whole entries.
+# .............................................................................
+# classify() makes a guess about the content_type of a repository from its
+# list of files and its languages, as stored in the 'files' and 'languages'
+# fields of its database entry.  The file tests are very basic and
+# conservative.  They are necessarily heuristic, so they could be wrong if
+# someone does something really unusual.  The language-based heuristics are
+# more iffy because GitHub's language analyzer sometimes guesses wrong.
+#
+# The same file names (README.md, LICENSE, .gitignore, ...) turn up over
+# and over, so what we decide about each name is remembered.
+
+CODE_FILE    = 1
+NONCODE_FILE = 2
+
+
+@functools.lru_cache(maxsize=65536)
+def file_kind(name):
+    '''Returns CODE_FILE, NONCODE_FILE, both or'ed together, or 0.'''
+    name = name.lower()
+    ext = name.split('.')[-1]
+    kind = 0
+    if ext in _code_file_extensions or name in _code_files:
+        kind |= CODE_FILE
+    if ext in _noncode_file_extensions or name in _noncode_files:
+        kind |= NONCODE_FILE
+    return kind
+
+
+def classify(files, languages):
+    '''Returns a tuple (guess, method), where 'guess' is 'code', 'noncode'
+    or None, and 'method' says what the guess was based on.  'files' and
+    'languages' are the values of the fields of the same names in an
+    entry, and either can be -1 (meaning unknown).'''
+    if languages != -1:
+        languages = [lang['name'] for lang in languages]
+    return _classify(files, languages)
+
+
+def _classify(files, lang_names):
+    if files != -1:
+        all_noncode = True
+        for name in files:
+            kind = file_kind(name)
+            if kind & CODE_FILE:
+                return ('code', 'file names')
+            if not kind & NONCODE_FILE:
+                all_noncode = False
+        if all_noncode:
+            return ('noncode', 'file names')
+    if lang_names != -1:
+        if any(known_code_lang(lang) for lang in lang_names):
+            return ('code', 'languages')
+    return (None, None)
+
+
+# Classifying in the database.
+# .............................................................................
+# classify_expression() turns the same rules into a MongoDB aggregation
+# expression, so that the database server can classify entries itself
+# without sending them to us.  The expression refers to the 'files' and
+# 'languages' fields of the document, and evaluates to one of the values in
+# 'results', which maps each possible result of classify() except
+# (None, None) to the value wanted for it; or to null if there's no guess.
+# (This needs to be kept in step with _classify() and file_kind().)
+
+def classify_expression(results):
+    code_exts     = {'$literal': sorted(_code_file_extensions)}
+    noncode_exts  = {'$literal': sorted(_noncode_file_extensions)}
+    code_names    = {'$literal': sorted(_code_files)}
+    noncode_names = {'$literal': sorted(_noncode_files)}
+    code_langs    = {'$literal': sorted(k for (k, v) in lang_names_nocase.items() if v)}
+
+    def each_file(extensions, names):
+        # True or false for each file name, depending on whether it has
+        # one of the extensions or names.
+        return {'$map': {
+            'input': '$files',
+            'as': 'file',
+            'in': {'$let': {
+                'vars': {'name': {'$toLower': '$$file'}},
+                'in': {'$or': [
+                    {'$in': [{'$arrayElemAt': [{'$split': ['$$name', '.']}, -1]},
+                             extensions]},
+                    {'$in': ['$$name', names]}]}}}}}
+
+    any_code_lang = {'$in': [True, {'$map': {
+        'input': '$languages',
+        'as': 'lang',
+        'in': {'$in': [{'$toLower': '$$lang.name'}, code_langs]}}}]}
+
+    any_code_file = {'$in': [True, each_file(code_exts, code_names)]}
+    all_noncode   = {'$eq': [False, {'$in': [False, each_file(noncode_exts,
+                                                          noncode_names)]}]}
+    has_files = {'$isArray': '$files'}
+    has_langs = {'$isArray': '$languages'}
+
+    # $and doesn't stop at the first false value, so the tests are nested
+    # in $cond to keep them away from values of -1.
+    return {'$switch': {
+        'branches': [
+            {'case': {'$cond': [has_files, any_code_file, False]},
+             'then': {'$literal': results[('code', 'file names')]}},
+            {'case': {'$cond': [has_files, all_noncode, False]},
+             'then': {'$literal': results[('noncode', 'file names')]}},
+            {'case': {'$cond': [has_langs, any_code_lang, False]},
+             'then': {'$literal': results[('code', 'languages')]}},
+        ],
+        'default': None}}
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3.4
+#
+# @file    coordination.py
+# @brief   Coordination of work between several collector processes.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+import os
+import socket
+import sys
+import threading
+from pymongo import UpdateOne, ReturnDocument
+from time import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
+from utils import *
+
+
+# Summary
+# .............................................................................
+# Several collector processes, on one or several hosts, can share the work of
+# a single action by splitting the _id space into fixed-size ranges.  Each
+# range is a document in a coordination collection in Mongo; a process claims
+# a range by writing its name and an expiration time into the document, and
+# keeps renewing the lease while it works.  If a process dies, its lease
+# expires and another process takes the range over.
+#
+# Range boundaries are always multiples of the range size, so processes that
+# start at different times (and thus see slightly different _id bounds) still
+# agree on the ranges.  Ranges are not subdivided further: if a range is
+# taken over, the new owner goes through all of it again, but the selectors
+# used by the actions skip entries that have already been done.
+
+class RangeLeases():
+    _lease_sec   = 600
+    _bulk_size   = 1000
+
+
+    def __init__(self, collection, job, owner=None):
+        self.db    = collection
+        self.job   = job
+        self.owner = owner or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.db.create_index([('job', 1), ('low', 1)], unique=True)
+
+
+    def create(self, low, high, size):
+        # Make sure there is a range document for every range covering the
+        # _id values from 'low' to 'high', inclusive.  Every process calls
+        # this, so it must not disturb ranges that exist already.
+        ops = []
+        for start in range((low // size) * size, high + 1, size):
+            ops.append(UpdateOne({'job': self.job, 'low': start},
+                                 {'$setOnInsert': {'high': start + size,
+                                                   'owner': None,
+                                                   'expires': 0,
+                                                   'done': False}},
+                                 upsert=True))
+            if len(ops) >= self._bulk_size:
+                self.db.bulk_write(ops, ordered=False)
+                ops = []
+        if ops:
+            self.db.bulk_write(ops, ordered=False)
+        # If every range is done, this is a fresh run of the same job.
+        if not self.db.find_one({'job': self.job, 'done': False}, {'_id': 1}):
+            msg('All ranges of {} were done -- starting over'.format(self.job))
+            self.db.update_many({'job': self.job},
+                                {'$set': {'done': False, 'owner': None,
+                                          'expires': 0}})
+
+
+    def claim(self, skip=None):
+        # Returns the lowest range that nobody holds a live lease on, or None
+        # if there is nothing left to do.  Ranges whose _id's are in 'skip'
+        # are not claimed.
+        now = time()
+        query = {'job': self.job, 'done': False,
+                 '$or': [{'owner': None}, {'owner': self.owner},
+                         {'expires': {'$lt': now}}]}
+        if skip:
+            query['_id'] = {'$nin': list(skip)}
+        return self.db.find_one_and_update(
+            query,
+            {'$set': {'owner': self.owner, 'expires': now + self._lease_sec}},
+            sort=[('low', 1)], return_document=ReturnDocument.AFTER)
+
+
+    def renew(self, lease):
+        # Returns False if the lease has been lost to another process.
+        result = self.db.update_one({'_id': lease['_id'], 'owner': self.owner},
+                                    {'$set': {'expires': time() + self._lease_sec}})
+        return result.matched_count > 0
+
+
+    def finish(self, lease):
+        self.db.update_one({'_id': lease['_id'], 'owner': self.owner},
+                           {'$set': {'done': True, 'owner': None}})
+
+
+    def release(self, lease):
+        # Gives up a range without finishing it, so that another process can
+        # claim it straight away instead of waiting for the lease to expire.
+        self.db.update_one({'_id': lease['_id'], 'owner': self.owner},
+                           {'$set': {'owner': None, 'expires': 0}})
+
+
+# Checkpoints.
+# .............................................................................
+# A long run of an action can die after days.  A Checkpoint records how far
+# the run got: the highest _id that has been completed, plus the _id's of
+# the entries that were still being worked on at the time (with several
+# workers, these can be lower than the highest completed _id).  A later run
+# of the same job can start from there instead of scanning the collection
+# from the beginning.  The entries are assumed to be visited in order of
+# increasing _id.
+
+class Checkpoint():
+    _save_interval_sec = 60
+
+
+    def __init__(self, collection, job):
+        self.db        = collection
+        self.job       = job
+        self._lock     = threading.Lock()
+        self._last_id  = None
+        self._running  = set()
+        self._saved_at = time()
+
+
+    def load(self):
+        '''Returns the saved checkpoint, or None if there isn't one.  The
+        saved values also become the starting point of this checkpoint.'''
+        saved = self.db.find_one({'_id': self.job})
+        if saved and not saved['done']:
+            with self._lock:
+                self._last_id = saved['last_id']
+                self._running = set(saved['in_flight'])
+        return saved
+
+
+    def started(self, id):
+        with self._lock:
+            self._running.add(id)
+
+
+    def finished(self, id):
+        with self._lock:
+            self._running.discard(id)
+            if self._last_id == None or id > self._last_id:
+                self._last_id = id
+
+
+    def forget(self, ids):
+        with self._lock:
+            self._running.difference_update(ids)
+
+
+    def pending(self):
+        '''Returns the number of entries started but not finished.'''
+        with self._lock:
+            return len(self._running)
+
+
+    def due(self):
+        return time() - self._saved_at >= self._save_interval_sec
+
+
+    def state(self):
+        '''Returns a snapshot of the values to be saved.  Take the snapshot
+        before making sure the work it covers has been written out.'''
+        with self._lock:
+            last_id = self._last_id
+            # Anything above last_id will be visited again anyway.
+            in_flight = sorted(id for id in self._running
+                               if last_id == None or id < last_id)
+        return {'last_id': last_id, 'in_flight': in_flight}
+
+
+    def save(self, state, done=False):
+        state = dict(state, done=done, saved=time())
+        self.db.update_one({'_id': self.job}, {'$set': state}, upsert=True)
+        self._saved_at = time()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3.4
+#
+# @file    github_graphql.py
+# @brief   Batched queries for repository data via GitHub's GraphQL API.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+import json
+import os
+import sys
+from datetime import datetime, timezone
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
+from utils import *
+from github_net import *
+
+
+# Summary
+# .............................................................................
+# The REST API costs one call per repository for each of languages, README
+# and basic repository info.  GitHub's GraphQL API lets us ask about up to
+# 100 repositories in a single query, by giving each repository its own
+# alias in the query.  GraphQLBatcher builds such queries and returns the
+# results as GraphQLRepo objects, which have the same attributes as the
+# github3.py Repository objects used by GitHubIndexer, plus the languages,
+# licenses and README text.
+#
+# GraphQL has no equivalent of the REST API's "preferred README" lookup, so
+# the query asks for the usual README file names and takes the first one
+# found, in the same order of preference that GitHub uses.  GraphQL also has
+# no direct equivalent of the REST "source" of a fork; we follow the chain of
+# parents a few levels up and take the last one as the root.
+
+_readme_names = ['README.md', 'README.markdown', 'README.rdoc', 'README.rst',
+                 'README', 'README.txt']
+
+_max_readme_size = 5242880
+
+_fork_depth = 3
+
+_repo_fields = '''
+    databaseId
+    name
+    owner { login }
+    description
+    homepageUrl
+    isPrivate
+    isFork
+    %(parents)s
+    defaultBranchRef { name }
+    primaryLanguage { name }
+    languages(first: 100) { edges { size node { name } } }
+    licenseInfo { name }
+    createdAt
+    updatedAt
+    pushedAt
+    %(readmes)s
+'''
+
+
+class GraphQLException(Exception):
+    def __init__(self, message, code):
+        message = str(message).encode('utf-8')
+        super(GraphQLException, self).__init__(message)
+        self.code = code
+
+
+class GraphQLOwner():
+    def __init__(self, login):
+        self.login = login
+
+
+class GraphQLParent():
+    def __init__(self, full_name):
+        self.full_name = full_name
+
+
+class GraphQLRepo():
+    # Mimics the parts of github3.py's Repository used by GitHubIndexer.
+    def __init__(self, data):
+        self.id             = data['databaseId']
+        self.name           = data['name']
+        self.owner          = GraphQLOwner(data['owner']['login'])
+        self.full_name      = self.owner.login + '/' + self.name
+        self.description    = data['description']
+        self.homepage       = data['homepageUrl']
+        self.private        = data['isPrivate']
+        self.fork           = data['isFork']
+        self.created_at     = _timestamp(data['createdAt'])
+        self.updated_at     = _timestamp(data['updatedAt'])
+        self.pushed_at      = _timestamp(data['pushedAt'])
+        branch = data['defaultBranchRef']
+        self.default_branch = branch['name'] if branch else None
+        language = data['primaryLanguage']
+        self.language       = language['name'] if language else None
+
+        # Same form as the result of the REST API call for languages.
+        self.languages = {e['node']['name']: e['size']
+                          for e in data['languages']['edges']}
+        license = data['licenseInfo']
+        self.licenses = [license['name']] if license else []
+
+        self.parent = None
+        self.source = None
+        parent = data.get('parent')
+        while parent:
+            if not self.parent:
+                self.parent = GraphQLParent(parent['nameWithOwner'])
+            self.source = GraphQLParent(parent['nameWithOwner'])
+            parent = parent.get('parent')
+
+        # Same values as GitHubIndexer.get_readme(): the text, -1 if there
+        # is no README, or -2 if it's too big to be worth keeping.
+        self.readme = -1
+        for i in range(0, len(_readme_names)):
+            blob = data.get('readme' + str(i))
+            if not blob:
+                continue
+            if blob['byteSize'] > _max_readme_size:
+                self.readme = -2
+            elif blob['isBinary']:
+                self.readme = ''
+            else:
+                self.readme = blob['text']
+            break
+
+
+class GraphQLBatcher():
+    _endpoint = 'https://api.github.com/graphql'
+    _max_batch = 100
+
+
+    def __init__(self, tokens, endpoint=None, user_agent=None, pool=None):
+        # 'tokens' is a TokenPool.  'endpoint' can be given to talk to
+        # something other than GitHub, e.g., a stand-in server for testing.
+        # 'pool' is the ConnectionPool to use for the endpoint's host, if
+        # the caller has one already.
+        (host, path)    = url_host_path(endpoint or self._endpoint)
+        secure          = not (endpoint or self._endpoint).startswith('http:')
+        self._tokens    = tokens
+        self._path      = path
+        self._pool      = pool or ConnectionPool(host, secure=secure)
+        self._breaker   = circuit_breaker(host)
+        self._agent     = user_agent or 'casics'
+
+
+    def query(self, names):
+        '''Given a list of (owner, name) tuples, returns a dict mapping each
+        tuple to a GraphQLRepo object, or to None if GitHub did not return
+        the repository (e.g., because it no longer exists).'''
+        results = {}
+        for start in range(0, len(names), self._max_batch):
+            batch = names[start : start + self._max_batch]
+            results.update(self._query_batch(batch))
+        return results
+
+
+    def _query_batch(self, names):
+        token = self._tokens.choose('graphql')
+        headers = {
+            'User-Agent': self._agent,
+            'Authorization': self._tokens.auth_header(token),
+            'Content-Type': 'application/json',
+        }
+        body = json.dumps({'query': graphql_query(names)}).encode('utf-8')
+        breaker = self._breaker
+        if not breaker.allow():
+            raise HostUnavailableException(breaker.host, breaker.until())
+        try:
+            response = self._pool.request('POST', self._path, headers, body)
+        except Exception:
+            breaker.failure()
+            raise
+        self._tokens.update(token, response.headers, 'graphql')
+        if server_trouble(response.status, response.headers):
+            breaker.failure(retry_after(response.headers))
+        else:
+            breaker.success()
+        if response.status != 200:
+            raise GraphQLException('GraphQL query failed with code {}'.format(
+                response.status), response.status)
+        content = json.loads(response.text())
+        data = content.get('data')
+        if not data:
+            raise GraphQLException('GraphQL query failed: {}'.format(
+                content.get('errors')), None)
+        results = {}
+        for i, (owner, name) in enumerate(names):
+            repo = data.get('r' + str(i))
+            results[(owner, name)] = GraphQLRepo(repo) if repo else None
+        return results
+
+
+# Utilities
+# .............................................................................
+
+def graphql_query(names):
+    '''Returns the text of a GraphQL query for the list of (owner, name)
+    tuples.  The result for the i-th repository has the alias "r<i>".'''
+    parents = 'parent { nameWithOwner }'
+    for _ in range(1, _fork_depth):
+        parents = 'parent { nameWithOwner ' + parents + ' }'
+    readmes = '\n    '.join('readme{}: object(expression: {}) '
+                           '{{ ... on Blob {{ text byteSize isBinary }} }}'.format(
+                               i, json.dumps('HEAD:' + f))
+                           for i, f in enumerate(_readme_names))
+    fields = _repo_fields % {'parents': parents, 'readmes': readmes}
+    parts = []
+    for i, (owner, name) in enumerate(names):
+        parts.append('r{}: repository(owner: {}, name: {}) {{{}}}'.format(
+            i, json.dumps(owner), json.dumps(name), fields))
+    return 'query {\n' + '\n'.join(parts) + '\n}'
+
+
+def _timestamp(value):
+    if not value:
+        return None
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
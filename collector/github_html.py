@@ -11,15 +11,25 @@
 # ------------------------------------------------------------------------- -->
 
 import os
+import re
 import requests
 import sys
 import urllib
 import html
-from time import sleep
+import asyncio
+import threading
+
+try:
+    import aiohttp
+except ImportError:
+    # Only needed by GitHubPageFetcher.
+    aiohttp = None
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
 sys.path.append(os.path.join(os.path.dirname(__file__), "../database"))
 from utils import *
+from github_net import HostUnavailableException, RetryPolicy, \
+    circuit_breaker, retry_after, server_trouble
 
 
 class NetworkAccessException(Exception):
@@ -38,10 +48,23 @@ class PageParsingException(Exception):
 
 class GitHubHomePage():
     _max_retries = 3
-    _retries_pause_sec = 0.5
-
-
-    def __init__(self):
+    _retry = RetryPolicy()
+    _chunk_size = 16384
+
+
+    def __init__(self, fields=None):
+        # If 'fields' is given, it is a collection of names of the methods
+        # below (e.g., ['licenses']) whose values the caller wants.  Only
+        # those are extracted when the page is fetched, and the download
+        # stops once the part of the page holding them has been read.  The
+        # other methods still work, but compute their values lazily from
+        # whatever part of the page was read.
+        if fields != None:
+            fields = set(fields)
+            unknown = fields - set(_settled_by)
+            if unknown:
+                raise ValueError('Unknown fields: {}'.format(', '.join(unknown)))
+        self._fields           = fields
         self._owner            = None
         self._name             = None
         self._url              = None
@@ -67,16 +90,31 @@ class GitHubHomePage():
             raise ValueError('Invalid arguments')
         self._owner = owner
         self._name  = name
+        breaker = circuit_breaker('github.com')
         try:
             url = self.url()
-            for _ in range(0, self._max_retries):
-                r = timed_get(url, verify=False)
+            for attempt in range(0, self._max_retries):
+                if not breaker.allow():
+                    raise HostUnavailableException(breaker.host, breaker.until())
+                r = timed_get(url, verify=False, stream=self._fields != None)
                 if r == None:
                     # Network timeout or other serious problem.
-                    raise NetworkAccessException('Cannot access {}: {}'.format(url, err))
-                elif r.status_code == 202:
+                    breaker.failure()
+                    if attempt + 1 < self._max_retries:
+                        self._retry.pause(attempt)
+                        continue
+                    raise NetworkAccessException('Cannot access {}'.format(url), None)
+                elif server_trouble(r.status_code, r.headers):
+                    wait = retry_after(r.headers)
+                    breaker.failure(wait)
+                    if attempt + 1 < self._max_retries:
+                        self._retry.pause(attempt, wait)
+                        continue
+                    break
+                breaker.success()
+                if r.status_code == 202:
                     # 202 = "accepted". We try again after a pause.
-                    sleep(self._retries_pause_sec)
+                    self._retry.pause(attempt)
                     continue
                 elif r.status_code == 301:
                     # Redirection.  Start from the top with new URL.
@@ -87,41 +125,118 @@ class GitHubHomePage():
                     break
 
                 # Success.
-                self._html = r.text
-
-                # If we're forcing a refresh of the HTML, we're done now.
-                if refresh:
-                    break
-
-                # Initialize the remaining internal values based on what we
-                # got.  It's critical to run through all of them so that the
-                # values are set based on the content on the GitHub page,
-                # because it will reflect the current owner and name (in case
-                # the owner and/or name have changed).  Note: no need to set
-                # the self._foo attributes directly here; the functions do it.
-                self.owner(force=True)
-                self.name(force=True)
-                self.url(force=True)
-                if not self.is_problem():
-                    self.is_empty()
-                    self.description()
-                    self.homepage()
-                    self.languages()
-                    self.forked_from()
-                    self.default_branch()
-                    self.files()
-                    self.num_commits()
-                    self.num_releases()
-                    self.num_branches()
-                    self.num_contributors()
-                    self.licenses()
+                if self._fields != None:
+                    self.set_html(self.read_wanted(r), refresh)
+                else:
+                    self.set_html(r.text, refresh)
                 break
             self._status_code = r.status_code
             return r.status_code
+        except HostUnavailableException:
+            # Let the caller put off work that needs github.com.
+            raise
+        except Exception as err:
+            raise PageParsingException('Getting GitHub page HTML: {}'.format(err), err)
+
+
+    async def get_html_async(self, owner, name, session, refresh=False):
+        # Same as get_html(), but for use in an asyncio event loop.  The
+        # 'session' is an aiohttp.ClientSession, normally the one created by
+        # GitHubPageFetcher so that many pages can be in flight at once.
+        if not owner or not name:
+            raise ValueError('Invalid arguments')
+        self._owner = owner
+        self._name  = name
+        breaker = circuit_breaker('github.com')
+        try:
+            url = self.url()
+            status = None
+            for attempt in range(0, self._max_retries):
+                if not breaker.allow():
+                    raise HostUnavailableException(breaker.host, breaker.until())
+                try:
+                    r = await session.get(url, ssl=False)
+                except Exception:
+                    breaker.failure()
+                    raise
+                async with r:
+                    status = r.status
+                    if server_trouble(status, r.headers):
+                        wait = retry_after(r.headers)
+                        breaker.failure(wait)
+                        if attempt + 1 < self._max_retries:
+                            await asyncio.sleep(self._retry.delay(attempt, wait))
+                            continue
+                        break
+                    breaker.success()
+                    if status == 202:
+                        # 202 = "accepted". We try again after a pause.
+                        await asyncio.sleep(self._retry.delay(attempt))
+                        continue
+                    elif status != 200:
+                        # Something's wrong. Stop trying, let caller deal with it.
+                        break
+                    text = await r.text(errors='replace')
+                # Success.
+                self.set_html(text, refresh)
+                break
+            self._status_code = status
+            return status
+        except HostUnavailableException:
+            raise
         except Exception as err:
             raise PageParsingException('Getting GitHub page HTML: {}'.format(err), err)
 
 
+    def set_html(self, text, refresh=False):
+        self._html = text
+
+        # If we're forcing a refresh of the HTML, we're done now.
+        if refresh:
+            return
+
+        # Initialize the remaining internal values based on what we got.
+        # It's critical to set all of them based on the content on the
+        # GitHub page, because it will reflect the current owner and name
+        # (in case the owner and/or name have changed).  scan_home_page()
+        # gets the same values as the individual methods below, but in one
+        # pass over the HTML instead of one pass per field.
+        fields = scan_home_page(text, self._owner, self._name, self._fields)
+        self._owner            = fields.owner
+        self._name             = fields.name
+        self._is_problem       = fields.is_problem
+        self._is_empty         = fields.is_empty
+        self._description      = fields.description
+        self._homepage         = fields.homepage
+        self._languages        = fields.languages
+        self._forked_from      = fields.forked_from
+        self._default_branch   = fields.default_branch
+        self._files            = fields.files
+        self._num_commits      = fields.num_commits
+        self._num_releases     = fields.num_releases
+        self._num_branches     = fields.num_branches
+        self._num_contributors = fields.num_contributors
+        self._licenses         = fields.licenses
+        self.url(force=True)
+
+
+    def read_wanted(self, response):
+        # Reads the body of a streamed requests response until every field
+        # in self._fields is settled, and returns the text read so far.
+        watches = [_MarkerWatch(_settled_by[f]) for f in self._fields]
+        watches.append(_MarkerWatch([[_endtitle_marker]]))
+        body = bytearray()
+        try:
+            for chunk in response.iter_content(self._chunk_size):
+                body.extend(chunk)
+                watches = [w for w in watches if not w.seen(body)]
+                if not watches:
+                    break
+        finally:
+            response.close()
+        return body.decode(response.encoding or 'utf-8', errors='replace')
+
+
     def status_code(self):
         return self._status_code
 
@@ -498,6 +613,436 @@ class GitHubHomePage():
         return self._licenses
 
 
+
+class GitHubPageFetcher():
+    # Fetches many GitHub home pages at once using asyncio.  HTML scraping is
+    # not subject to the API rate limit, so the only thing that bounds this
+    # is the number of requests we allow to be in flight at the same time.
+    # One event loop, running in a thread of its own, and one aiohttp
+    # session are used for everything fetched until close() is called, so
+    # that connections to github.com are kept open from one batch to the
+    # next, and a batch can be fetched while the caller does other work.
+    _timeout_sec = 15
+
+
+    def __init__(self, max_in_flight=100):
+        if not aiohttp:
+            raise ImportError('Concurrent page fetching requires aiohttp')
+        self._max_in_flight = max_in_flight
+        self._loop = None
+        self._thread = None
+        self._session = None
+
+
+    def submit(self, names):
+        # 'names' is a list of (owner, name) tuples.  Starts fetching the
+        # pages and returns a concurrent.futures.Future whose result() is a
+        # list of (page, status) tuples in the same order, where 'page' is a
+        # GitHubHomePage object.  If fetching a page raised an exception,
+        # 'status' is the exception object instead of an HTTP status code.
+        if not self._loop:
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._loop.run_forever,
+                                            daemon=True)
+            self._thread.start()
+        return asyncio.run_coroutine_threadsafe(self._fetch_all(names), self._loop)
+
+
+    def fetch(self, names):
+        # Like submit(), but waits for the pages and returns the list.
+        return self.submit(names).result()
+
+
+    def close(self):
+        if not self._loop:
+            return
+        if self._session:
+            asyncio.run_coroutine_threadsafe(self._session.close(),
+                                             self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        (self._loop, self._thread, self._session) = (None, None, None)
+
+
+    async def _fetch_all(self, names):
+        if not self._session:
+            # The session has to be made inside the event loop.
+            connector = aiohttp.TCPConnector(limit=self._max_in_flight)
+            timeout = aiohttp.ClientTimeout(total=self._timeout_sec)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=timeout)
+        return await asyncio.gather(*[self._fetch_one(self._session, owner, name)
+                                      for (owner, name) in names])
+
+
+    async def _fetch_one(self, session, owner, name):
+        page = GitHubHomePage()
+        try:
+            return (page, await page.get_html_async(owner, name, session))
+        except Exception as err:
+            return (page, err)
+
+
+
+# Single-pass scanner.
+# .............................................................................
+# The methods of GitHubHomePage each search the whole page from the top for
+# their own markers, and files() re-slices the file list on every step,
+# which is quadratic in the number of files.  scan_home_page() instead finds
+# all the markers that those methods search for from the top in a single
+# regular expression sweep over the page.  The remaining searches start from
+# those positions and only go as far as the next delimiter, and the file
+# list is walked using positions in the page rather than slices of it.  The
+# results are the same as those of the GitHubHomePage methods, including
+# their quirks, for any page whose markers don't overlap one another.
+
+_title_marker    = '<title>'
+_title_gh_marker = '<title>GitHub '
+_title_gh_dash   = '<title>GitHub - '
+_endtitle_marker = '</title>'
+_problem_marker  = '<h3>There is a problem with this repository on disk.</h3>'
+_empty_marker    = '<h3>This repository is empty.</h3>'
+_about_marker    = 'itemprop="about">'
+_url_marker      = 'itemprop="url"><a href="'
+_atom_marker     = '.atom" rel="alternate"'
+_lang_marker     = 'class="lang">'
+_forkflag_marker = '<span class="fork-flag">'
+_forked_marker   = '<span class="text">forked from <a href="'
+_filewrap_marker = '"file-wrap"'
+_summary_marker  = '<ul class="numbers-summary">'
+_num_marker      = '<span class="num text-emphasized">'
+_svg_end_marker  = '</svg>'
+
+# The leading quote of "file-wrap" is matched by a lookbehind, because it
+# can be the closing quote of one of the other markers.
+_page_markers = re.compile('|'.join(
+    ['<title>(?:GitHub - |GitHub )?', re.escape(_endtitle_marker),
+     re.escape(_problem_marker), re.escape(_empty_marker),
+     re.escape(_about_marker), re.escape(_url_marker),
+     re.escape(_atom_marker), re.escape(_lang_marker),
+     re.escape(_forkflag_marker), '(?<=")file-wrap"',
+     re.escape(_summary_marker)]))
+
+# Where in the page each field's value is settled, for the selective mode of
+# GitHubHomePage.  Each value is a list of alternatives, and each alternative
+# is a sequence of markers that appear in that order in a home page.  Once
+# any one alternative has been seen in full, the rest of the page cannot
+# change the field.  The order is that of GitHub's layout: the head, the
+# description and fork flag, the numbers summary (which has the license),
+# the language bar, and finally the file list or the "empty" message.  A
+# problem page has none of these, and so is always read to the end.
+
+_end_of_files = [[_filewrap_marker, '</table'], [_empty_marker]]
+_end_of_summary = [[_summary_marker, '</ul>']]
+
+_settled_by = {
+    'description':      [[_summary_marker]],
+    'homepage':         [[_summary_marker]],
+    'forked_from':      [[_summary_marker]],
+    'default_branch':   [['</head>']],
+    'num_commits':      _end_of_summary,
+    'num_branches':     _end_of_summary,
+    'num_releases':     _end_of_summary,
+    'num_contributors': _end_of_summary,
+    'licenses':         _end_of_summary,
+    'languages':        [[_filewrap_marker], [_empty_marker]],
+    'files':            _end_of_files,
+    'is_empty':         _end_of_files,
+}
+
+
+class _MarkerWatch():
+    # Watches a growing buffer for any one of several sequences of markers.
+    def __init__(self, alternatives):
+        self._alternatives = [[m.encode('utf-8') for m in seq]
+                              for seq in alternatives]
+        self._progress = [(0, 0)] * len(self._alternatives)
+
+
+    def seen(self, buffer):
+        '''Returns True if one of the sequences has been seen in 'buffer',
+        which must be the same buffer as before, with more added to it.'''
+        for (i, seq) in enumerate(self._alternatives):
+            (index, offset) = self._progress[i]
+            while index < len(seq):
+                found = buffer.find(seq[index], offset)
+                if found < 0:
+                    # A marker may be split across the end of the buffer.
+                    offset = max(offset, len(buffer) - len(seq[index]) + 1)
+                    break
+                offset = found + len(seq[index])
+                index += 1
+            self._progress[i] = (index, offset)
+            if index == len(seq):
+                return True
+        return False
+
+
+class PageFields():
+    # Result of scan_home_page().  The attributes have the same values as
+    # the GitHubHomePage methods of the same names.
+    __slots__ = ['owner', 'name', 'is_problem', 'is_empty', 'description',
+                 'homepage', 'languages', 'forked_from', 'default_branch',
+                 'files', 'num_commits', 'num_branches', 'num_releases',
+                 'num_contributors', 'licenses']
+
+    def __init__(self, owner, name):
+        for attr in self.__slots__:
+            setattr(self, attr, None)
+        self.owner = owner
+        self.name  = name
+
+
+def scan_home_page(text, owner=None, name=None, wanted=None, markers=None):
+    '''Extracts all the fields of a GitHub home page in one pass over the
+    HTML 'text'.  'owner' and 'name' are the values to fall back on if the
+    page title can't be parsed.  If 'wanted' is given, only the fields it
+    names are extracted (plus the owner, name, is_problem and is_empty),
+    and the others are left as None.  'markers' is the result of
+    scan_markers() for the same text, if the caller already has it.
+    Returns a PageFields object.'''
+    def want(field):
+        return wanted == None or field in wanted
+
+    (first, langs) = markers or scan_markers(text)
+
+    def find(marker):
+        return first.get(marker, -1)
+
+    fields = PageFields(owner, name)
+
+    # Owner and name, from the title.
+    marker = _title_gh_dash
+    start = find(marker)
+    if start < 0:
+        marker = _title_marker
+        start = find(marker)
+    if start > 0:
+        endtitle = text.find(_endtitle_marker, start)
+        endpoint = text.find('/', start, endtitle)
+        if endpoint > 0:
+            fields.owner = text[start + len(marker) : endpoint].strip()
+    start = find(_title_gh_marker)
+    if start < 0:
+        start = find(_title_marker)
+    endtitle = find(_endtitle_marker)
+    start = text.find('/', start, endtitle)
+    if start > 0:
+        start += 1
+        endpoint = text.find(':', start, endtitle)
+        if endpoint > 0:
+            fields.name = text[start : endpoint]
+        else:
+            endpoint = text.find(' · GitHub', start, endtitle)
+            if endpoint >= 0:
+                fields.name = text[start : endpoint]
+            else:
+                fields.name = text[start : endtitle]
+    else:
+        raise PageParsingException('Cannot parse HTML repo name for {}/{}'.format(
+            fields.owner, fields.name), None)
+
+    fields.is_problem = find(_problem_marker) > 0
+    fields.is_empty = find(_empty_marker) > 0
+    if fields.is_problem:
+        return fields
+
+    start = find(_about_marker)
+    if not want('description'):
+        pass
+    elif start > 0:
+        endpoint = text.find('</span>', start)
+        fields.description = text[start + len(_about_marker) : endpoint].strip()
+    else:
+        fields.description = ''
+
+    start = find(_url_marker)
+    if not want('homepage'):
+        pass
+    elif start > 0:
+        endpoint = text.find('"', start + len(_url_marker))
+        fields.homepage = text[start + len(_url_marker) : endpoint].strip()
+    else:
+        fields.homepage = ''
+
+    if want('languages'):
+        fields.languages = []
+        endpoint = 0
+        for start in langs:
+            if start <= 0:
+                # languages() stops at a marker at the very start of the page.
+                break
+            if start < endpoint:
+                continue
+            endpoint = text.find('<', start)
+            fields.languages.append(text[start + len(_lang_marker) : endpoint])
+            if endpoint < 0:
+                break
+        if 'Other' in fields.languages:
+            fields.languages.remove('Other')
+
+    spanstart = find(_forkflag_marker)
+    if not want('forked_from'):
+        pass
+    elif spanstart > 0:
+        start = text.find(_forked_marker, spanstart)
+        if start > 0:
+            endpoint = text.find('"', start + len(_forked_marker))
+            fields.forked_from = text[start + len(_forked_marker) + 1 : endpoint]
+        else:
+            fields.forked_from = True
+    else:
+        fields.forked_from = False
+
+    # The files list needs the default branch.
+    endpoint = find(_atom_marker)
+    if (want('default_branch') or want('files')) and endpoint > 0:
+        start = text.rfind('commits/', 0, endpoint) + 8
+        fields.default_branch = html.unescape(text[start : endpoint])
+
+    if not want('files'):
+        pass
+    elif fields.is_empty:
+        fields.files = -1
+    else:
+        _scan_files(text, find(_filewrap_marker), fields)
+
+    summary = find(_summary_marker)
+    if not want('num_commits'):
+        pass
+    elif summary < 0:
+        fields.num_commits = 0
+    else:
+        fields.num_commits = _scan_number(text, summary, None)
+    if want('num_branches'):
+        fields.num_branches = _scan_summary(text, summary, '/branches')
+    if want('num_releases'):
+        fields.num_releases = _scan_summary(text, summary, '/releases')
+    if want('num_contributors'):
+        fields.num_contributors = _scan_summary(text, summary, '/contributors', True)
+
+    if want('licenses'):
+        fields.licenses = []
+    if want('licenses') and summary >= 0:
+        spanstart = text.find('octicon-law', summary)
+        if spanstart >= 0:
+            start = text.find(_svg_end_marker, spanstart)
+            if start > 0:
+                endpoint = text.find('</a>', start + len(_svg_end_marker))
+                licenses = text[start + len(_svg_end_marker) : endpoint].strip()
+                if len(licenses) > 0:
+                    fields.licenses = [licenses]
+    return fields
+
+
+def scan_markers(text):
+    '''Finds the markers that scan_home_page() goes by in a single sweep
+    over the HTML 'text'.  Returns a tuple (first, langs), where 'first' is
+    a dictionary of the position of the first of each marker, and 'langs' is
+    a list of the positions of all the language markers.'''
+    first = {}
+    langs = []
+    for m in _page_markers.finditer(text):
+        found = m.group()
+        if found == _lang_marker:
+            langs.append(m.start())
+        elif found.startswith(_title_marker):
+            first.setdefault(_title_marker, m.start())
+            if found.startswith(_title_gh_marker):
+                first.setdefault(_title_gh_marker, m.start())
+            if found == _title_gh_dash:
+                first.setdefault(_title_gh_dash, m.start())
+        elif found == 'file-wrap"':
+            first.setdefault(_filewrap_marker, m.start() - 1)
+        else:
+            first.setdefault(found, m.start())
+    return (first, langs)
+
+
+def _scan_files(text, start, fields):
+    # Same as GitHubHomePage.files(), but walking the page by position.
+    if start < 0:
+        return
+    nextstart = text.find('<table', start + len(_filewrap_marker))
+    base      = '/' + fields.owner + '/' + fields.name
+    filepat   = base + '/blob/'
+    dirpat    = base + '/tree/'
+    found_file = text.find(filepat, nextstart)
+    found_dir  = text.find(dirpat, nextstart)
+    if found_file < 0 and found_dir < 0:
+        fields.is_empty = True
+        fields.files = -1
+        return
+    nextstart   = min([v for v in [found_file, found_dir] if v > -1])
+    end         = text.find('</table', nextstart)
+    if end < 0:
+        # Same as slicing with an end of -1.
+        end = len(text) - 1
+    url_name    = html_encode(fields.default_branch)
+    filepat     = filepat + url_name + '/'
+    filepat_len = len(filepat)
+    dirpat      = dirpat + url_name + '/'
+    dirpat_len  = len(dirpat)
+    found_file  = text.find(filepat, nextstart, end)
+    found_dir   = text.find(dirpat, nextstart, end)
+    if found_file < 0 and found_dir < 0:
+        raise PageParsingException('Problem parsing files list for {}/{}'.format(
+            fields.owner, fields.name), None)
+    nextstart = min([v for v in [found_file, found_dir] if v > -1])
+    files = []
+    while nextstart >= 0:
+        endpoint = text.find('"', nextstart, end)
+        if endpoint < 0:
+            endpoint = end - 1
+        whole = text[nextstart : endpoint]
+        if whole.find(filepat) > -1:
+            files.append(whole[filepat_len :])
+        elif whole.find(dirpat) > -1:
+            path = whole[dirpat_len :]
+            if path.find('/') > 0:
+                # Submodule; treated like a directory, as in files().
+                files.append(path[path.rfind('/') + 1:] + '/')
+            else:
+                files.append(path + '/')
+        else:
+            files = None
+            break
+        # Only search again for a pattern whose last match we've passed.
+        if found_file >= 0 and found_file < endpoint:
+            found_file = text.find(filepat, endpoint, end)
+        if found_dir >= 0 and found_dir < endpoint:
+            found_dir = text.find(dirpat, endpoint, end)
+        if found_file < 0 and found_dir < 0:
+            break
+        nextstart = min([v for v in [found_file, found_dir] if v > -1])
+    fields.files = files
+
+
+def _scan_summary(text, summary, link, contributors=False):
+    # Same as GitHubHomePage.num_branches(), num_releases() and
+    # num_contributors(), given the position of the numbers summary.
+    if summary < 0:
+        return 0
+    spanstart = text.find(link, summary)
+    if spanstart < 0:
+        return 0
+    return _scan_number(text, spanstart, None, contributors)
+
+
+def _scan_number(text, spanstart, default, contributors=False):
+    start = text.find(_num_marker, spanstart)
+    if start <= 0:
+        return default
+    endpoint = text.find('</span>', start + len(_num_marker))
+    value = text[start + len(_num_marker) : endpoint]
+    if contributors and (len(value) == 0 or value.find('Fetching') > 0):
+        # See the FIXME in GitHubHomePage.num_contributors().
+        return None
+    return int(value.strip().replace(',', ''))
+
+
+
 
 # Utilities
 # .............................................................................
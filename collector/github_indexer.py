@@ -16,17 +16,16 @@ import operator
 import json
 import http
 import pprint
+import queue
 import urllib
 import github3
 import humanize
 import socket
-import langid
-import markdown
-import re
-import warnings
-from bs4 import BeautifulSoup
-from base64 import b64encode
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
 from datetime import datetime
+from itertools import islice
 from time import time, sleep
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
@@ -35,6 +34,13 @@ from casicsdb import *
 from utils import *
 from content_inferencer import *
 from github_html import *
+from coordination import *
+from github_net import *
+from github_graphql import *
+from write_buffer import *
+from read_ahead import *
+from readme_store import *
+from text_language import *
 
 
 # Summary
@@ -71,7 +77,54 @@ def msg_bad(thing):
     else:
         msg('*** Unrecognize type of thing: "{}" ***'.format(thing))
 
+
+def rate_limited(err):
+    # True if a github3 exception was caused by the account's rate limit
+    # running out, as opposed to some other reason for a 403.
+    response = getattr(err, 'response', None)
+    if response is None:
+        return False
+    return response.headers.get('X-RateLimit-Remaining') == '0'
+
 
+def have_languages(entry):
+    # True if the entry has languages, so that asking GitHub for them can be
+    # made conditional on their having changed.
+    return bool(entry['languages']) and entry['languages'] != -1
+
+
+def have_readme(entry):
+    # Same as have_languages(), for the README.
+    return (isinstance(entry['readme'], str) or is_compressed(entry['readme'])
+            or is_blob_ref(entry['readme']))
+
+
+def fork_value(fork, is_fork, fork_parent, fork_root):
+    # Returns the new value of an entry's fork field, given the current value
+    # 'fork' and what we just learned.  'fork' is not modified.
+    if fork == []:
+        # We previously didn't know if it's a fork or not.
+        return make_fork(fork_parent, fork_root) if is_fork else False
+    elif fork and not is_fork:
+        # We had it as a fork, but it's not.
+        return False
+    elif fork:
+        # It's a fork, and we had it as such. Maybe update our fields,
+        # but don't overwrite something that we may already have had
+        # gathered if the new value is None -- we may have gotten the
+        # existing value a different, possibly more thorough way.
+        fork = dict(fork)
+        if fork_parent:
+            fork['parent'] = fork_parent
+        if fork_root:
+            fork['root'] = fork_root
+        return fork
+    elif is_fork:
+        # We don't have it as a fork, but it is.
+        return make_fork(fork_parent, fork_root)
+    return fork
+
+
 # Error classes for internal communication.
 # .............................................................................
 
@@ -89,42 +142,116 @@ class UnexpectedResponseException(Exception):
         self.code = code
 
 
+# Markers for loop().
+# .............................................................................
+# An iterator given to GitHubIndexer.loop() can yield a WhenDone object in
+# place of an entry.  loop() calls its function once every entry yielded
+# before it (and after the previous marker) has been dealt with, which may
+# be some time later when there are several workers.  The function gets one
+# argument, which is False if any of those entries was not finished (for
+# example, because it was put off or the run is stopping).
+
+class WhenDone():
+    def __init__(self, function):
+        self.function = function
+
+
 # Main class.
 # .............................................................................
 
 class GitHubIndexer():
     _max_failures   = 10
     _max_retries    = 3
-
-    def __init__(self, github_login=None, github_password=None, github_db=None):
+    _http_pool_size = 8
+    _batch_size     = 1000
+    _offline_batch  = 10000
+    _text_batch     = 100
+    _max_deferrals  = 10
+    _max_deferred   = 1000
+    _refresh_chunk  = 1000
+    _window_size    = 100000
+
+    # The actions that refresh() runs on the entries it selects, in order.
+    # Getting the home page gets the files and languages too.
+    _refresh_actions      = ['create_entries', 'add_languages', 'add_files',
+                             'add_readmes']
+    _refresh_actions_http = ['create_entries', 'add_readmes']
+
+    # READMEs bigger than this are not worth keeping.
+    _max_readme_size = 5242880
+
+    # Waits between tries of a network request, and between the pauses that
+    # loop() takes when too many entries in a row have failed.
+    _retry          = RetryPolicy()
+    _failure_pause  = RetryPolicy(base_sec=60, max_sec=1200)
+
+    # The fields read by update_entry_from_github3() and
+    # update_entry_from_html().  Actions that may call either one need to
+    # ask the database for at least these fields.
+    _update_fields  = ['_id', 'owner', 'name', 'time', 'is_visible',
+                       'is_deleted', 'description', 'homepage',
+                       'default_branch', 'files', 'licenses', 'languages',
+                       'fork', 'num_commits', 'num_branches', 'num_releases',
+                       'num_contributors']
+
+    def __init__(self, github_login=None, github_password=None, github_db=None,
+                 accounts=None):
+        # 'accounts' is an optional list of (login, password) tuples for
+        # additional GitHub accounts whose API budgets can be used.
         self.db        = github_db.repos
         self._login    = github_login
         self._password = github_password
+        self._tokens   = TokenPool([(github_login, github_password)]
+                                   + (accounts or []))
+        self._etags    = ETagCache(github_db.etags)
+        self._connect_lock = threading.Lock()
+        self._http_pools   = {}
+        self._workers      = 1
+        self._pages    = {}
+        self._graphql  = {}
+        self.leases_db = github_db.leases
+        self._writes   = WriteBuffer(self.db)
+        self._readmes  = ReadmeStore(github_db.readmes)
+        self._unfinished = None
+        self.checkpoints_db = github_db.checkpoints
 
 
     def github(self):
-        '''Returns the github3.py connection object.  If no connection has
-        been established yet, it connects to GitHub first.'''
+        '''Returns a github3.py connection object for the GitHub account that
+        has the most API calls left.  If no connection has been established
+        yet for that account, it connects to GitHub first.'''
 
-        if hasattr(self, '_github') and self._github:
-            return self._github
+        token = self._tokens.choose()
+        with self._connect_lock:
+            if token.get('github'):
+                return token['github']
 
-        msg('Connecting to GitHub as user {}'.format(self._login))
-        try:
-            self._github = github3.login(self._login, self._password)
+            msg('Connecting to GitHub as user {}'.format(token['login']))
+            try:
+                self._github = github3.login(token['login'], token['password'])
+            except Exception as err:
+                msg(err)
+                text = 'Failed to log into GitHub'
+                raise SystemExit(text)
+
+            if not self._github:
+                msg('*** Unexpected failure in logging into GitHub')
+                raise SystemExit()
+
+            # Keep track of the rate limit using the headers of every
+            # response, instead of asking GitHub about it separately.
+            def track(response, *args, **kwargs):
+                self._tokens.update(token, response.headers)
+            self._github.session.hooks['response'].append(track)
+            token['github'] = self._github
             return self._github
-        except Exception as err:
-            msg(err)
-            text = 'Failed to log into GitHub'
-            raise SystemExit(text)
-
-        if not self._github:
-            msg('*** Unexpected failure in logging into GitHub')
-            raise SystemExit()
 
 
     def api_calls_left(self):
         '''Returns an integer.'''
+        if self._tokens.known():
+            return self._tokens.calls_left()
+
         # We call this more than once:
         def calls_left():
             rate_limit = self.github().rate_limit()
@@ -147,6 +274,8 @@ class GitHubIndexer():
 
     def api_reset_time(self):
         '''Returns a timestamp value, i.e., seconds since epoch.'''
+        if self._tokens.known():
+            return self._tokens.reset_time()
         try:
             rate_limit = self.github().rate_limit()
             return rate_limit['resources']['core']['reset']
@@ -164,13 +293,21 @@ class GitHubIndexer():
 
 
     def repo_via_api(self, owner, name):
+        (found, repo) = self.prefetched_repo(owner, name)
+        if found:
+            return (True, repo)
+        breaker = circuit_breaker('api.github.com')
         failures = 0
         retry = True
         while retry and failures < self._max_failures:
             # Don't retry unless the problem may be transient.
             retry = False
+            if not breaker.allow():
+                raise HostUnavailableException(breaker.host, breaker.until())
             try:
-                return (True, self.github().repository(owner, name))
+                repo = self.github().repository(owner, name)
+                breaker.success()
+                return (True, repo)
             except github3.GitHubError as err:
                 if err.code == 403:
                     # This can happen for rate limits, and also when there is
@@ -179,6 +316,10 @@ class GitHubIndexer():
                         self.wait_for_reset()
                         failures += 1
                         retry = True
+                    elif rate_limited(err):
+                        # This account ran out, but others have calls left.
+                        failures += 1
+                        retry = True
                     else:
                         msg('*** GitHb code 403 for {}/{}'.format(owner, name))
                         return (False, None)
@@ -188,44 +329,59 @@ class GitHubIndexer():
                     break
                 else:
                     msg('*** github3 generated an exception: {0}'.format(err))
-                    failures += 1
                     # Might be a network or other transient error. Try again.
-                    sleep(0.5)
+                    if not err.code or err.code >= 500:
+                        breaker.failure()
+                    self._retry.pause(failures)
+                    failures += 1
                     retry = True
             except Exception as err:
                 msg('*** Exception for {}/{}: {}'.format(owner, name, err))
                 # Something even more unexpected.
+                breaker.failure()
                 return (False, None)
         return (True, None)
 
 
-    def direct_api_call(self, url):
-        auth = '{0}:{1}'.format(self._login, self._password)
+    def direct_api_call(self, url, remember=False, conditional=False):
+        # If 'remember' is True, the ETag and Last-Modified values returned
+        # by GitHub are stored for the URL.  If 'conditional' is True, the
+        # stored values are also sent with the request; if GitHub says that
+        # nothing has changed, the return value is the status code 304.
+        token = self._tokens.choose()
         headers = {
             'User-Agent': self._login,
-            'Authorization': 'Basic ' + b64encode(bytes(auth, 'ascii')).decode('ascii'),
+            'Authorization': self._tokens.auth_header(token),
             'Accept': 'application/vnd.github.v3.raw',
         }
-        try:
-            conn = http.client.HTTPSConnection("api.github.com", timeout=15)
-        except:
-            # If we fail (maybe due to a timeout), try it one more time.
+        if conditional:
+            headers.update(self._etags.headers(url))
+        (host, path) = url_host_path(url)
+        for attempt in range(0, self._retry.tries):
             try:
-                sleep(1)
-                conn = http.client.HTTPSConnection("api.github.com", timeout=15)
-            except Exception:
+                response = self.pooled_request(host, 'GET', path, headers)
+            except HostUnavailableException:
+                raise
+            except Exception as err:
                 msg('*** Failed direct api call: {}'.format(err))
                 return None
-        conn.request("GET", url, {}, headers)
-        response = conn.getresponse()
-        # First check for 202, "accepted". Wait half a second and try again.
-        if response.status == 202:
-            sleep(0.5)                  # Arbitrary.
+            self._tokens.update(token, response.headers)
+            if response.status != 202:
+                break
+            # 202 = "accepted": GitHub is still working on it.  Try again.
             msg('*** Got code 202 for {} -- retrying'.format(url))
-            return self.direct_api_call(url)
-        # Note: next "if" must not be an "elif"!
-        if response.status == 200:
-            content = response.readall()
+            self._retry.pause(attempt)
+        if (response.status == 403 and response.getheader('X-RateLimit-Remaining') == '0'
+            and self._tokens.calls_left() > 0):
+            # This account ran out, but another one has calls left.
+            return self.direct_api_call(url, remember, conditional)
+        if response.status == 304:
+            # Not modified since we last got it.
+            return response.status
+        elif response.status == 200:
+            if remember or conditional:
+                self._etags.store(url, response.headers)
+            content = response.body
             try:
                 return content.decode('utf-8')
             except:
@@ -235,12 +391,54 @@ class GitHubIndexer():
                 return ''
         elif response.status == 301:
             # Redirection.  Start from the top with new URL.
-            return self.direct_api_call(response.getheader('Location'))
+            return self.direct_api_call(response.getheader('Location'),
+                                        remember, conditional)
         else:
             msg('*** Response status {} for {}'.format(response.status, url))
             return response.status
 
 
+    def pooled_request(self, host, method, path, headers=None, max_size=None):
+        '''Sends a request through the connection pool for the host.
+        Network errors and responses that say the server is in trouble are
+        retried after a backoff period, up to the number of tries set by
+        self._retry.  Raises HostUnavailableException if the host's circuit
+        breaker says it's out of action.  'max_size' is passed on to
+        ConnectionPool.request().'''
+        breaker = circuit_breaker(host)
+        for attempt in range(0, self._retry.tries):
+            if not breaker.allow():
+                raise HostUnavailableException(host, breaker.until())
+            try:
+                response = self.http_pool(host).request(method, path, headers,
+                                                        max_size=max_size)
+            except Exception:
+                breaker.failure()
+                if attempt + 1 >= self._retry.tries:
+                    raise
+                self._retry.pause(attempt)
+                continue
+            if server_trouble(response.status, response.headers):
+                wait = retry_after(response.headers)
+                breaker.failure(wait)
+                if attempt + 1 >= self._retry.tries:
+                    return response
+                self._retry.pause(attempt, wait)
+                continue
+            breaker.success()
+            return response
+
+
+    def http_pool(self, host):
+        '''Returns the ConnectionPool for the given host, shared by all the
+        threads of this indexer.'''
+        with self._connect_lock:
+            if host not in self._http_pools:
+                size = max(self._http_pool_size, self._workers)
+                self._http_pools[host] = ConnectionPool(host, size)
+            return self._http_pools[host]
+
+
     def github_url_path(self, entry, owner=None, name=None):
         if not owner:
             owner = entry['owner']
@@ -257,17 +455,12 @@ class GitHubIndexer():
         '''Returns the URL actually returned by GitHub, in case of redirects.'''
         url_path = self.github_url_path(entry, owner, name)
         try:
-            conn = http.client.HTTPSConnection('github.com', timeout=15)
-        except:
-            # If we fail (maybe due to a timeout), try it one more time.
-            try:
-                sleep(1)
-                conn = http.client.HTTPSConnection('github.com', timeout=15)
-            except Exception:
-                msg('*** Failed url check for {}: {}'.format(url_path, err))
-                return None
-        conn.request('HEAD', url_path)
-        resp = conn.getresponse()
+            resp = self.pooled_request('github.com', 'HEAD', url_path)
+        except HostUnavailableException:
+            raise
+        except Exception as err:
+            msg('*** Failed url check for {}: {}'.format(url_path, err))
+            return None
         if resp.status == 200:
             return url_path
         elif resp.status < 400:
@@ -307,6 +500,161 @@ class GitHubIndexer():
             return (None, None)
 
 
+    def home_page(self, entry, fields=None):
+        '''Returns a tuple (page, status) for the GitHub home page of the
+        repository 'entry', where 'page' is a GitHubHomePage object.  If the
+        page was fetched ahead of time by prefetching_pages(), that copy is
+        used; otherwise, the page is fetched now.  If 'fields' is given, a
+        page fetched now only has those fields extracted (see
+        GitHubHomePage).'''
+        prefetched = self._pages.pop(entry.get('_id'), None)
+        if prefetched:
+            (page, status) = prefetched
+            if isinstance(status, Exception):
+                raise status
+            return (page, status)
+        page = GitHubHomePage(fields)
+        status = page.get_html(entry['owner'], entry['name'])
+        return (page, status)
+
+
+    def prefetching_pages(self, iterator, batch_size):
+        # Wraps an entry iterator of the kind given to loop().  Entries are
+        # pulled from 'iterator' in batches of 'batch_size', their GitHub
+        # home pages are fetched concurrently by GitHubPageFetcher, and then
+        # the entries are handed on.  The pages for one batch are fetched
+        # while loop() works on the one before it.  Body functions pick up
+        # the pages by calling home_page().
+        fetcher = GitHubPageFetcher(batch_size)
+
+        def prefetch(batch):
+            wanted = [(id, owner, name) for (id, owner, name)
+                      in map(self.prefetch_names, batch) if id is not None]
+            msg('Fetching {} GitHub pages'.format(len(wanted)))
+            future = fetcher.submit([(owner, name) for (_, owner, name) in wanted])
+
+            def finish():
+                for (id, _, _), result in zip(wanted, future.result()):
+                    self._pages[id] = result
+                return [id for (id, _, _) in wanted]
+            return finish
+
+        return self.prefetching(iterator, batch_size, prefetch, self._pages,
+                                fetcher.close)
+
+
+    def prefetching_graphql(self, iterator):
+        # Like prefetching_pages(), but gets the repository data for each
+        # batch of entries with a single GraphQL query.  The results are used
+        # by repo_via_api(), get_languages(), get_readme() and add_licenses.
+        # If a query fails, those fall back to the REST API for that batch.
+        batcher = GraphQLBatcher(self._tokens, user_agent=self._login,
+                                 pool=self.http_pool('api.github.com'))
+
+        def prefetch(batch):
+            names = [(owner, name) for (id, owner, name)
+                     in map(self.prefetch_names, batch) if id is not None]
+            try:
+                self._graphql.update(batcher.query(names))
+            except Exception as err:
+                msg('*** GraphQL query failed -- using REST API: {}'.format(err))
+                return lambda: []
+            return lambda: names
+
+        return self.prefetching(iterator, batcher._max_batch, prefetch,
+                                self._graphql)
+
+
+    def prefetching_etags(self, iterator, url):
+        # Like prefetching_pages(), but reads the stored ETag validators for
+        # a batch of entries with one query, for the API calls that will be
+        # conditional.  'url' is a function that returns the URL of the call
+        # for an entry, or None if the call won't be conditional.
+        def prefetch(batch):
+            urls = [url(e) for e in batch if isinstance(e, dict)]
+            urls = [u for u in urls if u]
+            if urls:
+                self._etags.load(urls)
+            return lambda: urls
+
+        return self.prefetching(iterator, self._batch_size, prefetch,
+                                self._etags.loaded)
+
+
+    def prefetch_names(self, entry):
+        # Returns (id, owner, name) for an entry given to loop(), which may be
+        # one of our database entries or a github3 repository object.  The
+        # id is None if there is nothing to prefetch for it.
+        if isinstance(entry, dict):
+            if '_id' in entry and entry.get('owner') and entry.get('name'):
+                return (entry['_id'], entry['owner'], entry['name'])
+        elif hasattr(entry, 'full_name') and getattr(entry, 'id', None):
+            owner = getattr(entry, 'owner', None)
+            owner = getattr(owner, 'login', None) or entry.full_name.split('/')[0]
+            return (entry.id, owner, entry.name)
+        return (None, None, None)
+
+
+    def prefetching(self, iterator, batch_size, prefetch, cache, close=None):
+        # Common part of prefetching_pages() and prefetching_graphql().
+        # 'prefetch' is called on each batch of entries to start getting
+        # what's needed for them, and returns a function that waits for it,
+        # stores it in 'cache', and returns the list of keys it stored.  Each
+        # batch is started before the one before it is handed on, so that
+        # the two overlap.  'close' is called when the iterator is finished.
+        def prefetcher(targets, start_id=0):
+            keys = deque(maxlen=2)
+            started = None
+
+            def hand_on(batch, finish):
+                # By now, loop() has moved past the entries of two batches
+                # ago, so anything of theirs still in the cache belongs to
+                # entries that the body function skipped.
+                if len(keys) == keys.maxlen:
+                    for key in keys[0]:
+                        cache.pop(key, None)
+                keys.append(finish())
+                yield from batch
+
+            try:
+                batch = []
+                for entry in iterator(targets, start_id=start_id):
+                    batch.append(entry)
+                    if len(batch) < batch_size and not isinstance(entry, WhenDone):
+                        continue
+                    (previous, started) = (started, (batch, prefetch(batch)))
+                    if previous:
+                        yield from hand_on(*previous)
+                    if isinstance(entry, WhenDone):
+                        # The iterator may be waiting for the marker to be
+                        # acted on before it gives us anything more, so
+                        # pass it on now.
+                        yield from hand_on(*started)
+                        started = None
+                    batch = []
+                (previous, started) = (started, None)
+                if batch:
+                    started = (batch, prefetch(batch))
+                if previous:
+                    yield from hand_on(*previous)
+                if started:
+                    yield from hand_on(*started)
+            finally:
+                if close:
+                    close()
+        return prefetcher
+
+
+    def prefetched_repo(self, owner, name):
+        '''Returns a tuple (found, repo).  If 'found' is True, 'repo' is the
+        GraphQLRepo object obtained by prefetching_graphql(), or None if
+        GitHub did not return the repository.'''
+        key = (owner, name)
+        if key in self._graphql:
+            return (True, self._graphql[key])
+        return (False, None)
+
+
     def github_iterator(self, last_seen=None, start_id=None):
         try:
             if last_seen or start_id:
@@ -319,6 +667,172 @@ class GitHubIndexer():
             sys.exit(1)
 
 
+    def windowed_github_iterator(self, workers, size):
+        '''Returns an iterator like github_iterator(), except that the _id
+        space above the starting point is split into windows of 'size' ids
+        and 'workers' windows are paged through at the same time.'''
+        # Each window is a RangeLeases range; a pager thread claims one,
+        # pages from its start with "since" and stops at the first repo in
+        # the next window, so the windows meet with no gaps or overlaps.
+        # The last window has no end, since repos keep being created.  A
+        # window is marked done once loop() has added everything in it, and
+        # an interrupted run leaves unfinished windows behind, which the
+        # next run does first.
+        def windowed(last_seen, start_id=0):
+            since = max(last_seen or 0, start_id or 0)
+            job = 'create_entries windows {}'.format(size)
+            leases = RangeLeases(self.leases_db, job)
+            unfinished = self.leases_db.find_one({'job': job, 'done': False})
+            self.leases_db.delete_many({'job': job, 'done': True})
+            top = self.highest_repo_id(since, size)
+            leases.create(since + 1, max(top, since + 1), size)
+            # If there are windows left over from an interrupted run, there
+            # may be holes below 'since', so those windows are paged from
+            # their start.  Otherwise nothing is missing below 'since'.
+            floor = None if unfinished else since
+            msg('Paging through ids above {} in windows of {}'.format(since, size))
+
+            results = queue.Queue(maxsize=10 * workers)
+            stop = threading.Event()
+            released = set()
+            released_lock = threading.Lock()
+
+            def claim(mine):
+                # Windows released by the pagers of this run are not taken
+                # again by them.
+                with released_lock:
+                    skip = list(released)
+                return mine.claim(skip)
+
+            def put(item):
+                while not stop.is_set():
+                    try:
+                        results.put(item, timeout=1)
+                        return True
+                    except queue.Full:
+                        continue
+                return False
+
+            def pager(number):
+                owner = '{}:{}'.format(leases.owner, number)
+                mine = RangeLeases(self.leases_db, job, owner)
+                try:
+                    lease = claim(mine)
+                    while lease and not stop.is_set():
+                        first = lease['low'] - 1
+                        if floor != None:
+                            first = max(first, floor)
+                        end = lease['high'] if lease['high'] <= top else None
+                        if self.page_window(mine, lease, first, end, put):
+                            # Wait for the window to be marked done, or we'd
+                            # get it again from claim().
+                            window = {'lease': lease, 'ok': False,
+                                      'finished': threading.Event()}
+                            put((None, mine, window))
+                            while not stop.is_set() and not window['finished'].wait(1):
+                                pass
+                            ok = window['ok']
+                        else:
+                            ok = False
+                        if not ok and not stop.is_set():
+                            # Let another process have the window, and carry
+                            # on with the others.
+                            msg('*** Releasing window starting at {} for another process or a later run'.format(
+                                lease['low']))
+                            mine.release(lease)
+                            with released_lock:
+                                released.add(lease['_id'])
+                        lease = claim(mine)
+                finally:
+                    put((None, None, None))
+
+            pagers = [threading.Thread(target=pager, args=(n,), daemon=True)
+                      for n in range(0, workers)]
+            for thread in pagers:
+                thread.start()
+            try:
+                running = len(pagers)
+                while running:
+                    (repo, mine, window) = results.get()
+                    if repo:
+                        yield repo
+                    elif window:
+                        # Everything in the window has been handed out.
+                        # loop() calls window_done() once it's all added.
+                        yield WhenDone(lambda ok, mine=mine, window=window:
+                                       window_done(ok, mine, window))
+                    else:
+                        running -= 1
+            finally:
+                stop.set()
+
+        def window_done(ok, leases, window):
+            if ok:
+                self._writes.flush()
+                leases.finish(window['lease'])
+            window['ok'] = ok
+            window['finished'].set()
+
+        return windowed
+
+
+    def page_window(self, leases, lease, since, end, put):
+        # Pages through the repos with _id's above 'since' and below 'end'
+        # (or with no end if 'end' is None), passing each one to 'put' as a
+        # tuple (repo, None, None).  Returns True if it got to the end.
+        attempt = 0
+        renewed = time()
+        while True:
+            try:
+                for repo in self.github().iter_all_repos(since=since):
+                    if end != None and repo.id >= end:
+                        return True
+                    if not put((repo, None, None)):
+                        return False
+                    since = repo.id
+                    attempt = 0
+                    if time() - renewed > leases._lease_sec / 3:
+                        if not leases.renew(lease):
+                            msg('*** Lost the lease on window starting at {}'.format(
+                                lease['low']))
+                            return False
+                        renewed = time()
+                return True
+            except Exception as err:
+                if isinstance(err, github3.GitHubError) and err.code == 403 \
+                   and self.api_calls_left() < 1:
+                    self.wait_for_reset()
+                    continue
+                attempt += 1
+                if attempt >= self._retry.tries:
+                    msg('*** Giving up on window starting at {} after {}: {}'.format(
+                        lease['low'], since, err))
+                    return False
+                msg('*** Paging after {} failed -- retrying: {}'.format(since, err))
+                self._retry.pause(attempt)
+
+
+    def highest_repo_id(self, since, precision):
+        # Returns an _id value that has no repos above it, but within
+        # 'precision' of one that does.  Each probe costs one API call.
+        def repos_above(id):
+            return any(True for _ in self.github().iter_all_repos(number=1, since=id))
+        if not repos_above(since):
+            return since
+        (low, step) = (since, precision)
+        while repos_above(low + step):
+            low += step
+            step *= 2
+        high = low + step
+        while high - low > precision:
+            middle = (low + high) // 2
+            if repos_above(middle):
+                low = middle
+            else:
+                high = middle
+        return high
+
+
     def last_seen_id(self):
         last = self.db.find_one({'$query':{}, '$orderby':{'_id':-1}}, {})
         return last['_id']
@@ -458,7 +972,7 @@ class GitHubIndexer():
             msg('updated time info for {}'.format(summary))
 
         if updates:
-            self.db.update({'_id': entry['_id']}, {'$set': updates}, upsert=False)
+            self._writes.update(entry['_id'], updates)
         else:
             msg('{} has no changes'.format(summary))
         return entry
@@ -526,43 +1040,44 @@ class GitHubIndexer():
             msg('{} num_contributors set to {}'.format(summary, page.num_contributors()))
             updates['num_contributors'] = entry['num_contributors'] = page.num_contributors()
 
-        if updates:
-            updates['time.data_refreshed'] = now_timestamp()
-            entry['time']['data_refreshed'] = updates['time.data_refreshed']
-            self.db.update({'_id': entry['_id']},
-                           {'$set': updates},
-                           upsert=False)
-        # Fork field is too complicated, and handled separately.
+        # The fork field is too complicated to compare directly.  The page
+        # never tells us the root, so we can at most update the parent.
+        fork = page.forked_from()
+        parent = fork if fork not in [True, False] else None
+        changed = False
         if entry['fork'] == []:
             # We didn't know either way.
-            # Don't know the root when we're getting the data from this source.
-            # So, we can only update the parent.
-            msg('updated fork info for {}'.format(summary))
-            is_fork = page.forked_from() != False
-            parent = page.forked_from() if page.forked_from() != True else None
-            self.update_entry_fork_field(entry, is_fork, parent, None)
-        elif not entry['fork'] and page.forked_from():
+            changed = True
+        elif not entry['fork'] and fork:
             # We had it as not-a-fork, but it is.
-            # Don't know the root when we're getting the data from this source.
-            # So, we can only update the parent.
-            msg('updated fork info for {}'.format(summary))
-            parent = page.forked_from() if page.forked_from() != True else None
-            self.update_entry_fork_field(entry, True, parent, None)
-        elif entry['fork'] and page.forked_from() == False:
-            # We had it as a fork, or didn't know, but apparently it's not.
-            msg('updated fork info for {}'.format(summary))
-            self.update_entry_fork_field(entry, False, None, None)
-        elif entry['fork'] and page.forked_from() != entry['fork']['parent']:
+            changed = True
+        elif entry['fork'] and fork == False:
+            # We had it as a fork, but apparently it's not.
+            changed = True
+        elif entry['fork'] and fork != entry['fork']['parent']:
             # We have it as a fork, it is a fork, and we have parent info.
+            changed = True
+        if changed:
             msg('updated fork info for {}'.format(summary))
-            self.update_entry_fork_field(entry, True, page.forked_from(), None)
-        elif not updates:
-            # This last case is weird but the logic is that if we get here, we
-            # have no updates to fork or anything else.
+            updates['fork'] = entry['fork'] = fork_value(entry['fork'],
+                                                         fork != False,
+                                                         parent, None)
+
+        if updates:
+            updates['time.data_refreshed'] = now_timestamp()
+            entry['time']['data_refreshed'] = updates['time.data_refreshed']
+            self._writes.update(entry['_id'], updates)
+        else:
             msg('{} has no changes'.format(summary))
         return entry
 
 
+    def flush_updates(self):
+        '''Writes any entry updates still waiting in the write buffer.'''
+        self._writes.flush()
+        self._etags.flush()
+
+
     def update_entry_field(self, entry, field, value, append=False):
         # If 'append' == True, the field is assumed to be a set of values, and
         # the 'value' is added if it's not already there.
@@ -572,41 +1087,59 @@ class GitHubIndexer():
                 return
             else:
                 entry[field].append(value)
-                self.db.update({'_id': entry['_id']},
-                               {'$addToSet': {field: value},
-                                '$set':      {'time.data_refreshed': now}})
+                self._writes.update(entry['_id'],
+                                    {'time.data_refreshed': now},
+                                    {field: value})
         else:
             entry[field] = value
-            self.db.update({'_id': entry['_id']},
-                           {'$set': {field: value,
-                                     'time.data_refreshed': now}})
+            self._writes.update(entry['_id'],
+                                {field: value, 'time.data_refreshed': now})
         # Update this so that the object being held by the caller reflects
         # what was written to the database.
         entry['time']['data_refreshed'] = now
 
 
     def update_entry_fork_field(self, entry, is_fork, fork_parent, fork_root):
-        if entry['fork'] == []:
-            # We previously didn't know if it's a fork or not.
-            entry['fork'] = make_fork(fork_parent, fork_root) if is_fork else False
-        elif entry['fork'] and not is_fork:
-            # We had it as a fork, but it's not.
-            entry['fork'] = False
-        elif entry['fork']:
-            # It's a fork, and we had it as such. Maybe update our fields,
-            # but don't overwrite something that we may already have had
-            # gathered if the new value is None -- we may have gotten the
-            # existing value a different, possibly more thorough way.
-            if fork_parent:
-                entry['fork']['parent'] = fork_parent
-            if fork_root:
-                entry['fork']['root'] = fork_root
-        elif is_fork:
-            # We don't have it as a fork, but it is.
-            entry['fork'] = make_fork(fork_parent, fork_root)
+        entry['fork'] = fork_value(entry['fork'], is_fork, fork_parent, fork_root)
         self.update_entry_field(entry, 'fork', entry['fork'])
 
 
+    def inherit_from_parent(self, entry, fields):
+        '''If 'entry' is a fork that has not been pushed to since it was
+        created, its contents are the same as those of the repo it was
+        forked from (as of then), so we copy the values of 'fields' from
+        the parent's entry instead of asking GitHub.  Only fields for which
+        the parent has a value are copied.  Returns the list of fields
+        copied, which is empty if the entry isn't such a fork or the parent
+        isn't in our database.'''
+        fork = entry.get('fork')
+        if not fork or not fork.get('parent') or '/' not in fork['parent']:
+            return []
+        created = entry['time'].get('repo_created')
+        pushed = entry['time'].get('repo_pushed')
+        if not created or not pushed or pushed > created:
+            return []
+        (owner, name) = fork['parent'].split('/', 1)
+        parent = self.db.find_one({'owner': owner, 'name': name},
+                                  {f: 1 for f in fields})
+        if not parent:
+            return []
+        # None and [] are what new entries have for fields we haven't
+        # gathered yet.
+        copied = [f for f in fields if parent.get(f) not in [None, []]]
+        if not copied:
+            return []
+        now = now_timestamp()
+        updates = {f: parent[f] for f in copied}
+        entry.update(updates)
+        updates['time.data_refreshed'] = now
+        entry['time']['data_refreshed'] = now
+        self._writes.update(entry['_id'], updates)
+        msg('{} inherited {} from {}'.format(e_summary(entry), ', '.join(copied),
+                                             fork['parent']))
+        return copied
+
+
     def update_entry_moved(self, entry, owner, name):
         (success, repo) = self.repo_via_api(owner, name)
         if not success:
@@ -629,70 +1162,442 @@ class GitHubIndexer():
         self.update_entry_field(entry, 'is_visible', False)
 
 
-    def loop(self, iterator, body_function, selector, targets=None, start_id=0):
+    def loop(self, iterator, body_function, selector, targets=None, start_id=0,
+             workers=1, shard_size=0, batch_size=0, resume=False, **kwargs):
+        # If 'workers' > 1, body_function is run on that many entries at a
+        # time using a pool of threads.  The bookkeeping for consecutive
+        # failures and for rate-limit pauses is shared by all the threads.
+        # If 'shard_size' > 0, the entries matched by 'selector' are split
+        # into _id ranges of that size, shared with other collector processes
+        # running the same action.  If 'batch_size' > 0, it sets the number
+        # of entries that entry_list() reads from the database at a time.
+        # Unless sharding, runs over a selector save checkpoints as they go,
+        # and if 'resume' is True, carry on from the last saved checkpoint.
         msg('Initial GitHub API calls remaining: ', self.api_calls_left())
+        if batch_size > 0:
+            self._batch_size = batch_size
+        checkpoint = None
+        if not targets and isinstance(selector, dict):
+            job = self.loop_job_name(body_function, selector)
+            if shard_size > 0:
+                msg('Sharing _id ranges of size {} for {}'.format(shard_size, job))
+                iterator = self.sharding(iterator, job, shard_size)
+            else:
+                checkpoint = Checkpoint(self.checkpoints_db, job)
+                if resume:
+                    iterator = self.resuming(iterator, checkpoint)
+        elif resume:
+            msg('*** Cannot resume when given explicit targets -- ignoring')
+
+        def run(entry):
+            id = entry.get('_id') if isinstance(entry, dict) else None
+            done = self.loop_entry(entry, body_function)
+            if done and checkpoint and id != None:
+                checkpoint.finished(id)
+            return done
+
+        def dispatch(entry, group=None):
+            if group:
+                with group_lock:
+                    group['pending'] += 1
+            if workers > 1:
+                slots.acquire()
+                future = pool.submit(run, entry)
+                futures.add(future)
+                future.add_done_callback(lambda future: release(future, group))
+            else:
+                entry_done(group, run(entry))
+
+        def release(future, group):
+            futures.discard(future)
+            slots.release()
+            entry_done(group, not future.exception() and future.result())
+
+        # Entries from the iterator are counted in groups ended by WhenDone
+        # markers.  Entries that were put off are tried again outside any
+        # group, and their groups count them as not finished.
+        def entry_done(group, done):
+            if group:
+                with group_lock:
+                    group['pending'] -= 1
+                    group['ok'] = group['ok'] and done
+                call_marker(group)
+
+        def end_group(marker):
+            group['marker'] = marker
+            call_marker(group)
+            return {'pending': 0, 'ok': True, 'marker': None}
+
+        def call_marker(group):
+            with group_lock:
+                ready = group['marker'] and group['pending'] == 0
+                marker = group['marker'] if ready else None
+                if ready:
+                    group['marker'] = None
+            if marker:
+                try:
+                    marker.function(group['ok'])
+                except Exception as err:
+                    msg('*** Exception finishing a group of entries: {}'.format(err))
+
+        self._failures   = 0
+        self._stopping   = False
+        self._loop_lock  = threading.Lock()
+        self._pause_lock = threading.Lock()
+        self._running    = threading.Event()
+        self._running.set()
+        self._deferred   = []
+        self._deferrals  = {}
+        futures = set()
+        group_lock = threading.Lock()
+        group = {'pending': 0, 'ok': True, 'marker': None}
         count = 0
-        failures = 0
-        retries = 0
         start = time()
-        # By default, only consider those entries without language info.
-        for entry in iterator(targets or selector, start_id=start_id):
-            retry = True
-            while retry and failures < self._max_failures:
-                # Don't retry unless the problem may be transient.
-                retry = False
-                try:
-                    body_function(entry)
-                    failures = 0
-                except StopIteration:
-                    msg('Iterator reports it is done')
+        self._failure_pauses = 0
+        self._workers = workers
+        if workers > 1:
+            msg('Using {} concurrent workers'.format(workers))
+            pool = ThreadPoolExecutor(max_workers=workers)
+            # Bound the number of queued entries, so that we don't pull the
+            # whole iterator into memory ahead of the workers.
+            slots = threading.BoundedSemaphore(2 * workers)
+        completed = False
+        try:
+            for entry in iterator(targets or selector, start_id=start_id):
+                if isinstance(entry, WhenDone):
+                    group = end_group(entry)
+                    continue
+                if checkpoint and isinstance(entry, dict):
+                    checkpoint.started(entry['_id'])
+                dispatch(entry, group)
+                # Entries put off because a host was unavailable are tried
+                # again once its circuit breaker lets requests through.  If
+                # too many pile up, everything needs that host, so wait.
+                wait = len(self._deferred) >= self._max_deferred
+                for deferred in self.deferred_entries(wait):
+                    dispatch(deferred)
+                if self._stopping:
                     break
-                except (github3.GitHubError, DirectAPIException) as err:
-                    if err.code == 403:
-                        if self.api_calls_left() < 1:
-                            msg('*** GitHub API rate limit exceeded')
-                            self.wait_for_reset()
-                            retry = True
-                        else:
-                            # Occasionally get 403 even when not over the limit.
-                            msg('*** GitHub code 403 for {}'.format(e_summary(entry)))
-                            self.mark_entry_invisible(entry)
-                            failures += 1
-                    elif err.code == 451:
-                        msg('*** GitHub code 451 (blocked) for {}'.format(e_summary(entry)))
-                        self.mark_entry_invisible(entry)
-                    else:
-                        msg('*** GitHub API exception: {0}'.format(err))
-                        failures += 1
-                        # Might be a network or other transient error.
-                        retry = True
-                except Exception as err:
-                    msg('*** Exception for {} -- skipping it -- {}'.format(
-                        e_summary(entry), err))
-                    # Something unexpected.  Don't retry this entry, but count
-                    # this failure in case we're up against a roadblock.
-                    failures += 1
+                if checkpoint and checkpoint.due():
+                    self.save_checkpoint(checkpoint)
 
-            if failures >= self._max_failures:
-                # Try pause & continue, in case of transient network issues.
-                if retries <= self._max_retries:
-                    retries += 1
-                    msg('*** Pausing because of too many consecutive failures')
-                    sleep(300 * retries)
-                    failures = 0
-                else:
-                    # We've already paused & restarted once.
-                    msg('*** Stopping because of too many consecutive failures')
+                if self._failures >= self._max_failures:
+                    # Try pause & continue, in case of transient network issues.
+                    self.pause_for_failures()
+                    if self._stopping:
+                        break
+                count += 1
+                if count % 100 == 0:
+                    msg('{} [{:2f}]'.format(count, time() - start))
+                    start = time()
+            # Finish off whatever is still waiting for a host to come back.
+            while not self._stopping:
+                if futures:
+                    wait_futures(list(futures))
+                deferred = self.deferred_entries(wait=True)
+                if not deferred:
                     break
-            count += 1
-            if count % 100 == 0:
-                msg('{} [{:2f}]'.format(count, time() - start))
-                start = time()
+                for entry in deferred:
+                    dispatch(entry)
+            completed = not self._stopping
+        finally:
+            if workers > 1:
+                pool.shutdown(wait=True)
+            # Whatever was prefetched and not used is of no more use, now
+            # that every entry has been dealt with.
+            self._pages.clear()
+            self._graphql.clear()
+            self._etags.loaded.clear()
+            if checkpoint:
+                done = completed and not checkpoint.pending()
+                self.save_checkpoint(checkpoint, done)
+            else:
+                self._writes.flush()
+            self._etags.flush()
 
         msg('')
         msg('Done.')
 
 
+    def loop_entry(self, entry, body_function):
+        # Runs body_function on one entry for loop(), retrying if the problem
+        # may be transient.  This may be called from several threads at once.
+        # Returns False if we gave up on the entry before it was dealt with.
+        retry = True
+        done = False
+        failed = False
+        while retry:
+            # Don't retry unless the problem may be transient.
+            retry = False
+            # Wait out a pause for too many failures, rather than dropping
+            # the entry, and block here if another thread has paused the loop.
+            if self._failures >= self._max_failures:
+                self.pause_for_failures()
+            self._running.wait()
+            if self._stopping:
+                self.note_unfinished(entry, True)
+                return False
+            try:
+                body_function(entry)
+                with self._loop_lock:
+                    self._failures = 0
+            except StopIteration:
+                msg('Iterator reports it is done')
+            except HostUnavailableException as err:
+                # Not this entry's fault.  Try it again later.
+                self.defer_entry(entry, err)
+                self.note_unfinished(entry, True)
+                return False
+            except (github3.GitHubError, DirectAPIException) as err:
+                if err.code == 403:
+                    if self.api_calls_left() < 1:
+                        self.pause_for_reset()
+                        retry = True
+                    elif rate_limited(err):
+                        # This account ran out, but others have calls left.
+                        retry = True
+                    else:
+                        # Occasionally get 403 even when not over the limit.
+                        msg('*** GitHub code 403 for {}'.format(e_summary(entry)))
+                        self.mark_entry_invisible(entry)
+                        with self._loop_lock:
+                            self._failures += 1
+                elif err.code == 451:
+                    msg('*** GitHub code 451 (blocked) for {}'.format(e_summary(entry)))
+                    self.mark_entry_invisible(entry)
+                else:
+                    msg('*** GitHub API exception: {0}'.format(err))
+                    with self._loop_lock:
+                        self._failures += 1
+                    # Might be a network or other transient error.
+                    retry = True
+            except Exception as err:
+                msg('*** Exception for {} -- skipping it -- {}'.format(
+                    e_summary(entry), err))
+                # Something unexpected.  Don't retry this entry, but count
+                # this failure in case we're up against a roadblock.
+                with self._loop_lock:
+                    self._failures += 1
+                failed = True
+            done = not retry
+        self.note_unfinished(entry, failed)
+        return done
+
+
+    def note_unfinished(self, entry, unfinished):
+        # If self._unfinished is a set, it collects the _id's of entries that
+        # loop_entry() couldn't deal with, for refresh().  An entry that was
+        # put off and later dealt with is taken out again.
+        if self._unfinished is None:
+            return
+        id = entry.get('_id') if isinstance(entry, dict) else getattr(entry, 'id', None)
+        with self._loop_lock:
+            if unfinished:
+                self._unfinished.add(id)
+            else:
+                self._unfinished.discard(id)
+
+
+    def defer_entry(self, entry, err):
+        # Called by loop_entry() when an entry needs a host that is out of
+        # action, so that loop() can try the entry again later.
+        key = entry.get('_id') if isinstance(entry, dict) else id(entry)
+        with self._loop_lock:
+            count = self._deferrals.get(key, 0) + 1
+            self._deferrals[key] = count
+            if count <= self._max_deferrals:
+                self._deferred.append((err.until, entry))
+        if count <= self._max_deferrals:
+            msg('*** {} unavailable -- putting off {}'.format(err.host, e_summary(entry)))
+        else:
+            msg('*** {} still unavailable -- giving up on {}'.format(
+                err.host, e_summary(entry)))
+
+
+    def deferred_entries(self, wait=False):
+        # Returns the entries put off by defer_entry() that can be tried
+        # again now.  If 'wait' is True and there are deferred entries but
+        # none are ready, waits until the earliest one is.
+        with self._loop_lock:
+            if not self._deferred:
+                return []
+            earliest = min(until for (until, _) in self._deferred)
+        if wait and earliest > time():
+            msg('Waiting {:.0f}s for unavailable hosts'.format(earliest - time()))
+            sleep(earliest - time())
+        now = time()
+        with self._loop_lock:
+            ready = [entry for (until, entry) in self._deferred if until <= now]
+            self._deferred = [(until, entry) for (until, entry) in self._deferred
+                              if until > now]
+        return ready
+
+
+    def save_checkpoint(self, checkpoint, done=False):
+        # The snapshot has to be taken before flushing the write buffer, so
+        # that the entries it counts as finished have all been written.
+        state = checkpoint.state()
+        self._writes.flush()
+        checkpoint.save(state, done)
+
+
+    def resuming(self, iterator, checkpoint):
+        # Wraps an entry iterator of the kind given to loop(), so that it
+        # first returns the entries that were in progress when the last run
+        # stopped, then continues after the highest _id that was finished.
+        def resumed(selector, start_id=0):
+            saved = checkpoint.load()
+            if not saved or saved['done'] or saved['last_id'] == None:
+                msg('No checkpoint to resume from -- starting from the beginning')
+                yield from iterator(selector, start_id=start_id)
+                return
+            if saved['in_flight']:
+                msg('Resuming {} entries left in progress'.format(len(saved['in_flight'])))
+                query = dict(selector)
+                query['_id'] = {'$in': saved['in_flight']}
+                seen = set()
+                for entry in iterator(query, start_id=0):
+                    seen.add(entry['_id'])
+                    yield entry
+                # The rest no longer match the selector, so they were done.
+                checkpoint.forget(set(saved['in_flight']) - seen)
+            msg('Resuming after _id {}'.format(saved['last_id']))
+            query = dict(selector)
+            query['_id'] = dict(query.get('_id', {}), **{'$gt': saved['last_id']})
+            yield from iterator(query, start_id=start_id)
+        return resumed
+
+
+    def loop_job_name(self, body_function, selector):
+        # Identifies an action and its selection criteria, so that separate
+        # processes can tell whether they are doing the same job.  The body
+        # functions are all defined inside the action methods, so the name
+        # of the action can be recovered from the body function's name.
+        # The lower bound on _id set by start_id is left out, so that a run
+        # that picks up from a later _id is still the same job, and values
+        # that JSON can't represent (such as datetimes) are turned into text.
+        action = body_function.__qualname__.split('.<locals>')[0]
+        action = action.split('.')[-1]
+        criteria = dict(selector)
+        bounds = criteria.get('_id')
+        if isinstance(bounds, dict) and list(bounds) == ['$gte']:
+            del criteria['_id']
+        return action + ' ' + json.dumps(criteria, default=str, sort_keys=True)
+
+
+    def sharding(self, iterator, job, shard_size):
+        # Wraps an entry iterator of the kind given to loop(), so that it only
+        # returns entries from _id ranges leased by this process.
+        def sharded(selector, start_id=0):
+            (low, high) = self.id_bounds(selector)
+            if low == None:
+                return
+            leases = RangeLeases(self.leases_db, job)
+            leases.create(low, high, shard_size)
+            released = set()
+            lease = leases.claim()
+            while lease:
+                msg('Claimed _id range {}-{}'.format(lease['low'], lease['high'] - 1))
+                query = dict(selector)
+                query['_id'] = {'$gte': max(lease['low'], start_id),
+                                '$lt': lease['high']}
+                renewed = time()
+                lost = False
+                for entry in iterator(query, start_id=0):
+                    if time() - renewed > leases._lease_sec / 3:
+                        if not leases.renew(lease):
+                            msg('*** Lost the lease on _id range starting at {}'.format(
+                                lease['low']))
+                            lost = True
+                            break
+                        renewed = time()
+                    yield entry
+                if not lost:
+                    # Wait until the workers have dealt with the range's
+                    # entries.  Otherwise claim() would give it back to us.
+                    finished = threading.Event()
+                    outcome = {}
+                    yield WhenDone(lambda ok, lease=lease:
+                                   range_done(ok, leases, lease, finished, outcome))
+                    finished.wait()
+                    if not outcome['ok']:
+                        # Some entries were put off or not finished.  Let
+                        # another process have the range, and carry on with
+                        # the others ourselves.
+                        msg('*** Releasing _id range {}-{} for another process or a later run'.format(
+                            lease['low'], lease['high'] - 1))
+                        leases.release(lease)
+                        released.add(lease['_id'])
+                lease = leases.claim(released)
+            msg('No more _id ranges to claim')
+
+        def range_done(ok, leases, lease, finished, outcome):
+            if ok:
+                # Don't mark the range done while its updates may still be
+                # sitting in the write buffer.
+                self._writes.flush()
+                leases.finish(lease)
+            outcome['ok'] = ok
+            finished.set()
+
+        return sharded
+
+
+    def id_bounds(self, selector):
+        # Returns the lowest and highest _id values of entries matching the
+        # selector, as a tuple.  The values are None if nothing matches.
+        first = list(self.db.find(selector, {'_id': 1}).sort('_id', 1).limit(1))
+        if not first:
+            return (None, None)
+        last = list(self.db.find(selector, {'_id': 1}).sort('_id', -1).limit(1))
+        return (first[0]['_id'], last[0]['_id'])
+
+
+    def pause_for_reset(self):
+        # When running with several workers, more than one of them may hit the
+        # rate limit at about the same time.  Only the first one waits for the
+        # reset; the others block until it's done and then carry on.
+        with self._pause_lock:
+            waiter = self._running.is_set()
+            if waiter:
+                self._running.clear()
+        if waiter:
+            msg('*** GitHub API rate limit exceeded')
+            self._writes.flush()
+            try:
+                self.wait_for_reset()
+            finally:
+                self._running.set()
+        else:
+            self._running.wait()
+
+
+    def pause_for_failures(self):
+        # Called by loop() and loop_entry() when too many entries in a row
+        # have failed.  As in pause_for_reset(), the first thread to get here
+        # does the pausing, and the others wait for it.  After pausing
+        # _max_retries times without getting anywhere, we stop instead.
+        with self._pause_lock:
+            waiter = (self._running.is_set()
+                      and self._failures >= self._max_failures)
+            if waiter:
+                self._running.clear()
+        if waiter:
+            try:
+                if self._failure_pauses <= self._max_retries:
+                    self._failure_pauses += 1
+                    msg('*** Pausing because of too many consecutive failures')
+                    sleep(self._failure_pause.delay(self._failure_pauses))
+                else:
+                    msg('*** Stopping because of too many consecutive failures')
+                    self._stopping = True
+                self._failures = 0
+            finally:
+                self._running.set()
+        else:
+            self._running.wait()
+
+
     def ensure_id(self, item):
         # This may return a list of id's, in the case where an item is given
         # as an owner/name string and there are multiple entries for it in
@@ -737,8 +1642,10 @@ class GitHubIndexer():
         return None
 
 
-    def entry_list(self, targets=None, fields=None, start_id=0):
-        # Returns a list of mongodb entries.
+    def entry_list(self, targets=None, fields=None, start_id=0, batch_size=None):
+        # Returns an iterator over mongodb entries.  The entries are read
+        # from the database 'batch_size' at a time, in the background.
+        batch_size = batch_size or self._batch_size
         if fields:
             # Restructure the list of fields into the format expected by mongo.
             fields = {x:1 for x in fields}
@@ -748,24 +1655,27 @@ class GitHubIndexer():
                 fields['_id'] = 0
         if isinstance(targets, dict):
             # Caller provided a query string, so use it directly.
-            return self.db.find(targets, fields, no_cursor_timeout=True)
+            cursor = self.db.find(targets, fields, no_cursor_timeout=True)
         elif isinstance(targets, list):
             # Caller provided a list of id's or repo names.
             ids = list(flatten(self.ensure_id(x) for x in targets))
             if start_id > 0:
                 ids = [id for id in ids if id >= start_id]
-            return self.db.find({'_id': {'$in': ids}}, fields,
-                                no_cursor_timeout=True)
+            cursor = self.db.find({'_id': {'$in': ids}}, fields,
+                                  no_cursor_timeout=True)
         elif isinstance(targets, int):
             # Single target, assumed to be a repo identifier.
-            return self.db.find({'_id' : targets}, fields,
-                                no_cursor_timeout=True)
+            cursor = self.db.find({'_id' : targets}, fields,
+                                  no_cursor_timeout=True)
         else:
             # Empty targets; match against all entries greater than start_id.
             query = {}
             if start_id > 0:
                 query['_id'] = {'$gte': start_id}
-            return self.db.find(query, fields, no_cursor_timeout=True)
+            cursor = self.db.find(query, fields, no_cursor_timeout=True)
+        # Going in _id order lets a checkpoint say how far we got.
+        cursor = cursor.sort('_id', 1)
+        return ReadAheadCursor(cursor, batch_size)
 
 
     def repo_list(self, targets=None, prefer_http=False, start_id=0):
@@ -1081,7 +1991,7 @@ class GitHubIndexer():
             msg('EXTERNAL HOMEPAGE:'.ljust(width), entry['homepage'])
             if entry['readme'] and entry['readme'] != -1:
                 msg('README:')
-                msg(entry['readme'])
+                msg(self._readmes.text(entry['readme']))
         msg('='*70)
 
 
@@ -1107,13 +2017,19 @@ class GitHubIndexer():
         msg('-'*79)
 
 
-    def get_languages(self, entry):
+    def get_languages(self, entry, conditional=False):
         # Using github3.py would cause 2 API calls per repo to get this info.
-        # Here we do direct access to bring it to 1 api call.
-        url = 'https://api.github.com/repos/{}/{}/languages'.format(entry['owner'],
-                                                                    entry['name'])
-        response = self.direct_api_call(url)
-        if isinstance(response, int) and response >= 400:
+        # Here we do direct access to bring it to 1 api call.  If
+        # 'conditional' is True and the languages have not changed since we
+        # last got them, this returns 304.
+        (found, repo) = self.prefetched_repo(entry['owner'], entry['name'])
+        if found:
+            return repo.languages if repo else -1
+        url = self.languages_url(entry)
+        response = self.direct_api_call(url, remember=True, conditional=conditional)
+        if response == 304:
+            return response
+        elif isinstance(response, int) and response >= 400:
             return -1
         elif response == None:
             return -1
@@ -1124,18 +2040,24 @@ class GitHubIndexer():
     def get_readme(self, entry, prefer_http=False, api_only=False):
 
         def get_raw(url):
-            r = timed_get(url, verify=False)
-            if not r:
+            (host, path) = url_host_path(url)
+            try:
+                r = self.pooled_request(host, 'GET', path,
+                                        max_size=self._max_readme_size)
+            except HostUnavailableException:
+                raise
+            except Exception:
                 # 408 is a standard http code for a time out.  May as well use
                 # that here, as we need to return a number.
                 return (408, None)
-            code = r.status_code
+            code = r.status
             if code in [200, 203, 206]:
-                # Got it, but watch out for bad files.  Threshold at 5 MB.
-                if int(r.headers['content-length']) > 5242880:
+                # Got it, but watch out for bad files.  The download stops
+                # as soon as the file turns out to be too big.
+                if r.truncated:
                     return (code, -2)
                 else:
-                    return (code, r.text)
+                    return (code, r.text())
             elif code in [404, 451]:
                 # 404 = doesn't exist.  451 = unavailable for legal reasons.
                 return (code, -1)
@@ -1167,16 +2089,13 @@ class GitHubIndexer():
             branch = entry['default_branch'] if entry['default_branch'] else 'master'
             if readme_file:
                 url = base_url + '/' + branch + '/' + readme_file
+                # Sometimes we get 503, and if you try it again, it works.
+                # get_raw() takes care of retrying.
                 (status, content) = get_raw(url)
-                if status == 503:
-                    # Weird behavior -- not sure if it's our system or theirs,
-                    # but we sometimes get 503 and if you try it again, it works.
-                    msg('*** Code 503 -- retrying {}'.format(url))
-                    (status, content) = get_raw(url)
                 if content != None:
                     return ('http', content)
                 else:
-                    msg('*** Code {} getting readme for {}'.format(r.status_code, url))
+                    msg('*** Code {} getting readme for {}'.format(status, url))
                     return ('http', None)
             elif entry['files'] and entry['files'] != -1:
                 # We have a list of files in the repo, and there's no README.
@@ -1205,30 +2124,54 @@ class GitHubIndexer():
                 exts = ['', '.md', '.txt', '.markdown', '.rdoc', '.rst']
                 for ext in exts:
                     alternative = base_url + '/master/README' + ext
-                    r = timed_get(alternative, verify=False)
-                    if r and r.status_code == 200:
-                        return ('http', r.text)
+                    (status, content) = get_raw(alternative)
+                    if status == 200:
+                        return ('http', content)
 
         # If we get here and we're only doing HTTP, then we're done.
         if prefer_http:
             return ('http', None)
 
-        # Resort to GitHub API call.
+        # Resort to GitHub API call, unless we got it already via GraphQL.
+        (found, repo) = self.prefetched_repo(entry['owner'], entry['name'])
+        if found:
+            # If GitHub didn't return the repo, the caller has to find out
+            # whether it moved.  If it did, -1 means it has no README.
+            return ('graphql', repo.readme if repo else 404)
+
         # Get the "preferred" readme file for a repository, as described in
         # https://developer.github.com/v3/repos/contents/
         # Using github3.py would need 2 api calls per repo to get this info.
         # Here we do direct access to bring it to 1 api call.
-        url = 'https://api.github.com/repos/{}/readme'.format(e_path(entry))
-        return ('api', self.direct_api_call(url))
+        # If we have a README already, ask only if it has changed.
+        url = self.readme_url(entry)
+        return ('api', self.direct_api_call(url, remember=True,
+                                            conditional=have_readme(entry)))
+
+
+    def languages_url(self, entry):
+        return 'https://api.github.com/repos/{}/{}/languages'.format(entry['owner'],
+                                                                    entry['name'])
+
+
+    def readme_url(self, entry):
+        return 'https://api.github.com/repos/{}/readme'.format(e_path(entry))
+
+
+    def files_url(self, entry):
+        branch = 'master' if not entry['default_branch'] else entry['default_branch']
+        return 'https://api.github.com/repos/' + e_path(entry) + '/git/trees/' + branch
 
 
     def set_files_via_api(self, entry, force=False):
-        branch   = 'master' if not entry['default_branch'] else entry['default_branch']
-        base     = 'https://api.github.com/repos/' + e_path(entry)
-        url      = base + '/git/trees/' + branch
-        response = self.direct_api_call(url)
+        url      = self.files_url(entry)
+        # If we have a list of files already, ask only if it has changed.
+        have_files = bool(entry['files'])
+        response = self.direct_api_call(url, remember=True, conditional=have_files)
         if response == None:
             msg('*** No response for {} -- skipping'.format(e_summary(entry)))
+        elif response == 304:
+            msg('{} files unchanged'.format(e_summary(entry)))
         elif isinstance(response, int) and response in [403, 451]:
             # We hit the rate limit or a problem.  Bubble it up to loop().
             raise DirectAPIException('Getting files', response)
@@ -1265,8 +2208,7 @@ class GitHubIndexer():
 
 
     def set_files_via_http(self, entry, force=False):
-        page = GitHubHomePage()
-        status = page.get_html(entry['owner'], entry['name'])
+        (page, status) = self.home_page(entry)
         if status >= 400 and status not in [404, 451]:
             raise UnexpectedResponseException('Getting HTML', status)
         elif page.is_problem():
@@ -1305,16 +2247,18 @@ class GitHubIndexer():
 
 
     def add_languages(self, targets=None, force=False, prefer_http=False,
-                      start_id=0, **kwargs):
+                      start_id=0, async_pages=0, graphql=False, inherit=False,
+                      **kwargs):
         def body_function(entry):
             t1 = time()
             if entry['languages'] and entry['languages'] != -1 and not force:
                 msg('*** {} has languages -- skipping'.format(e_summary(entry)))
                 return
+            if inherit and self.inherit_from_parent(entry, ['languages']):
+                return
             if prefer_http:
                 # The HTML scraper will get the languages as a by-product.
-                page = GitHubHomePage()
-                status = page.get_html(entry['owner'], entry['name'])
+                (page, status) = self.home_page(entry, ['languages'])
                 if status >= 400 and status not in [404, 451]:
                     raise UnexpectedResponseException('Getting HTML', status)
                 elif page.is_problem():
@@ -1324,8 +2268,12 @@ class GitHubIndexer():
                 # Use the API.  This is the best approach and gives a fuller
                 # language list, but of course, costs API calls.
                 # This will have a form like: {'Shell': 4051, 'Java': 1444052}
-                # We turn it it into a straight list of names.
-                lang_dict = self.get_languages(entry)
+                # We turn it it into a straight list of names.  If we have
+                # languages already, ask GitHub only if they have changed.
+                lang_dict = self.get_languages(entry, conditional=have_languages(entry))
+                if lang_dict == 304:
+                    msg('{} languages unchanged'.format(e_summary(entry)))
+                    return
                 langs = [k for k in lang_dict.keys()] if lang_dict else None
                 langs = make_languages(langs)
             if langs:
@@ -1335,6 +2283,10 @@ class GitHubIndexer():
                 self.update_entry_field(entry, 'languages', langs)
                 msg('{} languages added to {}'.format(len(langs), e_summary(entry)))
 
+        def iterator(targets, start_id):
+            fields = ['_id', 'owner', 'name', 'languages', 'time', 'fork']
+            return self.entry_list(targets, fields, start_id)
+
         msg('Gathering language data for repositories.')
         # Set up default selection criteria WHEN NOT USING 'targets'.
         selected_repos = {'languages': {"$eq" : []}, 'is_deleted': False,
@@ -1342,12 +2294,25 @@ class GitHubIndexer():
         if start_id > 0:
             msg("Skipping GitHub id's less than {}".format(start_id))
             selected_repos['_id'] = {'$gte': start_id}
+        if prefer_http and async_pages:
+            iterator = self.prefetching_pages(iterator, async_pages)
+        elif graphql and not prefer_http:
+            iterator = self.prefetching_graphql(iterator)
+        elif not prefer_http:
+            iterator = self.prefetching_etags(iterator, lambda entry:
+                self.languages_url(entry) if have_languages(entry) else None)
         # And let's do it.
-        self.loop(self.entry_list, body_function, selected_repos, targets, start_id)
+        self.loop(iterator, body_function, selected_repos, targets, start_id,
+                  **kwargs)
 
 
     def add_readmes(self, targets=None, languages=None, prefer_http=False,
-                    api_only=False, start_id=0, force=False, **kwargs):
+                    api_only=False, start_id=0, force=False, graphql=False,
+                    compress=False, dedup=False, inherit=False, **kwargs):
+        # If 'compress' is True, the READMEs are stored compressed.  If
+        # 'dedup' is True, they are stored in the ReadmeStore, and entries
+        # only refer to them.  See readme_store.py.  If 'inherit' is True,
+        # forks that haven't been pushed to get their parent's README.
 
         def no_readme(entry):
             msg('{} has no readme'.format(e_summary(entry)))
@@ -1357,9 +2322,14 @@ class GitHubIndexer():
             if entry['is_visible'] == False:
                 # See note at the end of the parent function (add_readmes).
                 return
+            if inherit and self.inherit_from_parent(entry, ['readme']):
+                return
             t1 = time()
             (method, readme) = self.get_readme(entry, prefer_http, api_only)
-            if isinstance(readme, int) and readme in [403, 451]:
+            if readme == 304:
+                msg('{} readme unchanged'.format(e_summary(entry)))
+                return
+            elif isinstance(readme, int) and readme in [403, 451]:
                 # We hit a problem.  Bubble it up to loop().
                 raise DirectAPIException('Getting README', readme)
             elif isinstance(readme, int) and readme >= 400:
@@ -1389,6 +2359,13 @@ class GitHubIndexer():
                 t2 = time()
                 msg('{} {} in {:.2f}s via {}'.format(
                     e_summary(entry), len(readme), (t2 - t1), method))
+                if dedup:
+                    readme = self._readmes.put(readme, compress)
+                    if readme == entry['readme']:
+                        msg('{} readme is the same as before'.format(e_summary(entry)))
+                        return
+                elif compress:
+                    readme = compress_readme(readme)
                 self.update_entry_field(entry, 'readme', readme)
             elif isinstance(readme, int) and readme in [404, 451]:
                 # If we have gotten this far and still have a 404, it's not there.
@@ -1398,6 +2375,11 @@ class GitHubIndexer():
             else:
                 msg('Got {} for readme for {}'.format(readme, e_summary(entry)))
 
+        def iterator(targets, start_id):
+            # If the repo has moved, update_entry_moved() needs the rest.
+            fields = self._update_fields + ['readme']
+            return self.entry_list(targets, fields, start_id)
+
         # Set up default selection criteria WHEN NOT USING 'targets'.
         #
         # Note 2016-05-27: I had trouble with adding a check against
@@ -1421,12 +2403,152 @@ class GitHubIndexer():
         else:
             selected_repos['readme'] = None
 
+        if graphql and not prefer_http:
+            iterator = self.prefetching_graphql(iterator)
+        elif not prefer_http:
+            iterator = self.prefetching_etags(iterator, lambda entry:
+                self.readme_url(entry) if have_readme(entry) else None)
         # And let's do it.
-        self.loop(self.entry_list, body_function, selected_repos, targets, start_id)
+        self.loop(iterator, body_function, selected_repos, targets, start_id,
+                  **kwargs)
+
+
+    def compress_readmes(self, targets=None, start_id=0, **kwargs):
+        '''Converts READMEs stored as plain text to the compressed form.'''
+
+        def body_function(entry):
+            if not isinstance(entry['readme'], str):
+                return
+            readme = compress_readme(entry['readme'])
+            if is_compressed(readme):
+                self._writes.update(entry['_id'], {'readme': readme})
+                msg('{} readme compressed to {} bytes'.format(
+                    e_summary(entry), len(readme)))
+
+        def iterator(targets, start_id):
+            fields = ['_id', 'owner', 'name', 'readme']
+            return self.entry_list(targets, fields, start_id)
+
+        msg('Compressing README files stored as text.')
+        selected_repos = {'readme': {'$type': 'string'}}
+        if start_id > 0:
+            msg("Skipping GitHub id's less than {}".format(start_id))
+            selected_repos['_id'] = {'$gte': start_id}
+        self.loop(iterator, body_function, selected_repos, targets, start_id,
+                  **kwargs)
+
+
+    def refresh(self, targets=None, prefer_http=False, start_id=0, ttl=None,
+                **kwargs):
+        '''Gets the data again for entries whose repos were pushed to or
+        updated after we last refreshed our data for them, plus (if 'ttl'
+        is given) entries whose data is more than 'ttl' days old.'''
+        # The entries are taken _refresh_chunk at a time, least recently
+        # refreshed first, and the usual actions are run on each chunk.
+        # Entries are marked as refreshed once all the actions are done, so
+        # they drop out of the selection; an interrupted run can simply be
+        # started again.  Entries refreshed since this run began are left
+        # out, so that nothing comes around twice if the clocks disagree.
+        def after_entry(entry):
+            # Selects the entries that come after 'entry' in the order
+            # (time.data_refreshed, _id).  Missing values sort first.
+            refreshed = entry.get('time', {}).get('data_refreshed')
+            later = [{'time.data_refreshed': refreshed, '_id': {'$gt': entry['_id']}}]
+            if refreshed is None:
+                later.append({'time.data_refreshed': {'$ne': None}})
+            else:
+                later.append({'time.data_refreshed': {'$gt': refreshed}})
+            return {'$or': later}
+
+        def unrefresh(chunk, ids):
+            # The actions set time.data_refreshed on entries they change, so
+            # the entries in 'ids' get back the value they had before.
+            for entry in chunk:
+                if entry['_id'] in ids:
+                    refreshed = entry.get('time', {}).get('data_refreshed')
+                    self.db.update_one({'_id': entry['_id']},
+                                       {'$set': {'time.data_refreshed': refreshed}})
+
+        started = now_timestamp()
+        for arg in ['force', 'resume', 'shard_size']:
+            kwargs.pop(arg, None)
+        changed = [{'$expr': {'$gt': ['$time.repo_pushed', '$time.data_refreshed']}},
+                   {'$expr': {'$gt': ['$time.repo_updated', '$time.data_refreshed']}}]
+        if ttl:
+            # Timestamps are in seconds.
+            changed.append({'time.data_refreshed': {'$lt': started - float(ttl)*86400}})
+        selected_repos = {'is_deleted': False, 'is_visible': {'$ne': False},
+                          '$and': [{'$or': changed},
+                                   {'$or': [{'time.data_refreshed': None},
+                                            {'time.data_refreshed': {'$lt': started}}]}]}
+        if start_id > 0:
+            msg("Skipping GitHub id's less than {}".format(start_id))
+            selected_repos['_id'] = {'$gte': start_id}
+        self.db.create_index([('is_deleted', 1), ('time.data_refreshed', 1), ('_id', 1)])
+
+        if prefer_http:
+            actions = self._refresh_actions_http
+        else:
+            actions = self._refresh_actions
+        msg('Refreshing entries that changed since we last got their data.')
+        total = 0
+        last = None
+        while True:
+            if targets:
+                ids = list(flatten(self.ensure_id(x) for x in targets))
+                chunk = list(self.db.find({'_id': {'$in': ids}},
+                                          {'_id': 1, 'time.data_refreshed': 1}))
+            else:
+                # Each chunk carries on from where the last one ended, so
+                # that the entries before it aren't looked at again.
+                query = selected_repos
+                if last:
+                    query = dict(selected_repos)
+                    query['$and'] = selected_repos['$and'] + [after_entry(last)]
+                cursor = self.db.find(query, {'_id': 1, 'time.data_refreshed': 1})
+                cursor = cursor.sort([('time.data_refreshed', 1), ('_id', 1)])
+                chunk = list(cursor.limit(self._refresh_chunk))
+                if chunk:
+                    last = chunk[-1]
+                ids = [entry['_id'] for entry in chunk]
+            if not ids:
+                break
+            msg('Refreshing {} entries'.format(len(ids)))
+            self._unfinished = set()
+            try:
+                for action in actions:
+                    # The ids are already above start_id.  create_entries
+                    # takes start_id=None to mean something else, so it has
+                    # to be given explicitly.
+                    getattr(self, action)(targets=ids, force=True, start_id=0,
+                                          prefer_http=prefer_http, **kwargs)
+                    if self._stopping:
+                        msg('*** Stopping refresh -- {} entries left as they were'.format(
+                            len(ids)))
+                        self._writes.flush()
+                        unrefresh(chunk, set(ids))
+                        return
+                unfinished = self._unfinished
+            finally:
+                self._unfinished = None
+            # Entries that any action failed on are left to be tried again
+            # by the next run.
+            if unfinished:
+                msg('*** {} entries could not be refreshed'.format(len(unfinished)))
+            done = [id for id in ids if id not in unfinished]
+            self._writes.flush()
+            unrefresh(chunk, unfinished)
+            self.db.update_many({'_id': {'$in': done}},
+                                {'$set': {'time.data_refreshed': now_timestamp()}})
+            total += len(done)
+            if targets:
+                break
+        msg('Refreshed {} entries.'.format(total))
 
 
     def create_entries(self, targets=None, api_only=False, prefer_http=False,
-                       force=False, start_id=None, **kwargs):
+                       force=False, start_id=None, async_pages=0, graphql=False,
+                       **kwargs):
         '''Create index by looking for new entries in GitHub, or adding entries
         whose id's or owner/name paths are given in the parameter 'targets'.
         If something is already in our database, this won't change it unless
@@ -1453,8 +2575,7 @@ class GitHubIndexer():
             if not entry:
                 entry = thing
             if prefer_http:
-                page = GitHubHomePage()
-                status = page.get_html(entry['owner'], entry['name'])
+                (page, status) = self.home_page(entry)
                 if status in [404, 451]:
                     # Is no longer visible.
                     self.mark_entry_invisible(entry)
@@ -1472,24 +2593,36 @@ class GitHubIndexer():
                     msg('*** Skipping existing entry {}'.format(e_summary(thing)))
                 self.update_entry_from_github3(entry, repo)
 
+        def stored_entries(targets, start_id):
+            return self.entry_list(targets, self._update_fields, start_id)
+
         last_seen = None
+        workers = kwargs.get('workers', 1)
         if targets:
             # We have a list of id's or repo paths.
             if force:
                 # Using the force flag only makes sense if we expect that
                 # the entries are in the database already => use entry_list()
-                repo_iterator = self.entry_list
+                repo_iterator = stored_entries
             else:
                 # We're indexing but not overwriting. This won't do anything
                 # to existing entries, so we assume that the targets are new
                 # repo id's or paths (or a mix of known and unknown).
                 repo_iterator = self.repo_list
+        elif workers > 1 and not (prefer_http and force):
+            # Page through GitHub's list of repos in several places at once,
+            # instead of one page after another.
+            last_seen = start_id or self.last_seen_id()
+            msg('Continuing from id {} using {} windows at a time'.format(
+                last_seen, workers))
+            size = kwargs.get('shard_size') or self._window_size
+            repo_iterator = self.windowed_github_iterator(workers, size)
         elif (start_id == 0 or start_id):
             msg('Starting from {}'.format(start_id))
             if prefer_http and force:
                 # Using the force flag only makes sense if we expect that
                 # the entries are in the database already => use entry_list()
-                repo_iterator = self.entry_list
+                repo_iterator = stored_entries
             else:
                 repo_iterator = self.github_iterator
         else:
@@ -1507,28 +2640,22 @@ class GitHubIndexer():
         if start_id > 0:
             msg("Skipping GitHub id's less than {}".format(start_id))
             selected_repos['_id'] = {'$gte': start_id}
-        self.loop(repo_iterator, body_function, selected_repos, targets or last_seen, start_id)
+        if prefer_http and async_pages:
+            repo_iterator = self.prefetching_pages(repo_iterator, async_pages)
+        elif graphql and not prefer_http and repo_iterator == stored_entries:
+            # Repos from GitHub's list come with their data already, so only
+            # stored entries being updated have any use for GraphQL.
+            repo_iterator = self.prefetching_graphql(repo_iterator)
+        self.loop(repo_iterator, body_function, selected_repos,
+                  targets or last_seen, start_id, **kwargs)
 
 
     def infer_type(self, targets=None, api_only=False, prefer_http=False,
-                   force=False, start_id=None, **kwargs):
+                   force=False, start_id=0, inherit=False, offline=False,
+                   in_database=False, batch_size=0, **kwargs):
 
         def guess_type(entry):
-            # File tests are very basic and conservative.  They are
-            # necessarily heuristic, so they could be wrong if someone does
-            # something really unusual.
-            if entry['files'] != -1:
-                if any(is_code_file(f) for f in entry['files']):
-                    return ('code', 'file names')
-                if all(is_noncode_file(f) for f in entry['files']):
-                    return ('noncode', 'file names')
-
-            # The language-based heuristics are more iffy because GitHub's
-            # language analyzer sometimes guesses wrong.
-            if entry['languages'] != -1:
-                if any(known_code_lang(lang['name']) for lang in entry['languages']):
-                    return ('code', 'languages')
-            return (None, None)
+            return classify(entry['files'], entry['languages'])
 
         def body_function(entry):
             if not force:
@@ -1539,6 +2666,12 @@ class GitHubIndexer():
                 if entry['content_type']:
                     msg('*** {} already has content_type -- skipping'.format(summary))
                     return
+            if inherit:
+                # If the parent has no content_type, its files and languages
+                # at least let us guess without getting the files list.
+                fields = ['content_type', 'files', 'languages']
+                if 'content_type' in self.inherit_from_parent(entry, fields):
+                    return
             if not entry['files']:
                 # We don't have a files list yet. Get it.
                 if api_only:      self.set_files_via_api(entry, force)
@@ -1553,17 +2686,94 @@ class GitHubIndexer():
             else:
                 msg('*** Unable to guess type of {}'.format(e_summary(entry)))
 
+        def iterator(targets, start_id):
+            # Getting the files list may update anything from the HTML page.
+            fields = self._update_fields + ['content_type']
+            return self.entry_list(targets, fields, start_id)
+
+        def infer_offline(selector, batch_size):
+            # Classifies a batch of entries at a time.
+            fields = ['_id', 'files', 'languages', 'content_type', 'time']
+            entries = iter(self.entry_list(selector, fields, start_id, batch_size))
+            count = 0
+            guessed = 0
+            start = time()
+            while not self._stopping:
+                batch = list(islice(entries, batch_size))
+                if not batch:
+                    break
+                for entry in batch:
+                    (guess, method) = classify(entry['files'], entry['languages'])
+                    if guess:
+                        self.update_entry_field(entry, 'content_type',
+                                                make_content_type(guess, method),
+                                                append=True)
+                        guessed += 1
+                count += len(batch)
+                msg('{} entries done, {} guessed, {:.0f} entries/sec'.format(
+                    count, guessed, count/max(time() - start, 1e-6)))
+            msg('Guessed content_type for {} of {} entries.'.format(guessed, count))
+
+        def infer_in_database(selector):
+            # The database classifies the entries and updates them itself,
+            # doing what update_entry_field() does with append=True.  This
+            # needs MongoDB 4.4 or later for $merge into the same collection.
+            self.flush_updates()
+            results = {(guess, method): make_content_type(guess, method)
+                       for (guess, method) in [('code', 'file names'),
+                                               ('noncode', 'file names'),
+                                               ('code', 'languages')]}
+            now = now_timestamp()
+            current = {'$ifNull': ['$content_type', []]}
+            pipeline = [
+                {'$match': selector},
+                {'$project': {'content_type': 1,
+                              'guess': classify_expression(results)}},
+                {'$match': {'guess': {'$ne': None}}},
+                {'$match': {'$expr': {'$eq': [False, {'$in': ['$guess', current]}]}}},
+                {'$project': {'content_type': {'$concatArrays': [current, ['$guess']]}}},
+                {'$merge': {'into': self.db.name, 'on': '_id',
+                            'whenMatched': [{'$set': {
+                                'content_type': '$$new.content_type',
+                                'time.data_refreshed': now}}],
+                            'whenNotMatched': 'discard'}},
+            ]
+            start = time()
+            self.db.aggregate(pipeline, allowDiskUse=True)
+            msg('Database finished classifying in {:.0f} sec.'.format(time() - start))
+
         # Main loop.
         msg('Inferring content_type for repositories.')
         selected_repos = {'is_deleted': False, 'is_visible': True}
         if start_id > 0:
             msg("Skipping GitHub id's less than {}".format(start_id))
             selected_repos['_id'] = {'$gte': start_id}
-        self.loop(self.entry_list, body_function, selected_repos, targets, start_id)
+        if offline or in_database:
+            # Only use what's in the database.  Entries without a files
+            # list would need one from GitHub, so they're left out.
+            if targets:
+                ids = list(flatten(self.ensure_id(x) for x in targets))
+                selected_repos['_id'] = {'$in': [id for id in ids
+                                                 if id >= (start_id or 0)]}
+            if force:
+                selected_repos['$or'] = [{'files': -1},
+                                         {'files.0': {'$exists': True}}]
+            else:
+                selected_repos['files.0'] = {'$exists': True}
+                selected_repos['content_type'] = []
+            self._stopping = False
+            if in_database:
+                infer_in_database(selected_repos)
+            else:
+                infer_offline(selected_repos, batch_size or self._offline_batch)
+            return
+        self.loop(iterator, body_function, selected_repos, targets, start_id,
+                  batch_size=batch_size, **kwargs)
 
 
     def add_files(self, targets=None, api_only=False, prefer_http=False,
-                  force=False, start_id=None, **kwargs):
+                  force=False, start_id=0, async_pages=0, inherit=False,
+                  **kwargs):
 
         def body_function(entry):
             if not force:
@@ -1577,16 +2787,14 @@ class GitHubIndexer():
                 if entry['is_visible'] == False or entry['is_deleted'] == True:
                     msg('*** {} believed to be unavailable -- skipping'.format(info))
                     return
+            if inherit and self.inherit_from_parent(entry, ['files']):
+                return
             if api_only:      self.set_files_via_api(entry, force)
             elif prefer_http: self.set_files_via_http(entry, force)
             else:             self.set_files_via_svn(entry, force)
 
         def iterator(targets, start_id):
-            fields = ['files', 'default_branch', 'is_visible', 'is_deleted',
-                      'owner', 'name', 'time', '_id', 'description',
-                      'languages', 'fork', 'num_releases', 'num_branches',
-                      'num_commits', 'num_contributors', 'homepage']
-            return self.entry_list(targets, fields, start_id)
+            return self.entry_list(targets, self._update_fields, start_id)
 
         # And let's do it.
         msg('Gathering lists of files.')
@@ -1599,80 +2807,103 @@ class GitHubIndexer():
         if start_id > 0:
             msg("Skipping GitHub id's less than {}".format(start_id))
             selected_repos['_id'] = {'$gte': start_id}
+        if prefer_http and async_pages:
+            iterator = self.prefetching_pages(iterator, async_pages)
+        elif api_only:
+            iterator = self.prefetching_etags(iterator, lambda entry:
+                self.files_url(entry) if entry['files'] else None)
         # Note: the selector only has effect when targets are not explicit.
-        self.loop(iterator, body_function, selected_repos, targets, start_id)
-
+        self.loop(iterator, body_function, selected_repos, targets, start_id,
+                  **kwargs)
 
-    def detect_text_lang(self, targets=None, force=False,
-                         start_id=None, **kwargs):
 
-        min_readme_length = 125
-        min_description_length = 60
+    def detect_text_lang(self, targets=None, force=False, start_id=0,
+                         processes=0, **kwargs):
 
-        def guess_markdown(text):
-            if not isinstance(text, str):
-                text = text.decode()
-            return re.search('^#', text) or text.find('](')
-
-        def guess_html(text):
-            with warnings.catch_warnings():
-                warnings.simplefilter('ignore')
-                return BeautifulSoup(text, 'html.parser').find()
-
-        def remove_html(text):
-            with warnings.catch_warnings():
-                warnings.simplefilter('ignore')
-                return ''.join(BeautifulSoup(text, 'lxml').findAll(text=True))
+        def skip(entry):
+            if not force and entry['text_languages']:
+                msg('*** {} has text_language -- skipping'.format(e_summary(entry)))
+                return True
+            return False
 
-        def body_function(entry):
-            info = e_summary(entry)
-            if not force:
-                if entry['text_languages']:
-                    msg('*** {} has text_language -- skipping'.format(info))
-                    return
-                current_langs = entry['text_languages']
-            else:
-                current_langs = []
-            no_text = True
+        def text_to_check(entry):
+            # Returns a tuple (kind, text, found, lang), where 'found' is
+            # True if 'lang' is already known and there's nothing to check.
             # The best inferences come from long text.  The langid module
             # gets things wrong for short text with unusual terms (which is
             # typical for programmer-speak).  So the approach is: if we have
             # a README and it's reasonably long, we use that exclusively;
             # otherwise, we try the description but only if it's long enough.
             if entry['readme'] and entry['readme'] != -1:
-                readme = entry['readme']
-                if not isinstance(readme, str):
-                    readme = readme.decode().encode('ascii', 'ignore')
-                if guess_html(readme):
-                    readme = remove_html(readme)
-                elif guess_markdown(readme):
-                    # Use Markdown formatter to generate HTML, then strip it.
-                    readme = remove_html(markdown.markdown(readme))
-                if len(readme) > min_readme_length:
-                    lang, _ = langid.classify(readme)
-                    current_langs.append(lang)
-                    no_text = False
+                # READMEs kept in the ReadmeStore may be shared by many
+                # entries, and the result is stored with them.
+                (found, lang) = self._readmes.cached(entry['readme'], 'text_language')
+                if found:
+                    return ('readme', None, True, lang)
+                return ('readme', self._readmes.text(entry['readme']), False, None)
             elif entry['description'] and entry['description'] != -1:
-                description = entry['description']
-                if not isinstance(description, str):
-                    description = description.decode().encode('ascii', 'ignore')
-                if guess_html(description):
-                    description = remove_html(description)
-                if len(description) > min_description_length:
-                    lang, _ = langid.classify(description)
-                    current_langs.append(lang)
-                    no_text = False
-            if current_langs or force:
+                return ('description', entry['description'], False, None)
+            return (None, None, True, None)
+
+        def record(entry, kind, lang, computed):
+            info = e_summary(entry)
+            if kind == 'readme' and computed:
+                self._readmes.cache(entry['readme'], 'text_language', lang)
+            if lang:
+                self._writes.update(entry['_id'], {'text_languages': [lang]})
+                msg('{} languages inferred to be {}'.format(info, [lang]))
+            elif force:
                 # If we couldn't make an inference, we set it to -1.
-                current_langs = list(set(current_langs)) or -1
-                self.db.update({'_id': entry['_id']},
-                               {'$set': {'text_languages': current_langs}})
-                msg('{} languages inferred to be {}'.format(info, current_langs))
-            elif no_text:
-                self.db.update({'_id': entry['_id']}, {'$set': {'text_languages': -1}})
-                msg('{} has no description or readme, or they are too short'.format(info))
+                self._writes.update(entry['_id'], {'text_languages': -1})
+                msg('{} languages inferred to be -1'.format(info))
             else:
-                msg('could not infer language for {}'.format(info))
+                self._writes.update(entry['_id'], {'text_languages': -1})
+                msg('{} has no description or readme, or they are too short'.format(info))
+
+        def body_function(entry):
+            if skip(entry):
+                return
+            (kind, text, found, lang) = text_to_check(entry)
+            if not found:
+                lang = text_language(kind, text)
+            record(entry, kind, lang, not found)
+
+        def run_in_processes(selector):
+            # The pool is made first, because its processes are forked and
+            # entry_list() starts a thread.  Batches of work are handed to
+            # the pool as entries are read, keeping a few batches in hand
+            # for each process so that none of them sits idle.
+            msg('Using {} processes'.format(processes))
+            pool = TextLanguagePool(processes)
+            pending = deque()
+            self._stopping = False
+            try:
+                entries = iter(iterator(targets or selector, start_id))
+                while not self._stopping:
+                    work = []
+                    for entry in islice(entries, self._text_batch):
+                        if not skip(entry):
+                            work.append((entry,) + text_to_check(entry))
+                    if not work:
+                        break
+                    result = pool.submit([(kind, text) for (_, kind, text, found, _)
+                                          in work if not found])
+                    pending.append((work, result))
+                    if len(pending) > 2 * processes:
+                        finish(*pending.popleft())
+                while pending:
+                    finish(*pending.popleft())
+            finally:
+                pool.close()
+                # This doesn't go through loop(), which would do it.
+                self._writes.flush()
+
+        def finish(work, result):
+            langs = iter(result.get())
+            for (entry, kind, _, found, lang) in work:
+                if not found:
+                    lang = next(langs)
+                record(entry, kind, lang, not found)
 
         def iterator(targets, start_id):
             fields = ['description', 'readme', 'text_languages', '_id',
@@ -1690,26 +2921,33 @@ class GitHubIndexer():
         if selected_repos == {}:
             selected_repos = None
         # Note: the selector only has effect when targets are not explicit.
-        self.loop(iterator, body_function, selected_repos, targets, start_id)
+        if processes > 1:
+            run_in_processes(selected_repos)
+            return
+        self.loop(iterator, body_function, selected_repos, targets, start_id,
+                  **kwargs)
 
 
     def add_licenses(self, targets=None, force=False, prefer_http=False,
-                     start_id=0, **kwargs):
+                     start_id=0, async_pages=0, graphql=False, **kwargs):
         def body_function(entry):
             t1 = time()
             if entry['licenses'] and entry['licenses'] != -1 and not force:
                 msg('*** {} has licenses -- skipping'.format(e_summary(entry)))
                 return
 
-            # Currently, there is no way to get the license info from GitHub
-            # other than by scraping the HTML from the project page.
-            page = GitHubHomePage()
-            status = page.get_html(entry['owner'], entry['name'])
-            if status >= 400 and status not in [404, 451]:
-                raise UnexpectedResponseException('Getting HTML', status)
-            elif page.is_problem():
-                msg('*** problem with GitHub page for {}'.format(e_summary(entry)))
-            licenses = page.licenses()
+            # Apart from GraphQL, the only way to get the license info from
+            # GitHub is by scraping the HTML from the project page.
+            (found, repo) = self.prefetched_repo(entry['owner'], entry['name'])
+            if found and repo and repo.licenses:
+                licenses = repo.licenses
+            else:
+                (page, status) = self.home_page(entry, ['licenses'])
+                if status >= 400 and status not in [404, 451]:
+                    raise UnexpectedResponseException('Getting HTML', status)
+                elif page.is_problem():
+                    msg('*** problem with GitHub page for {}'.format(e_summary(entry)))
+                licenses = page.licenses()
             if licenses:
                 # We don't set licenses to -1 if only using HTTP, as the web
                 # pages don't always contain license info.
@@ -1727,5 +2965,48 @@ class GitHubIndexer():
         if start_id > 0:
             msg("Skipping GitHub id's less than {}".format(start_id))
             selected_repos['_id'] = {'$gte': start_id}
+        if async_pages:
+            iterator = self.prefetching_pages(iterator, async_pages)
+        if graphql:
+            iterator = self.prefetching_graphql(iterator)
+        # And let's do it.
+        self.loop(iterator, body_function, selected_repos, targets, start_id,
+                  **kwargs)
+
+
+    def enrich(self, targets=None, force=False, start_id=0, async_pages=0,
+               **kwargs):
+        # The HTML scraper extracts everything on a repository's home page in
+        # one go, so this gets the languages, licenses, files, counts, fork
+        # info and description with one page fetch and one database write per
+        # entry, instead of a separate pass for each kind of data.
+        def body_function(entry):
+            (page, status) = self.home_page(entry)
+            if status >= 400 and status not in [404, 451]:
+                raise UnexpectedResponseException('Getting HTML', status)
+            elif page.is_problem():
+                msg('*** GitHub problem for {} -- skipping'.format(e_summary(entry)))
+            else:
+                self.update_entry_from_html(entry, page, force)
+
+        def iterator(targets, start_id):
+            return self.entry_list(targets, self._update_fields, start_id)
+
+        msg('Gathering data from repository home pages.')
+        # Set up default selection criteria WHEN NOT USING 'targets'.
+        if force:
+            selected_repos = {'is_deleted': False, 'is_visible': {"$ne" : False}}
+        else:
+            # Only entries that are missing at least one of the things we
+            # can only get cheaply from the home page.
+            selected_repos = {'is_deleted': False, 'is_visible': {"$ne" : False},
+                              '$or': [{'languages': []}, {'licenses': []},
+                                      {'files': []}]}
+        if start_id > 0:
+            msg("Skipping GitHub id's less than {}".format(start_id))
+            selected_repos['_id'] = {'$gte': start_id}
+        if async_pages:
+            iterator = self.prefetching_pages(iterator, async_pages)
         # And let's do it.
-        self.loop(iterator, body_function, selected_repos, targets, start_id)
+        self.loop(iterator, body_function, selected_repos, targets, start_id,
+                  **kwargs)
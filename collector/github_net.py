@@ -0,0 +1,480 @@
+#!/usr/bin/env python3.4
+#
+# @file    github_net.py
+# @brief   Network plumbing shared by the GitHub indexer's API calls.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+import codecs
+import gzip
+import http.client
+import os
+import queue
+import random
+import sys
+import threading
+import urllib.parse
+import zlib
+from base64 import b64encode
+from email.utils import parsedate_to_datetime
+from time import time, sleep
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
+from utils import *
+from write_buffer import WriteBuffer
+
+
+# Token pool.
+# .............................................................................
+# GitHub's rate limit is per account.  The pool holds the credentials of one
+# or more accounts and tracks each one's remaining budget and reset time from
+# the X-RateLimit-* headers that GitHub sends back on every API response, so
+# we don't have to spend extra calls asking about the rate limit.  Callers
+# ask the pool for a token each time they make a call, and get the one with
+# the most calls left.
+#
+# GitHub keeps separate budgets for different kinds of calls, such as the
+# REST API ("core") and GraphQL ("graphql"), and says which one a response
+# counted against in X-RateLimit-Resource.  The pool keeps them apart, and
+# the methods that ask about budgets take the name of one, "core" by
+# default.
+
+class TokenPool():
+    _default_limit = 5000
+
+
+    def __init__(self, accounts):
+        # 'accounts' is a list of (login, password) tuples.
+        self._lock   = threading.Lock()
+        self._tokens = [{'login': login, 'password': password, 'limits': {}}
+                        for (login, password) in accounts]
+
+
+    def __len__(self):
+        return len(self._tokens)
+
+
+    def choose(self, resource='core'):
+        '''Returns the token with the most API calls left.'''
+        with self._lock:
+            return max(self._tokens, key=lambda t: self._budget(t, resource))
+
+
+    def update(self, token, headers, resource='core'):
+        '''Records the rate limit values found in the response 'headers'.
+        'resource' is the budget they are for if the headers don't say.'''
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset')
+        if remaining == None:
+            return
+        resource = headers.get('X-RateLimit-Resource') or resource
+        with self._lock:
+            limit = token['limits'].setdefault(resource, {'reset': 0})
+            limit['remaining'] = int(remaining)
+            if reset:
+                limit['reset'] = int(reset)
+
+
+    def known(self, resource='core'):
+        '''Returns True if we have seen rate limit headers for any token.'''
+        return any(resource in t['limits'] for t in self._tokens)
+
+
+    def calls_left(self, resource='core'):
+        '''Returns the number of API calls left across all tokens.'''
+        with self._lock:
+            return sum(self._budget(t, resource) for t in self._tokens)
+
+
+    def reset_time(self, resource='core'):
+        '''Returns the earliest time (in seconds since the epoch) at which an
+        exhausted token gets a new budget.'''
+        with self._lock:
+            resets = [t['limits'][resource]['reset'] for t in self._tokens
+                      if self._budget(t, resource) < 1]
+            return min(resets) if resets else time()
+
+
+    def auth_header(self, token):
+        auth = '{0}:{1}'.format(token['login'], token['password'])
+        return 'Basic ' + b64encode(bytes(auth, 'ascii')).decode('ascii')
+
+
+    def _budget(self, token, resource):
+        # Tokens we haven't used yet are assumed to have their full budget,
+        # and so are tokens whose reset time has passed.
+        limit = token['limits'].get(resource)
+        if limit == None or limit['reset'] <= time():
+            return self._default_limit
+        return limit['remaining']
+
+
+
+# Conditional requests.
+# .............................................................................
+# GitHub answers requests carrying If-None-Match or If-Modified-Since with
+# 304 Not Modified when nothing has changed, and 304 responses don't count
+# against the rate limit.  ETagCache remembers the validators that GitHub
+# returned for each URL, in a Mongo collection so that they survive across
+# runs.  New validators are kept in memory and written to the collection in
+# bulk by a WriteBuffer, rather than with a database call for each request,
+# so flush() must be called at the end.  Validators can also be read ahead
+# for a batch of URLs with one query, using load(); they are kept in the
+# dictionary 'loaded' until the caller removes them.
+
+class ETagCache():
+    def __init__(self, collection):
+        self.db = collection
+        self.loaded = {}
+        self._writes = WriteBuffer(collection, upsert=True)
+
+
+    def load(self, urls):
+        '''Reads the stored validators for all the URLs at once.'''
+        found = {url: {} for url in urls}
+        for doc in self.db.find({'_id': {'$in': urls}}):
+            found[doc['_id']] = doc
+        self.loaded.update(found)
+
+
+    def headers(self, url):
+        '''Returns a dict of conditional request headers for the URL.  The
+        dict is empty if we have nothing stored for it.'''
+        # Validators not written yet are the newest, then those read ahead
+        # by load(), and the database is asked only if it's neither.
+        found = self._writes.pending(url)
+        if found == None:
+            found = self.loaded.get(url)
+        if found == None:
+            found = self.db.find_one({'_id': url})
+        headers = {}
+        if found and found.get('etag'):
+            headers['If-None-Match'] = found['etag']
+        if found and found.get('last_modified'):
+            headers['If-Modified-Since'] = found['last_modified']
+        return headers
+
+
+    def store(self, url, headers):
+        '''Records the validators found in the response 'headers'.'''
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if not etag and not last_modified:
+            return
+        self._writes.update(url, {'etag': etag, 'last_modified': last_modified})
+
+
+    def flush(self):
+        '''Writes the validators that are still held in memory.'''
+        self._writes.flush()
+
+
+
+# Connection pools.
+# .............................................................................
+# Opening a new HTTPS connection for every request costs a TCP and TLS
+# handshake each time, which is a large part of the time needed for a single
+# small API call.  A ConnectionPool keeps idle keep-alive connections to one
+# host and reuses them.  The number of requests in flight to the host at any
+# one time (and thus the number of connections) is bounded by 'size'.
+#
+# Requests can be given a limit on the size of the body.  The body is then
+# read and decoded a piece at a time, and reading stops as soon as the limit
+# is passed, so that a huge file doesn't have to be downloaded (and held in
+# memory) only to be thrown away.
+
+class PooledResponse():
+    def __init__(self, status, headers, body, text=None, truncated=False):
+        # For requests made with a size limit, 'body' is None and the
+        # decoded body is in 'text', or is None if 'truncated' is True.
+        self.status    = status
+        self.headers   = headers
+        self.body      = body
+        self.truncated = truncated
+        self._text     = text
+
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+
+    def text(self):
+        # Like requests' Response.text, but defaults to UTF-8.
+        if self.body == None:
+            return self._text
+        return self.body.decode(response_charset(self.headers), errors='replace')
+
+
+class ConnectionPool():
+    _timeout_sec = 15
+    _chunk_size  = 65536
+
+
+    def __init__(self, host, size=8, secure=True):
+        self.host    = host
+        self._secure = secure
+        self._idle   = queue.LifoQueue()
+        self._slots  = threading.BoundedSemaphore(size)
+
+
+    def request(self, method, path, headers=None, body=None, max_size=None):
+        '''Performs the request and returns a PooledResponse object, with the
+        body already read (and decompressed, if the server used gzip).  If
+        'max_size' is given, the body is decoded to text as it is read, and
+        if it turns out to be bigger than 'max_size' bytes, reading stops
+        and the response is marked as truncated.'''
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', 'gzip')
+        with self._slots:
+            (conn, reused) = self._connection()
+            try:
+                response = self._send(conn, method, path, headers, body)
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if not reused:
+                    raise
+                # The server may have closed an idle keep-alive connection
+                # on its end.  Try again with a fresh connection.
+                (conn, _) = self._connection(fresh=True)
+                try:
+                    response = self._send(conn, method, path, headers, body)
+                except Exception:
+                    conn.close()
+                    raise
+            (text, truncated) = (None, False)
+            try:
+                if max_size == None:
+                    body = response.read()
+                else:
+                    body = None
+                    (text, truncated) = self._read_text(response, max_size)
+            except Exception:
+                conn.close()
+                raise
+            if response.will_close or truncated:
+                # A truncated response leaves unread data on the connection.
+                conn.close()
+            else:
+                self._idle.put(conn)
+        if body != None and response.getheader('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return PooledResponse(response.status, response.headers, body,
+                              text, truncated)
+
+
+    def _read_text(self, response, max_size):
+        # Returns a tuple (text, truncated).  The size limit applies to the
+        # decompressed body, and decompression never produces more than one
+        # byte beyond the limit, so a small compressed body can't blow up.
+        length = response.getheader('Content-Length')
+        gzipped = response.getheader('Content-Encoding') == 'gzip'
+        if not gzipped and length and length.isdigit() and int(length) > max_size:
+            return (None, True)
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+        decoder  = codecs.getincrementaldecoder(response_charset(response.headers))
+        decoder  = decoder(errors='replace')
+        pieces   = []
+        size     = 0
+        while True:
+            data = response.read(self._chunk_size)
+            if inflater:
+                if not data and not inflater.unconsumed_tail:
+                    break
+                data = inflater.decompress(inflater.unconsumed_tail + data,
+                                           max_size - size + 1)
+            elif not data:
+                break
+            size += len(data)
+            if size > max_size:
+                return (None, True)
+            pieces.append(decoder.decode(data))
+        pieces.append(decoder.decode(b'', True))
+        return (''.join(pieces), False)
+
+
+    def _send(self, conn, method, path, headers, body):
+        conn.request(method, path, body=body, headers=headers)
+        return conn.getresponse()
+
+
+    def _connection(self, fresh=False):
+        # Returns a tuple (connection, reused).
+        if not fresh:
+            try:
+                return (self._idle.get_nowait(), True)
+            except queue.Empty:
+                pass
+        if self._secure:
+            conn = http.client.HTTPSConnection(self.host, timeout=self._timeout_sec)
+        else:
+            conn = http.client.HTTPConnection(self.host, timeout=self._timeout_sec)
+        return (conn, False)
+
+
+def response_charset(headers):
+    '''Returns the character set named in the Content-Type header, or UTF-8
+    if there is none or it is one that Python doesn't know.'''
+    content_type = headers.get('Content-Type', '')
+    if 'charset=' not in content_type:
+        return 'utf-8'
+    charset = content_type.split('charset=')[-1].split(';')[0].strip().strip('"')
+    try:
+        codecs.lookup(charset)
+        return charset
+    except LookupError:
+        return 'utf-8'
+
+
+def url_host_path(url, default_host='api.github.com'):
+    '''Splits a URL into a tuple of (host, path), where the path includes
+    the query string, if any.'''
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    return (parts.netloc or default_host, path)
+
+
+# Retries and circuit breakers.
+# .............................................................................
+# When a request fails for reasons that may be temporary (network errors,
+# 5xx responses, 429 Too Many Requests), we wait a little and try again.
+# RetryPolicy computes the waits: exponential backoff with random jitter, so
+# that many threads don't all come back at the same moment, and never less
+# than what the server asked for in a Retry-After header.
+#
+# A CircuitBreaker tracks the health of one host.  After enough consecutive
+# failures, the circuit "opens" and requests to the host fail right away with
+# HostUnavailableException, instead of each one going through its own
+# retries.  After a cooldown period, one trial request is let through; if it
+# succeeds the circuit closes again, and if not, it stays open for longer.
+# Callers can use the exception to put off work that needs the host while
+# carrying on with work that doesn't.  The breakers are shared by everything
+# in this process, via circuit_breaker().
+
+class HostUnavailableException(Exception):
+    def __init__(self, host, until):
+        message = '{} unavailable for {:.0f}s'.format(host, max(0, until - time()))
+        super(HostUnavailableException, self).__init__(message)
+        self.host  = host
+        self.until = until
+
+
+class RetryPolicy():
+    def __init__(self, base_sec=0.5, max_sec=60, tries=4):
+        self.base_sec = base_sec
+        self.max_sec  = max_sec
+        self.tries    = tries
+
+
+    def delay(self, attempt, retry_after=None):
+        '''Returns the number of seconds to wait after failed attempt number
+        'attempt' (counting from 0).'''
+        ceiling = min(self.max_sec, self.base_sec * (2 ** attempt))
+        delay = ceiling/2 + random.uniform(0, ceiling/2)
+        if retry_after:
+            delay = max(delay, retry_after)
+        return delay
+
+
+    def pause(self, attempt, retry_after=None):
+        sleep(self.delay(attempt, retry_after))
+
+
+class CircuitBreaker():
+    _threshold        = 5
+    _cooldown_sec     = 30
+    _max_cooldown_sec = 900
+    _trial_sec        = 60
+
+
+    def __init__(self, host):
+        self.host      = host
+        self._lock     = threading.Lock()
+        self._failures = 0
+        self._opened   = 0
+        self._until    = 0
+        self._trial    = 0
+
+
+    def allow(self):
+        '''Returns True if a request to the host may go ahead now.'''
+        with self._lock:
+            if self._failures < self._threshold:
+                return True
+            now = time()
+            if now < self._until or now - self._trial < self._trial_sec:
+                return False
+            # Half-open: let this one request through as a trial.
+            self._trial = now
+            return True
+
+
+    def until(self):
+        '''Returns the time at which the next trial request may be made.'''
+        with self._lock:
+            return max(self._until, self._trial + self._trial_sec)
+
+
+    def success(self):
+        with self._lock:
+            if self._opened:
+                msg('Requests to {} are working again'.format(self.host))
+            self._failures = 0
+            self._opened   = 0
+            self._trial    = 0
+
+
+    def failure(self, retry_after=None):
+        with self._lock:
+            self._failures += 1
+            self._trial = 0
+            if self._failures < self._threshold:
+                return
+            cooldown = min(self._max_cooldown_sec,
+                           self._cooldown_sec * (2 ** self._opened))
+            if retry_after:
+                cooldown = max(cooldown, retry_after)
+            self._until = time() + cooldown
+            self._opened += 1
+        msg('*** Too many failures for {} -- holding off for {:.0f}s'.format(
+            self.host, cooldown))
+
+
+_breakers      = {}
+_breakers_lock = threading.Lock()
+
+def circuit_breaker(host):
+    '''Returns the CircuitBreaker for the host, shared by the whole process.'''
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host)
+        return _breakers[host]
+
+
+def retry_after(headers):
+    '''Returns the number of seconds asked for by a Retry-After header, or
+    None if there is no such header.'''
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+def server_trouble(status, headers):
+    '''Returns True if a response status means the server is (perhaps
+    temporarily) unable or unwilling to answer, as opposed to an answer.'''
+    if status == 429 or status >= 500:
+        return True
+    # GitHub's abuse detection uses 403 with a Retry-After header.
+    return status == 403 and headers.get('Retry-After') != None
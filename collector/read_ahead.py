@@ -0,0 +1,97 @@
+#!/usr/bin/env python3.4
+#
+# @file    read_ahead.py
+# @brief   Database cursor that reads the next batch in the background.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+import os
+import queue
+import sys
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
+from utils import *
+
+
+# Summary
+# .............................................................................
+# A plain Mongo cursor fetches the next batch of documents only when the
+# current one has been used up, so the loop over entries stalls on a round
+# trip to the server every batch.  ReadAheadCursor iterates the cursor on a
+# background thread and hands over whole batches through a small queue, so
+# the next batch is usually in memory by the time the caller needs it.  The
+# queue holds at most 'depth' batches, which bounds the memory used.
+#
+# Only the background thread touches the underlying cursor, since pymongo
+# cursors must not be shared between threads.
+
+class ReadAheadCursor():
+    _put_timeout_sec = 1
+
+
+    def __init__(self, cursor, batch_size=1000, depth=2):
+        self._cursor     = cursor.batch_size(batch_size)
+        self._batch_size = batch_size
+        self._queue      = queue.Queue(maxsize=depth)
+        self._stop       = threading.Event()
+        self._thread     = None
+
+
+    def __iter__(self):
+        if self._thread:
+            raise RuntimeError('ReadAheadCursor can only be iterated once')
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+        try:
+            while True:
+                batch = self._queue.get()
+                if batch == None:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield from batch
+        finally:
+            # The caller may stop early, e.g., by breaking out of a loop.
+            self.close()
+
+
+    def close(self):
+        '''Stops the background reader.  The cursor is closed by the reader
+        thread itself.'''
+        self._stop.set()
+
+
+    def _read(self):
+        try:
+            batch = []
+            for doc in self._cursor:
+                if self._stop.is_set():
+                    return
+                batch.append(doc)
+                if len(batch) >= self._batch_size:
+                    self._put(batch)
+                    batch = []
+            if batch:
+                self._put(batch)
+            self._put(None)
+        except Exception as err:
+            self._put(err)
+        finally:
+            self._cursor.close()
+
+
+    def _put(self, item):
+        # Waits for room in the queue, but gives up if we've been stopped,
+        # since then nobody will be taking things off the queue.
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=self._put_timeout_sec)
+                return
+            except queue.Full:
+                continue
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3.4
+#
+# @file    readme_store.py
+# @brief   Storage format of README files in the database.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+import hashlib
+import os
+import sys
+import zlib
+from bson.binary import Binary
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
+from utils import *
+
+
+# Summary
+# .............................................................................
+# The 'readme' field of an entry holds either the text of the README file or
+# one of the codes -1 (no README) and -2 (too big to keep).  READMEs are the
+# bulk of the data in the repos collection, so they can also be stored
+# compressed, as a BSON binary value.  The binary subtype says how the value
+# was encoded; subtypes 0x80 and up are reserved by BSON for user-defined
+# purposes.  Currently the only encoding is UTF-8 text compressed with zlib.
+# Very short READMEs don't get any smaller that way, and are left as text.
+#
+# Code that reads the 'readme' field should pass the value through
+# readme_text(), which returns the text no matter how it was stored, and
+# leaves the numeric codes as they are.  (Or ReadmeStore.text(), if the
+# README may be stored in a ReadmeStore; see below.)
+
+ZLIB_SUBTYPE = 0x80
+
+_compress_level = 6
+
+
+def compress_readme(value):
+    '''Returns the value to store in the 'readme' field for 'value'.  Text
+    is compressed, unless that doesn't make it any smaller; anything else
+    (e.g., -1 or -2) is returned unchanged.'''
+    if not isinstance(value, str) or not value:
+        return value
+    data = value.encode('utf-8')
+    compressed = zlib.compress(data, _compress_level)
+    if len(compressed) >= len(data):
+        return value
+    return Binary(compressed, ZLIB_SUBTYPE)
+
+
+def is_compressed(value):
+    return isinstance(value, Binary) and value.subtype == ZLIB_SUBTYPE
+
+
+def readme_text(value):
+    '''Returns the text of a README stored in the form returned by
+    compress_readme(), or 'value' itself if it isn't compressed.'''
+    if is_compressed(value):
+        return zlib.decompress(value).decode('utf-8')
+    return value
+
+
+# Content-addressed storage.
+# .............................................................................
+# Forks and repositories made from templates often have exactly the same
+# README file.  A ReadmeStore keeps one copy of each distinct README in a
+# separate collection, keyed by the SHA-1 hash of its UTF-8 text, and the
+# 'readme' field of an entry then holds only {'blob': <hash>}.  Results
+# computed from the text alone, such as the language it's written in, can
+# be stored along with the text, so that they are computed once per
+# distinct README instead of once per entry.
+#
+# The hashes of blobs known to be in the collection are remembered, so that
+# storing a README we've seen before costs no database access at all.
+
+class ReadmeStore():
+    _max_known = 1000000
+
+
+    def __init__(self, collection):
+        self.db     = collection
+        self._known = set()
+
+
+    def put(self, text, compress=False):
+        '''Stores the README 'text' if it isn't stored already, and returns
+        the value to put in an entry's 'readme' field.'''
+        key = readme_hash(text)
+        if key not in self._known:
+            self.db.update_one({'_id': key},
+                               {'$setOnInsert': {'readme': compress_readme(text)
+                                                 if compress else text}},
+                               upsert=True)
+            if len(self._known) >= self._max_known:
+                self._known.clear()
+            self._known.add(key)
+        return {'blob': key}
+
+
+    def text(self, value):
+        '''Returns the text of the README for the value of a 'readme' field,
+        in any of the forms it can be stored in.  A reference to a blob
+        that can't be found is treated like a missing README.'''
+        if is_blob_ref(value):
+            found = self.db.find_one({'_id': value['blob']}, {'readme': 1})
+            return readme_text(found['readme']) if found else None
+        return readme_text(value)
+
+
+    def cached(self, value, field):
+        '''Returns a tuple (found, result), where 'result' is the value
+        stored for 'field' with the blob, if 'value' refers to a blob and
+        something was stored for it.'''
+        if not is_blob_ref(value):
+            return (False, None)
+        found = self.db.find_one({'_id': value['blob']}, {field: 1})
+        if not found or field not in found:
+            return (False, None)
+        return (True, found[field])
+
+
+    def cache(self, value, field, result):
+        '''Stores 'result' for 'field' with the blob, if 'value' refers to
+        a blob.'''
+        if is_blob_ref(value):
+            self.db.update_one({'_id': value['blob']}, {'$set': {field: result}})
+
+
+def is_blob_ref(value):
+    return isinstance(value, dict) and 'blob' in value
+
+
+def readme_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
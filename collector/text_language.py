@@ -0,0 +1,194 @@
+#!/usr/bin/env python3.4
+#
+# @file    text_language.py
+# @brief   Guess the human language of README files and descriptions.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+import html
+import langid
+import multiprocessing
+import re
+
+
+# Summary
+# .............................................................................
+# Stripping markup and running langid take far more time than getting the
+# text out of the database, and all of it is CPU-bound Python.
+# TextLanguagePool does it in a pool of processes, so that more than one
+# core can work on it.  Work is handed over in batches of (kind, text)
+# pairs, where 'kind' is 'readme' or 'description', and the results come
+# back in the same order.
+#
+# The functions here are also used directly when there's no pool.
+
+min_readme_length = 125
+min_description_length = 60
+
+
+# Markup removal.
+# .............................................................................
+# langid only needs the words, so markup is taken out with regular
+# expressions, a line at a time, instead of parsing the text into a tree
+# (as BeautifulSoup does) or turning Markdown into HTML first (as the
+# markdown module does).  The result has the same words as stripping the
+# HTML from the output of markdown.markdown() with BeautifulSoup, which is
+# how it used to be done, except that reStructuredText and Textile markup
+# is taken out too.  Text with any HTML tags in it is treated as HTML only,
+# as before, but URLs in angle brackets (which both Markdown and RST use)
+# no longer count as tags.
+
+_html_tag      = re.compile(r'<[a-zA-Z][^\t\n\r\f />\x00:]*(?:[\s/][^>]*)?>')
+_html_comment  = re.compile(r'<!--(.*?)-->', re.S)
+_html_doctype  = re.compile(r'<!doctype\s+([^\s>]*)[^>]*>', re.I)
+_html_markup   = re.compile(r'<[a-zA-Z/!?][^>]*>')
+
+_md_heading    = re.compile(r'^ {0,3}#{1,6}[ \t]*(.*?)[ \t]*#*[ \t]*$')
+_md_quote      = re.compile(r'^ {0,3}(?:> ?)+')
+_md_list_item  = re.compile(r'^ {0,3}(?:[*+-]|\d+\.)[ \t]+')
+_md_link_def   = re.compile(r'^ {0,3}\[[^\]]+\]:[ \t]*\S+.*$')
+_md_image      = re.compile(r'!\[[^\]]*\]\s*(?:\([^)]*\)|\[[^\]]*\])')
+_md_link       = re.compile(r'\[([^\]]*)\]\s*(?:\([^)]*\)|\[[^\]]*\])')
+_md_escape     = re.compile(r'\\([\\`*_{}\[\]()#+\-.!])')
+_md_underscore = re.compile(r'(?<!\w)_+|_+(?!\w)')
+_md_autolink   = re.compile(r'<([a-zA-Z][\w+.-]*:[^\s<>]*)>')
+
+_rule_line     = re.compile(r'^[ \t]*([=\-`:\'"~^_*+#<>.])(?:[ \t]*\1){2,}[ \t]*$')
+
+_rst_directive = re.compile(r'^ *\.\. +[\w-]+::[ \t]*(?:\S*[ \t]*$)?')
+_rst_target    = re.compile(r'^ *\.\. +(?:_[^:]+:|\|[^|]+\|).*$')
+_rst_option    = re.compile(r'^ +:[\w-]+:.*$')
+_rst_role      = re.compile(r':[\w-]+:`([^`]*?)(?:\s*<[^>]*>)?`')
+_rst_link      = re.compile(r'`([^`<]*?)\s*<[^>]*>`__?')
+_rst_ref       = re.compile(r'`([^`]+)`__?|\b(\w+)__?(?!\w)')
+
+_tx_block      = re.compile(r'^(?:h[1-6]|p|bq|bc|pre|fn\d+)(?:\([^)]*\))?\.\.? ')
+_tx_link       = re.compile(r'"([^"]+)":\S+')
+_tx_image      = re.compile(r'!(?:\([^)]*\))?[^\s!]+!(?::\S+)?')
+
+
+def guess_html(text):
+    '''Returns True if there is an HTML start tag anywhere in the text.'''
+    return bool(_html_tag.search(text))
+
+
+def remove_html(text):
+    '''Returns the text without HTML tags, keeping the text of comments.'''
+    text = _html_comment.sub(r'\1', text)
+    text = _html_doctype.sub(r'\1', text)
+    return html.unescape(_html_markup.sub('', text))
+
+
+def remove_markup(text):
+    '''Returns the words of a README or similar text, without HTML, Markdown,
+    reStructuredText or Textile markup.'''
+    if guess_html(text):
+        return remove_html(text)
+    return html.unescape('\n'.join(_plain_lines(text.splitlines())))
+
+
+def _plain_lines(lines):
+    literal = False
+    for line in lines:
+        if not line.strip():
+            yield ''
+            continue
+        indented = line.startswith(('    ', '\t'))
+        if indented and (literal or not _md_list_item.match(line.lstrip())):
+            # Indented code.  Markdown leaves it alone.
+            literal = True
+            yield line.replace('`', '')
+            continue
+        literal = False
+        if (_rule_line.match(line) or _md_link_def.match(line)
+                or _rst_target.match(line) or _rst_option.match(line)):
+            continue
+        # Directives such as '.. note::' may be followed by text, but an
+        # argument on its own is a URL or file name, as in '.. image::'.
+        line = _rst_directive.sub('', line)
+        if not line.strip():
+            continue
+        line = _md_heading.sub(r'\1', line)
+        line = _md_quote.sub('', line)
+        line = _md_list_item.sub('', line)
+        line = _tx_block.sub('', line)
+        line = _md_image.sub('', line)
+        line = _md_link.sub(r'\1', line)
+        line = _rst_role.sub(r'\1', line)
+        line = _rst_link.sub(r'\1', line)
+        line = _md_autolink.sub(r'\1', line)
+        line = _rst_ref.sub(lambda m: m.group(1) or m.group(2), line)
+        line = _tx_image.sub('', line)
+        line = _tx_link.sub(r'\1', line)
+        line = line.replace('`', '').replace('*', '')
+        line = _md_underscore.sub('', line)
+        line = _md_escape.sub(r'\1', line)
+        yield line
+
+
+def readme_language(readme):
+    '''Returns the language code for the text of a README file, or None if
+    there's too little text to go by.'''
+    if not readme or isinstance(readme, int):
+        return None
+    if not isinstance(readme, str):
+        readme = readme.decode().encode('ascii', 'ignore').decode()
+    readme = remove_markup(readme)
+    if len(readme) > min_readme_length:
+        lang, _ = langid.classify(readme)
+        return lang
+    return None
+
+
+def description_language(description):
+    '''Returns the language code for a repository description, or None if
+    it's too short to go by.'''
+    if not isinstance(description, str):
+        description = description.decode().encode('ascii', 'ignore').decode()
+    if guess_html(description):
+        description = remove_html(description)
+    if len(description) > min_description_length:
+        lang, _ = langid.classify(description)
+        return lang
+    return None
+
+
+def text_language(kind, text):
+    if kind == 'readme':
+        return readme_language(text)
+    return description_language(text)
+
+
+def text_languages(batch):
+    return [text_language(kind, text) for (kind, text) in batch]
+
+
+def _start_worker():
+    # langid loads its model the first time it's used.  Do it now, once
+    # per process, rather than in the middle of the first batch.
+    langid.classify('')
+
+
+class TextLanguagePool():
+    '''Pool of processes that run text_language() on batches of work.  The
+    processes are forked, so the pool should be made before the caller
+    starts any threads of its own.'''
+
+    def __init__(self, processes):
+        self._pool = multiprocessing.Pool(processes, initializer=_start_worker)
+
+
+    def submit(self, batch):
+        '''Starts work on a list of (kind, text) pairs, and returns an object
+        whose get() method returns the list of results when they're done.'''
+        return self._pool.apply_async(text_languages, (batch,))
+
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3.4
+#
+# @file    write_buffer.py
+# @brief   Buffering of database updates, written in bulk.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+import os
+import sys
+import threading
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, ConnectionFailure
+from time import time, sleep
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
+from utils import *
+
+
+# Summary
+# .............................................................................
+# Each update to an entry used to be a separate round trip to the database
+# server.  WriteBuffer collects $set and $addToSet updates instead, merging
+# all the updates to a given _id into a single operation, and sends them to
+# Mongo with one bulk_write() call when enough entries have accumulated or
+# enough time has passed since the oldest pending update.  Callers must
+# call flush() when they are done, so that nothing is left behind.
+#
+# Updates to different entries are independent, so the bulk writes are
+# unordered.  Updates to the same entry keep their order, because they are
+# merged in the order they arrive, and flushes are done one at a time.
+#
+# A timer also flushes the buffer once the oldest pending update is old
+# enough, in case no more updates come along to do it.  If the database
+# can't be reached (AutoReconnect, NetworkTimeout and the like), a bulk write
+# is tried a few more times.  If it still fails, its updates are kept, to
+# be written ahead of any newer ones by the next flush, and the error is
+# raised.  Updates that Mongo rejects (BulkWriteError) are not kept.
+
+class WriteBuffer():
+    _tries     = 3
+    _retry_sec = 1
+
+    def __init__(self, collection, batch_size=500, interval=10, upsert=False):
+        self.db          = collection
+        self.batch_size  = batch_size
+        self.interval    = interval
+        self.upsert      = upsert
+        self._lock       = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending    = {}
+        self._unwritten  = []
+        self._oldest     = None
+        self._timer      = None
+
+
+    def update(self, id, set_fields=None, add_fields=None):
+        '''Queues an update for the entry with the given _id.  'set_fields'
+        is a dict of values for $set, and 'add_fields' is a dict of values
+        for $addToSet.'''
+        set_fields = set_fields or {}
+        add_fields = add_fields or {}
+        if not set_fields and not add_fields:
+            return
+        with self._lock:
+            op = self._pending.get(id)
+            if op and self._conflicts(op, set_fields, add_fields):
+                # Mongo rejects an update that touches the same field (or a
+                # field and one of its subfields) with more than one
+                # operator, so the earlier update has to be written first.
+                full = True
+            else:
+                full = False
+                self._merge(id, set_fields, add_fields)
+        if full:
+            self.flush()
+            self.update(id, set_fields, add_fields)
+        elif self._due():
+            self.flush()
+
+
+    def pending(self, id):
+        '''Returns the $set values still waiting to be written for the entry
+        with the given _id, or None if there are none.'''
+        with self._lock:
+            for batch in [self._pending] + self._unwritten[::-1]:
+                if id in batch:
+                    return dict(batch[id]['set'])
+        return None
+
+
+    def flush(self):
+        '''Writes all pending updates to the database.'''
+        with self._flush_lock:
+            with self._lock:
+                batches = [p for p in self._unwritten + [self._pending] if p]
+                self._unwritten = []
+                self._pending = {}
+                self._oldest = None
+            for (index, pending) in enumerate(batches):
+                try:
+                    self._write(pending)
+                except BulkWriteError:
+                    self._keep(batches[index + 1:])
+                    raise
+                except ConnectionFailure as err:
+                    msg('*** Keeping {} database updates for later: {}'.format(
+                        sum(len(p) for p in batches[index:]), err))
+                    self._keep(batches[index:])
+                    raise
+
+
+    def _write(self, pending):
+        ops = []
+        for (id, op) in pending.items():
+            update = {}
+            if op['set']:
+                update['$set'] = op['set']
+            if op['add']:
+                update['$addToSet'] = {field: {'$each': values}
+                                       for (field, values) in op['add'].items()}
+            ops.append(UpdateOne({'_id': id}, update, upsert=self.upsert))
+        for attempt in range(0, self._tries):
+            try:
+                self.db.bulk_write(ops, ordered=False)
+                return
+            except BulkWriteError as err:
+                msg('*** {} of {} database updates failed: {}'.format(
+                    len(err.details.get('writeErrors', [])), len(ops),
+                    err.details.get('writeErrors', [])[:3]))
+                raise
+            except ConnectionFailure:
+                # The updates only set values, so writing them again is safe.
+                if attempt + 1 >= self._tries:
+                    raise
+                sleep(self._retry_sec * 2 ** attempt)
+
+
+    def _keep(self, batches):
+        # Puts back updates that couldn't be written, ahead of any that
+        # arrived in the meantime, and has the timer try them again later.
+        if not batches:
+            return
+        with self._lock:
+            self._unwritten = batches + self._unwritten
+            self._oldest = time()
+            self._start_timer(self.interval)
+
+
+    def _start_timer(self, delay):
+        # Must be called with self._lock held.
+        if self._timer == None:
+            self._timer = threading.Timer(max(0, delay), self._timer_done)
+            self._timer.daemon = True
+            self._timer.start()
+
+
+    def _timer_done(self):
+        with self._lock:
+            self._timer = None
+            if self._oldest == None:
+                return
+            left = self._oldest + self.interval - time()
+            if left > 0:
+                self._start_timer(left)
+                return
+        try:
+            self.flush()
+        except Exception as err:
+            msg('*** Timed flush of database updates failed: {}'.format(err))
+
+
+    def _merge(self, id, set_fields, add_fields):
+        # Must be called with self._lock held.
+        if id not in self._pending:
+            self._pending[id] = {'set': {}, 'add': {}}
+            if self._oldest == None:
+                self._oldest = time()
+                self._start_timer(self.interval)
+        op = self._pending[id]
+        op['set'].update(set_fields)
+        for (field, value) in add_fields.items():
+            values = op['add'].setdefault(field, [])
+            if value not in values:
+                values.append(value)
+
+
+    def _conflicts(self, op, set_fields, add_fields):
+        # True if merging the new fields into 'op' would make one update
+        # touch overlapping fields with different operators, or a field
+        # along with one of its own subfields.
+        def overlap(a, b):
+            return a == b or a.startswith(b + '.') or b.startswith(a + '.')
+        for field in set_fields:
+            if any(overlap(field, f) for f in op['add']):
+                return True
+            if any(overlap(field, f) and field != f for f in op['set']):
+                return True
+        for field in add_fields:
+            if any(overlap(field, f) for f in op['set']):
+                return True
+        return False
+
+
+    def _due(self):
+        with self._lock:
+            if len(self._pending) >= self.batch_size:
+                return True
+            return self._oldest != None and time() - self._oldest >= self.interval
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3.4
+#
+# @file    benchmark_content_inferencer.py
+# @brief   Benchmark of content_type inference on synthetic entries.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+#
+# Run this from the tests directory:
+#
+#    ./benchmark_content_inferencer.py        compare against the saved baseline
+#    ./benchmark_content_inferencer.py -u     save the current numbers as baseline
+#
+# It needs no network access or database.  It makes a fixed set of entries
+# with files lists and languages that look roughly like the ones in our
+# database (including forks that have the same lists as their parents), and
+# reports the number of entries per second that classify() gets
+# through, with and without the file names it remembers from earlier calls,
+# along with the rate of the old way of testing one file at a time.
+#
+# As in benchmark_github_html.py, timings are divided by the time taken for
+# a fixed amount of pure-Python work before being compared to the baseline,
+# and the script exits with a nonzero status if any number is worse than
+# the baseline by more than the tolerance factor.
+
+import json
+import os
+import plac
+import random
+import sys
+import timeit
+
+sys.path.append('../collector')
+
+import content_inferencer
+from content_inferencer import *
+
+
+# Constants.
+# .............................................................................
+
+baseline_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'benchmark_content_inferencer.json')
+
+_num_entries = 20000
+_fork_fraction = 0.3
+_repeats = 5
+_min_time_sec = 0.2
+
+
+# Main program.
+# .............................................................................
+
+def main(update=False, tolerance=1.5):
+    '''Benchmark content_type inference on synthetic entries.'''
+    tolerance = float(tolerance)
+    entries = make_entries(_num_entries)
+    unit = best_time(calibration)
+
+    results = {}
+    for (name, function) in [('one file at a time', lambda: guess_each(entries)),
+                             ('classify cold',      lambda: classify_cold(entries)),
+                             ('classify warm',      lambda: classify_each(entries))]:
+        elapsed = best_time(function)
+        results[name] = elapsed / unit
+        msg('{:<20} {:10.0f} entries/sec'.format(name, len(entries)/elapsed))
+
+    if update:
+        with open(baseline_file, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+        msg('Saved baseline in {}'.format(baseline_file))
+        return
+
+    if not os.path.exists(baseline_file):
+        raise SystemExit('No baseline in {} -- run with -u first'.format(baseline_file))
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    slower = []
+    for (name, value) in sorted(results.items()):
+        if name in baseline and value > baseline[name] * tolerance:
+            slower.append('{} is {:.1f} times the baseline'.format(
+                name, value/baseline[name]))
+    if slower:
+        for line in slower:
+            msg('*** ' + line)
+        raise SystemExit(1)
+    msg('No regressions beyond {} times the baseline.'.format(tolerance))
+
+
+# Helpers.
+# .............................................................................
+
+def make_entries(count):
+    # Common names are much more common than rare ones, as in real repos.
+    rand = random.Random(1)
+    names = ['README.md', 'LICENSE', '.gitignore', 'index.html', 'src/',
+             'docs/', 'package.json', 'Makefile', 'setup.py', 'main.go']
+    names += ['file{}.{}'.format(n, ext) for n in range(20)
+              for ext in code_file_extensions + noncode_file_extensions]
+    langs = sorted(content_inferencer.lang_names)
+    entries = []
+    for _ in range(count):
+        if entries and rand.random() < _fork_fraction:
+            parent = rand.choice(entries)
+            entries.append({'files': list(parent['files']),
+                            'languages': list(parent['languages'])})
+            continue
+        files = set(names[int(len(names) ** rand.random()) - 1]
+                    for _ in range(rand.randint(1, 40)))
+        languages = [{'name': x} for x in rand.sample(langs, rand.randint(0, 3))]
+        entries.append({'files': sorted(files), 'languages': languages})
+    return entries
+
+
+def guess_each(entries):
+    # As infer_type used to do it, looking up each file in the lists.
+    def is_code(name):
+        return (name.split('.')[-1].lower() in code_file_extensions
+                or name.lower() in code_files)
+
+    def is_noncode(name):
+        return (name.split('.')[-1].lower() in noncode_file_extensions
+                or name.lower() in noncode_files)
+
+    for entry in entries:
+        if any(is_code(f) for f in entry['files']):
+            continue
+        if all(is_noncode(f) for f in entry['files']):
+            continue
+        any(known_code_lang(lang['name']) for lang in entry['languages'])
+
+
+def classify_each(entries):
+    for entry in entries:
+        classify(entry['files'], entry['languages'])
+
+
+def classify_cold(entries):
+    file_kind.cache_clear()
+    classify_each(entries)
+
+
+def calibration():
+    # Fixed work of roughly the same kind as classifying files.
+    table = {'file{}.c'.format(n): n for n in range(1000)}
+    for n in range(20000):
+        'FILE{}.C'.format(n % 2000).lower().split('.')[-1] in table
+
+
+def best_time(function):
+    # Best of several runs, each one repeating 'function' for long enough
+    # to get a usable measurement.
+    timer = timeit.Timer(function)
+    number = max(1, int(_min_time_sec / max(timer.timeit(1), 1e-6)))
+    return min(timer.repeat(_repeats, number)) / number
+
+
+def msg(text):
+    print(text, flush=True)
+
+
+# Plac annotations for main function arguments
+# .............................................................................
+# Argument annotations are: (help, kind, abbrev, type, choices, metavar)
+# Plac automatically adds a -h argument for help, so no need to do it here.
+
+main.__annotations__ = dict(
+    update    = ('save the results as the new baseline',            'flag',   'u'),
+    tolerance = ('fail if worse than the baseline by this factor',  'option', 't'),
+)
+
+# Entry point
+# .............................................................................
+
+if __name__ == '__main__':
+    plac.call(main)
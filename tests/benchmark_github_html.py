@@ -0,0 +1,203 @@
+#!/usr/bin/env python3.4
+#
+# @file    benchmark_github_html.py
+# @brief   Benchmark of GitHub home page parsing, using the saved corpus.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+#
+# Run this from the tests directory:
+#
+#    ./benchmark_github_html.py        compare against the saved baseline
+#    ./benchmark_github_html.py -u     save the current numbers as baseline
+#
+# It needs no network access.  It reports the number of pages per second
+# that GitHubHomePage.set_html() gets through, the time taken to extract
+# each field on its own, and the peak memory used while parsing a page.
+# The time for a field is that of scan_home_page() getting only that field,
+# less the time it takes to get none of them, with the sweep for markers
+# done beforehand, since the sweep is the same whatever the fields are.
+#
+# Timings vary a lot from one computer to another, so they are compared
+# against the baseline after dividing by the time taken for a fixed amount
+# of pure-Python string work on the same computer.  Everything is timed in
+# several rounds, one after the other within each round, and the best time
+# of each is used, so that the reference work and the parsing are measured
+# under the same conditions.  The script exits with a nonzero status if any
+# number is worse than the baseline by more than the tolerance factor.  The
+# fields take little time compared to the whole page, so a field is only
+# counted as slower if it is also slower by more than a small fraction of
+# the time for the whole page.
+
+import glob
+import json
+import os
+import plac
+import re
+import sys
+import timeit
+import tracemalloc
+
+sys.path.append('../collector')
+
+from github_html import *
+
+
+# Constants.
+# .............................................................................
+
+corpus_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'corpus', 'github_html')
+
+baseline_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'benchmark_github_html.json')
+
+fields = ['description', 'homepage', 'languages', 'forked_from',
+          'default_branch', 'files', 'num_commits', 'num_branches',
+          'num_releases', 'num_contributors', 'licenses']
+
+_rounds = 15
+_min_time_sec = 0.02
+_field_floor = 0.02
+
+
+# Main program.
+# .............................................................................
+
+def main(update=False, tolerance=1.5):
+    '''Benchmark GitHub home page parsing on the saved corpus.'''
+    tolerance = float(tolerance)
+    pages = load_corpus()
+    scanned = [(owner, name, text, scan_markers(text))
+               for (owner, name, text) in pages]
+    tasks = {'unit': calibration,
+             'parse': lambda: parse_all(pages),
+             'none': lambda: extract_all(scanned, set())}
+    for field in fields:
+        tasks[field] = lambda field=field: extract_all(scanned, {field})
+    times = best_times(tasks)
+    unit = times['unit']
+
+    results = {}
+    total = times['parse']
+    results['parse'] = total / unit
+    msg('{} pages, {:.0f} pages/sec, {:.2f} ms per page'.format(
+        len(pages), len(pages)/total, 1000*total/len(pages)))
+    for field in fields:
+        elapsed = max(0, times[field] - times['none'])
+        results['field ' + field] = elapsed / unit
+        msg('  {:<17} {:8.3f} ms for the whole corpus'.format(field, 1000*elapsed))
+    peak = peak_memory(pages)
+    results['peak KB'] = peak / 1024
+    msg('Peak memory while parsing one page: {:.0f} KB'.format(peak/1024))
+
+    if update:
+        with open(baseline_file, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+        msg('Saved baseline in {}'.format(baseline_file))
+        return
+
+    if not os.path.exists(baseline_file):
+        raise SystemExit('No baseline in {} -- run with -u first'.format(baseline_file))
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    slower = []
+    floor = baseline.get('parse', 0) * _field_floor
+    for (name, value) in sorted(results.items()):
+        slack = floor if name.startswith('field ') else 0
+        if name in baseline and value > baseline[name] * tolerance + slack:
+            slower.append('{} is {:.1f} times the baseline'.format(
+                name, value/baseline[name]))
+    if slower:
+        for line in slower:
+            msg('*** ' + line)
+        raise SystemExit(1)
+    msg('No regressions beyond {} times the baseline.'.format(tolerance))
+
+
+# Helpers.
+# .............................................................................
+
+def load_corpus():
+    pages = []
+    for html_file in sorted(glob.glob(os.path.join(corpus_dir, '*.html'))):
+        with open(html_file, encoding='utf-8') as f:
+            text = f.read()
+        with open(html_file[:-len('.html')] + '.json', encoding='utf-8') as f:
+            expected = json.load(f)
+        pages.append((expected['owner'], expected['name'], text))
+    return pages
+
+
+def parse_all(pages):
+    for (owner, name, text) in pages:
+        page = GitHubHomePage()
+        page._owner = owner
+        page._name  = name
+        page.set_html(text)
+
+
+def extract_all(scanned, wanted):
+    for (owner, name, text, markers) in scanned:
+        scan_home_page(text, owner, name, wanted, markers)
+
+
+def peak_memory(pages):
+    # The largest peak over all pages, not counting the text of the page.
+    peak = 0
+    for (owner, name, text) in pages:
+        tracemalloc.start()
+        page = GitHubHomePage()
+        page._owner = owner
+        page._name  = name
+        page.set_html(text)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return peak
+
+
+def calibration():
+    # Fixed work of roughly the same kind as page parsing.
+    text = '<td class="content"><a href="/x/y/blob/master/file">file</a></td>\n' * 2000
+    for m in re.finditer('href="', text):
+        text.find('"', m.end())
+    text.split('\n')
+
+
+def best_times(tasks):
+    # 'tasks' is a dictionary of functions.  Returns a dictionary of the
+    # best time for each one over _rounds rounds, where each round runs
+    # every function in turn, enough times to get a usable measurement.
+    timers = {}
+    for (name, function) in tasks.items():
+        timer = timeit.Timer(function)
+        number = max(1, int(_min_time_sec / max(timer.timeit(1), 1e-6)))
+        timers[name] = (timer, number)
+    best = {}
+    for _ in range(_rounds):
+        for (name, (timer, number)) in timers.items():
+            elapsed = timer.timeit(number) / number
+            best[name] = min(elapsed, best.get(name, elapsed))
+    return best
+
+
+# Plac annotations for main function arguments
+# .............................................................................
+# Argument annotations are: (help, kind, abbrev, type, choices, metavar)
+# Plac automatically adds a -h argument for help, so no need to do it here.
+
+main.__annotations__ = dict(
+    update    = ('save the results as the new baseline',            'flag',   'u'),
+    tolerance = ('fail if worse than the baseline by this factor',  'option', 't'),
+)
+
+# Entry point
+# .............................................................................
+
+if __name__ == '__main__':
+    plac.call(main)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3.4
+#
+# @file    test_content_inferencer.py
+# @brief   Py.test testing code.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+import random
+import pytest
+import sys
+
+sys.path.append('../collector')
+
+from content_inferencer import *
+
+
+# The way infer_type used to make its guesses, one file at a time.
+
+def reference_guess(entry):
+    if entry['files'] != -1:
+        if any(is_code_file(f) for f in entry['files']):
+            return ('code', 'file names')
+        if all(is_noncode_file(f) for f in entry['files']):
+            return ('noncode', 'file names')
+    if entry['languages'] != -1:
+        if any(known_code_lang(lang['name']) for lang in entry['languages']):
+            return ('code', 'languages')
+    return (None, None)
+
+
+def random_entries(count):
+    rand = random.Random(1)
+    names = (code_files + noncode_files + ['Build.XML', 'README.md', 'src/',
+                                           'index.html', 'x.HTML', 'docs'])
+    names += ['file.' + ext for ext in code_file_extensions[::7]]
+    names += ['file.' + ext for ext in noncode_file_extensions[::5]]
+    langs = ['C', 'HTML', 'TeX', 'Markdown', 'Python', 'Unknown Language']
+    entries = []
+    for _ in range(count):
+        files = rand.sample(names, rand.randint(0, 6))
+        languages = [{'name': x} for x in rand.sample(langs, rand.randint(0, 2))]
+        entries.append({'files': -1 if rand.random() < 0.1 else files,
+                        'languages': -1 if rand.random() < 0.1 else languages})
+    return entries
+
+
+class TestClass:
+    def test_file_kind(self):
+        assert file_kind('main.c') == CODE_FILE
+        assert file_kind('README') == NONCODE_FILE
+        assert file_kind('index.html') == 0
+        # A code file name with a noncode extension.
+        assert file_kind('build.xml') == CODE_FILE | NONCODE_FILE
+
+    def test_classify(self):
+        assert classify(['README.md', 'LICENSE'], []) == ('noncode', 'file names')
+        assert classify(['README.md', 'main.py'], []) == ('code', 'file names')
+        assert classify(['index.html'], [{'name': 'C'}]) == ('code', 'languages')
+        assert classify(-1, [{'name': 'TeX'}]) == (None, None)
+        assert classify(-1, -1) == (None, None)
+
+    def test_classify_matches_reference(self):
+        entries = random_entries(5000)
+        for entry in entries:
+            assert classify(entry['files'], entry['languages']) == reference_guess(entry)
+        # Again, now that the file names are remembered.
+        for entry in entries:
+            assert classify(entry['files'], entry['languages']) == reference_guess(entry)
+
+    def test_classify_expression_matches_classify(self):
+        mongomock = pytest.importorskip('mongomock')
+        entries = random_entries(500)
+        results = {('code', 'file names'): 1, ('noncode', 'file names'): 2,
+                   ('code', 'languages'): 3}
+        collection = mongomock.MongoClient().db.repos
+        collection.insert_many([dict(e, _id=n) for (n, e) in enumerate(entries)])
+        found = collection.aggregate([
+            {'$project': {'guess': classify_expression(results)}},
+            {'$sort': {'_id': 1}}])
+        assert [doc['guess'] for doc in found] == \
+            [results.get(classify(e['files'], e['languages'])) for e in entries]
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3.4
+#
+# @file    test_github_graphql.py
+# @brief   Py.test testing code.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+import http.server
+import json
+import pytest
+import sys
+import threading
+
+sys.path.append('../collector')
+
+from github_net import TokenPool
+from github_graphql import *
+
+
+# Stand-in for GitHub's GraphQL endpoint.  It answers every query with the
+# data in 'repos' (keyed by "owner/name"), and records the queries it got.
+
+repos = {
+    'alice/tool': {
+        'databaseId': 101, 'name': 'tool', 'owner': {'login': 'alice'},
+        'description': 'A tool', 'homepageUrl': 'http://tool.org',
+        'isPrivate': False, 'isFork': False, 'parent': None,
+        'defaultBranchRef': {'name': 'master'},
+        'primaryLanguage': {'name': 'C'},
+        'languages': {'edges': [{'size': 900, 'node': {'name': 'C'}},
+                                {'size': 10, 'node': {'name': 'Shell'}}]},
+        'licenseInfo': {'name': 'MIT License'},
+        'createdAt': '2015-01-02T03:04:05Z',
+        'updatedAt': '2016-01-02T03:04:05Z',
+        'pushedAt': '2016-02-02T03:04:05Z',
+        'readme0': None,
+        'readme1': None, 'readme2': None, 'readme3': None,
+        'readme4': {'text': 'Plain readme', 'byteSize': 12, 'isBinary': False},
+        'readme5': {'text': 'Text readme', 'byteSize': 11, 'isBinary': False},
+    },
+    'bob/tool': {
+        'databaseId': 202, 'name': 'tool', 'owner': {'login': 'bob'},
+        'description': None, 'homepageUrl': None,
+        'isPrivate': False, 'isFork': True,
+        'parent': {'nameWithOwner': 'carol/tool',
+                   'parent': {'nameWithOwner': 'alice/tool', 'parent': None}},
+        'defaultBranchRef': None, 'primaryLanguage': None,
+        'languages': {'edges': []}, 'licenseInfo': None,
+        'createdAt': '2015-01-02T03:04:05Z',
+        'updatedAt': '2015-01-02T03:04:05Z',
+        'pushedAt': None,
+        'readme0': None, 'readme1': None, 'readme2': None,
+        'readme3': None, 'readme4': None, 'readme5': None,
+    },
+}
+
+queries = []
+
+
+class StandIn(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        query = json.loads(self.rfile.read(length).decode('utf-8'))['query']
+        queries.append(query)
+        data = {}
+        for line in query.splitlines():
+            if ': repository(owner: ' in line:
+                alias = line[:line.find(':')].strip()
+                owner = line.split('owner: ')[1].split(',')[0]
+                name = line.split('name: ')[1].split(')')[0]
+                full_name = json.loads(owner) + '/' + json.loads(name)
+                data[alias] = repos.get(full_name)
+        body = json.dumps({'data': data}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-RateLimit-Remaining', '4990')
+        self.send_header('X-RateLimit-Reset', '2000000000')
+        self.send_header('X-RateLimit-Resource', 'graphql')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def endpoint():
+    server = http.server.HTTPServer(('127.0.0.1', 0), StandIn)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    del queries[:]
+    yield 'http://127.0.0.1:{}/graphql'.format(server.server_port)
+    server.shutdown()
+
+
+class TestClass:
+    def test_query_text(self):
+        text = graphql_query([('alice', 'tool'), ('bob', 'x"y')])
+        assert 'r0: repository(owner: "alice", name: "tool")' in text
+        assert 'r1: repository(owner: "bob", name: "x\\"y")' in text
+        assert 'readme0: object(expression: "HEAD:README.md")' in text
+
+    def test_batch(self, endpoint):
+        batcher = GraphQLBatcher(TokenPool([('u', 'p')]), endpoint)
+        names = [('alice', 'tool'), ('bob', 'tool'), ('nobody', 'nothing')]
+        results = batcher.query(names)
+        assert len(queries) == 1
+        assert results[('nobody', 'nothing')] == None
+
+        repo = results[('alice', 'tool')]
+        assert repo.id == 101
+        assert repo.owner.login == 'alice'
+        assert repo.full_name == 'alice/tool'
+        assert repo.default_branch == 'master'
+        assert repo.language == 'C'
+        assert repo.languages == {'C': 900, 'Shell': 10}
+        assert repo.licenses == ['MIT License']
+        assert repo.readme == 'Plain readme'
+        assert repo.fork == False and repo.parent == None
+        assert repo.pushed_at.year == 2016
+
+        fork = results[('bob', 'tool')]
+        assert fork.parent.full_name == 'carol/tool'
+        assert fork.source.full_name == 'alice/tool'
+        assert fork.default_branch == None
+        assert fork.languages == {}
+        assert fork.licenses == []
+        assert fork.readme == -1
+        assert fork.pushed_at == None
+
+    def test_batch_size(self, endpoint):
+        batcher = GraphQLBatcher(TokenPool([('u', 'p')]), endpoint)
+        names = [('alice', 'tool')] * 250
+        batcher.query(names)
+        assert len(queries) == 3
+
+    def test_rate_limit(self, endpoint):
+        tokens = TokenPool([('u', 'p')])
+        batcher = GraphQLBatcher(tokens, endpoint)
+        batcher.query([('alice', 'tool')])
+        # GraphQL has a budget of its own, apart from the REST API's.
+        assert tokens.calls_left('graphql') == 4990
+        assert tokens.calls_left() == 5000
+        assert not tokens.known()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3.4
+#
+# @file    test_github_html.py
+# @brief   Py.test testing code.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+import glob
+import json
+import os
+import pytest
+import sys
+
+sys.path.append('../collector')
+
+from github_html import *
+
+
+# The corpus holds saved home pages, each with a .json file of the values
+# that the GitHubHomePage methods should return for it.  Owner and name are
+# what the crawler would have asked for when it fetched the page.
+
+corpus_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'corpus', 'github_html')
+
+cases = sorted(os.path.splitext(os.path.basename(f))[0]
+               for f in glob.glob(os.path.join(corpus_dir, '*.html')))
+
+fields = ['description', 'homepage', 'languages', 'forked_from',
+          'default_branch', 'files', 'num_commits', 'num_branches',
+          'num_releases', 'num_contributors', 'licenses']
+
+
+def corpus_page(case):
+    with open(os.path.join(corpus_dir, case + '.html'), encoding='utf-8') as f:
+        text = f.read()
+    with open(os.path.join(corpus_dir, case + '.json'), encoding='utf-8') as f:
+        expected = json.load(f)
+    return (text, expected)
+
+
+def parsed_page(text, expected, wanted=None):
+    page = GitHubHomePage(wanted)
+    page._owner = expected['owner']
+    page._name  = expected['name']
+    page.set_html(text)
+    return page
+
+
+class FakeResponse():
+    # Enough of a streamed requests response for read_wanted().
+    encoding = 'utf-8'
+
+    def __init__(self, text):
+        self._body = text.encode('utf-8')
+        self.bytes_read = 0
+
+    def iter_content(self, size):
+        for start in range(0, len(self._body), size):
+            chunk = self._body[start : start + size]
+            self.bytes_read += len(chunk)
+            yield chunk
+
+    def close(self):
+        pass
+
+
+class TestClass:
+    def test_corpus_has_cases(self):
+        for case in ['normal', 'empty', 'fork', 'problem', 'huge_files', 'odd_branch']:
+            assert case in cases
+
+    @pytest.mark.parametrize('case', cases)
+    def test_fields(self, case):
+        (text, expected) = corpus_page(case)
+        page = parsed_page(text, expected)
+        assert page.owner() == expected['owner']
+        assert page.name() == expected['name']
+        assert page.is_problem() == expected['is_problem']
+        assert page.is_empty() == expected['is_empty']
+        for field in fields:
+            assert getattr(page, field)() == expected[field], field
+
+    @pytest.mark.parametrize('case', cases)
+    def test_single_pass_matches_methods(self, case):
+        # The per-field methods recompute their values from the HTML when
+        # forced, independently of scan_home_page().
+        (text, expected) = corpus_page(case)
+        page = parsed_page(text, expected)
+        for field in fields:
+            assert getattr(page, field)(force=True) == expected[field], field
+
+    @pytest.mark.parametrize('case', cases)
+    def test_selected_fields(self, case):
+        (text, expected) = corpus_page(case)
+        for field in fields:
+            page = parsed_page(text, expected, [field])
+            assert getattr(page, field)() == expected[field], field
+
+    @pytest.mark.parametrize('case', cases)
+    def test_read_wanted(self, case):
+        (text, expected) = corpus_page(case)
+        for field in fields:
+            page = GitHubHomePage([field])
+            partial = page.read_wanted(FakeResponse(text))
+            assert text.startswith(partial)
+            page = parsed_page(partial, expected, [field])
+            assert getattr(page, field)() == expected[field], field
+
+    def test_read_wanted_stops_early(self):
+        (text, expected) = corpus_page('huge_files')
+        response = FakeResponse(text)
+        GitHubHomePage(['licenses']).read_wanted(response)
+        assert response.bytes_read < len(text) / 10
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3.4
+#
+# @file    test_github_indexer.py
+# @brief   Py.test testing code.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+import pytest
+import sys
+from time import time
+
+sys.path.append('../collector')
+
+mongomock = pytest.importorskip('mongomock')
+
+from github_indexer import *
+
+
+# Entries as they are stored, and GitHub's side of things, as returned by
+# the methods that go over the network.  Those methods are replaced, so that
+# everything else that the actions do runs as usual against a mongomock
+# collection.
+
+def stored_entry(id, refreshed):
+    now = time()
+    return {'_id': id, 'owner': 'alice', 'name': 'tool' + str(id),
+            'description': 'A tool', 'homepage': None, 'default_branch': 'master',
+            'is_deleted': False, 'is_visible': True, 'fork': False,
+            'languages': [], 'licenses': [], 'files': [], 'readme': None,
+            'content_type': [], 'text_languages': [],
+            'num_commits': None, 'num_branches': None, 'num_releases': None,
+            'num_contributors': None,
+            'time': {'repo_created': now - 1000, 'repo_updated': now - 100,
+                     'repo_pushed': now - 100, 'data_refreshed': refreshed}}
+
+
+def github_repo(entry):
+    return GraphQLRepo({'databaseId': entry['_id'], 'name': entry['name'],
+                        'owner': {'login': entry['owner']},
+                        'description': 'A better tool', 'homepageUrl': None,
+                        'isPrivate': False, 'isFork': False,
+                        'createdAt': None, 'updatedAt': None, 'pushedAt': None,
+                        'defaultBranchRef': {'name': 'master'},
+                        'primaryLanguage': {'name': 'C'},
+                        'languages': {'edges': [{'size': 10, 'node': {'name': 'C'}}]},
+                        'licenseInfo': None})
+
+
+def offline_indexer(entries, broken=()):
+    # The readme of each entry in 'broken' can't be had.
+    github_db = mongomock.MongoClient().github
+    github_db.repos.insert_many(entries)
+    indexer = GitHubIndexer('user', 'password', github_db)
+
+    def set_files(entry, force=False):
+        indexer.update_entry_field(entry, 'files', ['main.c', 'README.md'])
+
+    def get_readme(entry, prefer_http=False, api_only=False):
+        if entry['_id'] in broken:
+            raise ValueError('cannot get README for {}'.format(entry['_id']))
+        return ('api', 'This is a README file.')
+
+    indexer.api_calls_left    = lambda: 5000
+    indexer.repo_via_api      = lambda owner, name: (True, github_repo(
+        github_db.repos.find_one({'owner': owner, 'name': name})))
+    indexer.get_languages     = lambda entry, conditional=False: {'C': 10}
+    indexer.set_files_via_svn = set_files
+    indexer.get_readme        = get_readme
+    return (indexer, github_db.repos)
+
+
+class TestClass:
+    def test_refresh_targets(self):
+        (indexer, repos) = offline_indexer([stored_entry(5, None)])
+        indexer.refresh(targets=[5])
+        entry = repos.find_one({'_id': 5})
+        assert entry['description'] == 'A better tool'
+        assert entry['languages'] == [{'name': 'C'}]
+        assert entry['files'] == ['main.c', 'README.md']
+        assert entry['readme'] == 'This is a README file.'
+        assert entry['time']['data_refreshed'] != None
+
+    def test_refresh_selected(self):
+        # Entry 3 was refreshed after it last changed, so it's left alone,
+        # and entry 2's README can't be had, so it isn't marked refreshed.
+        long_ago = time() - 10000
+        entries = [stored_entry(1, long_ago), stored_entry(2, long_ago),
+                   stored_entry(3, time()), stored_entry(4, None)]
+        (indexer, repos) = offline_indexer(entries, broken=[2])
+        indexer._refresh_chunk = 2
+        indexer.refresh()
+        refreshed = {e['_id']: e['time']['data_refreshed'] for e in repos.find()}
+        assert refreshed[1] > long_ago and refreshed[4] != None
+        assert refreshed[2] == long_ago
+        assert repos.find_one({'_id': 3})['readme'] == None
+        assert repos.find_one({'_id': 2})['files'] == ['main.c', 'README.md']
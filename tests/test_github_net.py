@@ -0,0 +1,107 @@
+#!/usr/bin/env python3.4
+#
+# @file    test_github_net.py
+# @brief   Py.test testing code.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+import gzip
+import http.server
+import pytest
+import sys
+import threading
+
+sys.path.append('../collector')
+
+from github_net import *
+
+
+# Stand-in web server.  The path says what to send back: /plain/<n> sends
+# n bytes with a Content-Length header, /chunked/<n> sends them without
+# one, and /gzip/<n> sends n bytes compressed.  The bytes are made of a
+# two-byte UTF-8 character, so that chunks often end in the middle of one.
+
+unit = 'é'.encode('utf-8')
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        (_, kind, size) = self.path.split('/')
+        body = unit * (int(size) // len(unit))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        if kind == 'gzip':
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        if kind == 'chunked':
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for start in range(0, len(body), 1000):
+                chunk = body[start : start + 1000]
+                self.wfile.write('{:x}\r\n'.format(len(chunk)).encode('ascii'))
+                self.wfile.write(chunk + b'\r\n')
+            self.wfile.write(b'0\r\n\r\n')
+        else:
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def pool():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield ConnectionPool('127.0.0.1:{}'.format(server.server_port), secure=False)
+    server.shutdown()
+
+
+class TestClass:
+    @pytest.mark.parametrize('kind', ['plain', 'chunked', 'gzip'])
+    def test_under_limit(self, pool, kind):
+        response = pool.request('GET', '/{}/200000'.format(kind), max_size=200000)
+        assert not response.truncated
+        assert response.text() == 'é' * 100000
+
+    @pytest.mark.parametrize('kind', ['plain', 'chunked', 'gzip'])
+    def test_over_limit(self, pool, kind):
+        response = pool.request('GET', '/{}/200002'.format(kind), max_size=200000)
+        assert response.truncated
+        assert response.text() == None
+        # The pool must still work after abandoning a response.
+        response = pool.request('GET', '/{}/10'.format(kind), max_size=200000)
+        assert response.text() == 'é' * 5
+
+    def test_without_limit(self, pool):
+        response = pool.request('GET', '/gzip/1000')
+        assert not response.truncated
+        assert response.text() == 'é' * 500
+
+    def test_charset(self):
+        assert response_charset({}) == 'utf-8'
+        assert response_charset({'Content-Type': 'text/plain; charset=latin-1'}) == 'latin-1'
+        assert response_charset({'Content-Type': 'text/plain; charset=bogus'}) == 'utf-8'
+
+    def test_etag_cache(self):
+        mongomock = pytest.importorskip('mongomock')
+        collection = mongomock.MongoClient().github.etags
+        collection.insert_one({'_id': 'a', 'etag': '"1"', 'last_modified': None})
+        cache = ETagCache(collection)
+        cache.store('b', {'ETag': '"2"'})
+        # Stored but not yet written.
+        assert cache.headers('b') == {'If-None-Match': '"2"'}
+        cache.load(['a', 'c'])
+        collection.delete_many({})
+        assert cache.headers('a') == {'If-None-Match': '"1"'}
+        assert cache.headers('c') == {}
+        cache.flush()
+        assert collection.find_one({'_id': 'b'})['etag'] == '"2"'
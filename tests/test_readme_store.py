@@ -0,0 +1,61 @@
+#!/usr/bin/env python3.4
+#
+# @file    test_readme_store.py
+# @brief   Py.test testing code.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+import pytest
+import sys
+from bson import BSON
+
+sys.path.append('../collector')
+
+from readme_store import *
+
+
+class TestClass:
+    def test_round_trip(self):
+        text = 'Überblick\n\nThis package does things. ' * 50
+        stored = compress_readme(text)
+        assert is_compressed(stored)
+        assert len(stored) < len(text)
+        assert readme_text(stored) == text
+
+    def test_round_trip_through_bson(self):
+        text = '# Title\n\nSome text in a README file.\n' * 20
+        doc = BSON.encode({'readme': compress_readme(text)}).decode()
+        assert is_compressed(doc['readme'])
+        assert readme_text(doc['readme']) == text
+
+    def test_left_alone(self):
+        for value in [None, -1, -2, '', 'Tiny']:
+            assert compress_readme(value) == value
+            assert not is_compressed(compress_readme(value))
+            assert readme_text(value) == value
+
+    def test_store_keeps_one_copy(self):
+        mongomock = pytest.importorskip('mongomock')
+        store = ReadmeStore(mongomock.MongoClient().db.readmes)
+        text = 'The same README in many forks.\n' * 10
+        refs = [store.put(text) for _ in range(5)]
+        assert all(ref == refs[0] for ref in refs)
+        assert store.db.count_documents({}) == 1
+        assert store.text(refs[0]) == text
+        assert store.text({'blob': 'missing'}) == None
+        assert store.text(-1) == -1
+
+    def test_store_cache(self):
+        mongomock = pytest.importorskip('mongomock')
+        store = ReadmeStore(mongomock.MongoClient().db.readmes)
+        ref = store.put('Something worth saying about this code.' * 10, compress=True)
+        assert is_compressed(store.db.find_one()['readme'])
+        assert store.cached(ref, 'text_language') == (False, None)
+        store.cache(ref, 'text_language', 'en')
+        assert store.cached(ref, 'text_language') == (True, 'en')
+        assert store.cached('plain text', 'text_language') == (False, None)
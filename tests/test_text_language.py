@@ -0,0 +1,87 @@
+#!/usr/bin/env python3.4
+#
+# @file    test_text_language.py
+# @brief   Py.test testing code.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+import glob
+import os
+import pytest
+import re
+import sys
+import warnings
+
+sys.path.append('../collector')
+
+langid = pytest.importorskip('langid')
+
+from text_language import *
+
+
+# The corpus holds README files in various formats.  remove_markup() should
+# leave the same words as the way detect_text_lang used to get the text,
+# which is reference_text() below.  For reStructuredText and Textile, which
+# that didn't understand, it should only take words away.
+
+corpus_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'corpus', 'text_language')
+
+cases = sorted(os.path.basename(f) for f in glob.glob(os.path.join(corpus_dir, '*')))
+
+
+def corpus_text(case):
+    with open(os.path.join(corpus_dir, case), encoding='utf-8') as f:
+        return f.read()
+
+
+def reference_text(text):
+    bs4 = pytest.importorskip('bs4')
+    markdown = pytest.importorskip('markdown')
+    pytest.importorskip('lxml')
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        if bs4.BeautifulSoup(text, 'html.parser').find():
+            html = text
+        elif re.search('^#', text) or text.find(']('):
+            html = markdown.markdown(text)
+        else:
+            return text
+        return ''.join(bs4.BeautifulSoup(html, 'lxml').findAll(text=True))
+
+
+def words(text):
+    return re.findall(r'\w+', text)
+
+
+class TestClass:
+    def test_corpus_has_cases(self):
+        kinds = {os.path.splitext(case)[1] for case in cases}
+        assert kinds == {'.md', '.html', '.rst', '.textile', '.txt'}
+
+    @pytest.mark.parametrize('case', cases)
+    def test_same_words(self, case):
+        text = corpus_text(case)
+        expected = words(reference_text(text))
+        found = words(remove_markup(text))
+        if case.endswith(('.rst', '.textile')):
+            assert set(found) <= {w.strip('_') for w in expected} | set(expected)
+            assert len(found) < len(expected)
+        else:
+            assert found == expected
+
+    @pytest.mark.parametrize('case', cases)
+    def test_same_language(self, case):
+        text = corpus_text(case)
+        assert readme_language(text) == langid.classify(reference_text(text))[0]
+
+    def test_guess_html(self):
+        assert guess_html('<p>Hello</p>')
+        assert guess_html('Some <b>bold</b> text')
+        assert not guess_html('if a < b and c > d')
+        assert not guess_html('See <https://example.com/> for more')
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3.4
+#
+# @file    test_write_buffer.py
+# @brief   Py.test testing code.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+import pytest
+import sys
+from pymongo.errors import AutoReconnect
+from time import sleep
+
+sys.path.append('../collector')
+
+from write_buffer import *
+
+
+class Recorder():
+    # Stands in for a Mongo collection, remembering each bulk write.
+    def __init__(self):
+        self.writes = []
+
+    def bulk_write(self, ops, ordered=True):
+        assert ordered == False
+        self.writes.append([(op._filter, op._doc) for op in ops])
+
+
+class Unreachable(Recorder):
+    # Fails the first 'failures' bulk writes as if the server were down.
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    def bulk_write(self, ops, ordered=True):
+        if self.failures > 0:
+            self.failures -= 1
+            raise AutoReconnect('connection closed')
+        super().bulk_write(ops, ordered)
+
+
+class TestClass:
+    def test_merge_same_id(self):
+        db = Recorder()
+        buffer = WriteBuffer(db)
+        buffer.update(1, {'is_visible': False, 'time.data_refreshed': 10})
+        buffer.update(1, {'is_deleted': True, 'time.data_refreshed': 11})
+        buffer.update(1, {}, {'licenses': 'MIT'})
+        buffer.update(1, {}, {'licenses': 'GPL'})
+        buffer.update(2, {'files': -1})
+        assert db.writes == []
+        buffer.flush()
+        assert db.writes == [[
+            ({'_id': 1}, {'$set': {'is_visible': False, 'is_deleted': True,
+                                   'time.data_refreshed': 11},
+                          '$addToSet': {'licenses': {'$each': ['MIT', 'GPL']}}}),
+            ({'_id': 2}, {'$set': {'files': -1}})]]
+        buffer.flush()
+        assert len(db.writes) == 1
+
+    def test_conflicting_fields(self):
+        db = Recorder()
+        buffer = WriteBuffer(db)
+        buffer.update(1, {'fork': {'parent': 'a/b', 'root': None}})
+        buffer.update(1, {'fork.parent': 'c/d'})
+        buffer.flush()
+        assert db.writes == [[({'_id': 1}, {'$set': {'fork': {'parent': 'a/b', 'root': None}}})],
+                             [({'_id': 1}, {'$set': {'fork.parent': 'c/d'}})]]
+
+    def test_batch_size(self):
+        db = Recorder()
+        buffer = WriteBuffer(db, batch_size=3)
+        for id in range(0, 7):
+            buffer.update(id, {'files': -1})
+        assert [len(w) for w in db.writes] == [3, 3]
+        buffer.flush()
+        assert [len(w) for w in db.writes] == [3, 3, 1]
+
+    def test_unreachable_database(self):
+        db = Unreachable(WriteBuffer._tries)
+        buffer = WriteBuffer(db)
+        buffer._retry_sec = 0
+        buffer.update(1, {'files': -1})
+        with pytest.raises(AutoReconnect):
+            buffer.flush()
+        buffer.update(1, {'fork.parent': 'a/b'})
+        buffer.update(1, {'fork': None})
+        buffer.flush()
+        assert db.writes == [[({'_id': 1}, {'$set': {'files': -1}})],
+                             [({'_id': 1}, {'$set': {'fork.parent': 'a/b'}})],
+                             [({'_id': 1}, {'$set': {'fork': None}})]]
+
+    def test_timed_flush(self):
+        db = Recorder()
+        buffer = WriteBuffer(db, interval=0.1)
+        buffer.update(1, {'files': -1})
+        sleep(0.5)
+        assert db.writes == [[({'_id': 1}, {'$set': {'files': -1}})]]